@@ -0,0 +1,9 @@
+from http.server import BaseHTTPRequestHandler
+from tinyagents.registry import serve_agents
+
+# --- ELENCO DEGLI AGENTI PER LA MINI APP ---
+# Stessa configurazione usata dal bot (agents.json), senza i system prompt.
+
+class handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        serve_agents(self)
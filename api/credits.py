@@ -0,0 +1,9 @@
+from http.server import BaseHTTPRequestHandler
+from tinyagents.miniapp import serve_credits
+
+# --- SALDO DEI CREDITI PER LA MINI APP ---
+# Autenticazione con initData firmato da Telegram (header `Authorization: tma <initData>`).
+
+class handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        serve_credits(self)
@@ -1,8 +1,10 @@
 import os
 import json
 from http.server import BaseHTTPRequestHandler
-from supabase.client import create_client, Client
-import stripe
+from tinyagents import metrics
+from tinyagents.clients import get_stripe
+from tinyagents.credits import apply_stripe_event
+from tinyagents.dedup import MemorySeenSet
 
 # --- CONFIGURAZIONE INIZIALE ---
 # Le chiavi API vengono lette dalle variabili d'ambiente di Vercel
@@ -11,62 +13,52 @@ SUPABASE_KEY = os.environ.get('SUPABASE_KEY')
 STRIPE_SECRET_KEY = os.environ.get('STRIPE_SECRET_KEY')
 STRIPE_WEBHOOK_SECRET = os.environ.get('STRIPE_WEBHOOK_SECRET') # Chiave segreta del webhook di Stripe
 
-# Inizializza i client
-try:
-    supabase_client: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
-except Exception as e:
-    print(f"Attenzione: Impossibile inizializzare Supabase client. Errore: {e}")
-    supabase_client = None
+# I client sono condivisi con /api/telegram e creati una sola volta per istanza,
+# alla prima richiesta: l'import dell'SDK di Stripe non pesa sul cold start
 
-try:
-    stripe.api_key = STRIPE_SECRET_KEY
-except Exception as e:
-    print(f"Attenzione: Impossibile inizializzare Stripe. Errore: {e}")
+def _stripe_sdk():
+    """Modulo `stripe` (configurato se STRIPE_SECRET_KEY è presente, importato al primo utilizzo)."""
+    stripe = get_stripe()
+    if stripe is None:
+        # La verifica della firma non richiede la chiave API
+        import stripe
+    return stripe
 
-# --- FUNZIONE DI AGGIORNAMENTO CREDITI (SUPABASE) ---
+# --- FUNZIONE DI AGGIORNAMENTO CREDITI ---
+# apply_stripe_event accredita i crediti una sola volta per evento (vedi tinyagents/credits.py)
 
-def add_credits_to_user(user_id: int, amount: int):
-    """Aggiunge crediti all'utente in Supabase."""
-    if not supabase_client:
-        return False
-        
-    try:
-        # Recupera il record dell'utente
-        response = supabase_client.table('users').select('credits').eq('id', user_id).execute()
-        
-        if response.data:
-            current_credits = response.data[0]['credits']
-            new_credits = current_credits + amount
-            
-            # Aggiorna i crediti
-            supabase_client.table('users').update({"credits": new_credits}).eq('id', user_id).execute()
-            print(f"Crediti aggiornati per utente {user_id}: {current_credits} -> {new_credits}")
-            return True
-        else:
-            # Utente non trovato, lo creiamo con i crediti acquistati
-            supabase_client.table('users').insert({"id": user_id, "credits": amount}).execute()
-            print(f"Nuovo utente creato con {amount} crediti: {user_id}")
-            return True
-            
-    except Exception as e:
-        print(f"Errore Supabase (add_credits_to_user): {e}")
-        return False
+# --- EVENTI GIÀ APPLICATI ---
+# Indice in memoria degli eventi Stripe già accreditati da questa istanza: durante
+# le raffiche di retry la risposta arriva da qui senza interrogare il database.
+# La garanzia di unicità resta la tabella stripe_events (vedi sql/credits.sql).
+processed_events = MemorySeenSet(window=7 * 24 * 3600)
 
 # --- GESTORE DELLA RICHIESTA HTTP (WEBHOOK STRIPE) ---
 class handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        # Metriche dell'istanza in formato Prometheus (route /api/stripe-webhook/metrics)
+        metrics.serve_metrics(self)
+
     def do_POST(self):
+        metrics.begin_request()
+        with metrics.span("request", handler="stripe_webhook"):
+            self._handle_post()
+
+    def _handle_post(self):
         # Leggi il corpo della richiesta
         content_length = int(self.headers['Content-Length'])
         payload = self.rfile.read(content_length)
         sig_header = self.headers.get('stripe-signature')
         
         event = None
+        stripe = _stripe_sdk()
         
         # Verifica la firma del webhook per sicurezza
         try:
-            event = stripe.Webhook.construct_event(
-                payload, sig_header, STRIPE_WEBHOOK_SECRET
-            )
+            with metrics.span("stripe_construct_event"):
+                event = stripe.Webhook.construct_event(
+                    payload, sig_header, STRIPE_WEBHOOK_SECRET
+                )
         except ValueError as e:
             # Invalid payload
             self.send_response(400)
@@ -78,12 +70,19 @@ class handler(BaseHTTPRequestHandler):
             self.end_headers()
             return
 
+        # Evento già applicato: risposta immediata, nessuna operazione sui crediti
+        if event['id'] in processed_events:
+            metrics.inc("tinyagents_stripe_duplicates_total")
+            self.send_response(200)
+            self.end_headers()
+            return
+
         # Gestisci l'evento
         if event['type'] == 'checkout.session.completed':
             session = event['data']['object']
             
             # Recupera l'ID utente Telegram dal metadata
-            telegram_user_id = session.get('client_reference_id')
+            telegram_user_id = getattr(session, 'client_reference_id', None)
             
             if telegram_user_id:
                 try:
@@ -92,7 +91,14 @@ class handler(BaseHTTPRequestHandler):
                     # Per semplicità, assumiamo che l'acquisto dia 100 crediti
                     CREDITS_TO_ADD = 100 
                     
-                    if add_credits_to_user(int(telegram_user_id), CREDITS_TO_ADD):
+                    # Accredito e registrazione dell'evento in un'unica operazione atomica
+                    new_credits = apply_stripe_event(event['id'], int(telegram_user_id), CREDITS_TO_ADD)
+                    
+                    if new_credits is not None:
+                        if new_credits == -1:
+                            print(f"Evento Stripe {event['id']} già applicato.")
+                            metrics.inc("tinyagents_stripe_duplicates_total")
+                        processed_events.add(event['id'])
                         self.send_response(200)
                         self.end_headers()
                         return
@@ -1,12 +1,20 @@
 import os
 import json
+import math
+import threading
 from http.server import BaseHTTPRequestHandler
-from urllib.parse import parse_qsl, urlparse
-import telegram
-from telegram import ParseMode
-from groq import Groq
-from supabase.client import create_client, Client
-import stripe
+from tinyagents import metrics
+from tinyagents.admission import create_admission_controller
+from tinyagents.cache import create_response_cache
+from tinyagents.clients import get_bot, get_groq_client, get_stripe
+from tinyagents.credit_store import CREDITS_BACKEND
+from tinyagents.credits import get_user_credits, refund_credits, reserve_credits
+from tinyagents.dedup import create_deduplicator
+from tinyagents.fanout import MULTI_COMMAND, parse_agent_list, run_concurrently
+from tinyagents.hedging import LLMRouter
+from tinyagents.jobs import WorkerPool, create_job_queue
+from tinyagents.outbound import Outbox
+from tinyagents.registry import get_registry, parse_command
 
 # --- CONFIGURAZIONE INIZIALE ---
 # Le chiavi API vengono lette dalle variabili d'ambiente di Vercel
@@ -14,68 +22,23 @@ TELEGRAM_TOKEN = os.environ.get('TELEGRAM_TOKEN')
 GROQ_API_KEY = os.environ.get('GROQ_API_KEY')
 SUPABASE_URL = os.environ.get('SUPABASE_URL')
 SUPABASE_KEY = os.environ.get('SUPABASE_KEY')
+# Con CREDITS_BACKEND=sqlite i crediti sono locali e Supabase non serve
+DATABASE_CONFIGURED = CREDITS_BACKEND != 'supabase' or bool(SUPABASE_URL and SUPABASE_KEY)
 STRIPE_SECRET_KEY = os.environ.get('STRIPE_SECRET_KEY')
 STRIPE_PRODUCT_ID = os.environ.get('STRIPE_PRODUCT_ID')
+# Se attivo, la risposta dell'agente viene mostrata man mano che viene generata
+LLM_STREAMING = os.environ.get('LLM_STREAMING', '').lower() in ('1', 'true', 'yes')
+# Se attivo, il webhook accoda gli update e risponde subito (vedi tinyagents/jobs.py)
+ASYNC_UPDATES = os.environ.get('ASYNC_UPDATES', '').lower() in ('1', 'true', 'yes')
 
-# --- FUNZIONI DI GESTIONE CREDITI (SUPABASE) ---
+DEFAULT_BOT_URL = 'https://t.me/TinyAgents_bot'
 
-def get_supabase_client() -> Client | None:
-    """Inizializza e restituisce il client Supabase."""
-    if not SUPABASE_URL or not SUPABASE_KEY:
-        return None
-    try:
-        return create_client(SUPABASE_URL, SUPABASE_KEY)
-    except Exception as e:
-        print(f"Errore durante l'inizializzazione del client Supabase: {e}")
-        return None
+# Valore di telegram.ParseMode.MARKDOWN: gli SDK (telegram, groq, supabase,
+# stripe) vengono importati solo al primo utilizzo, per ridurre i cold start
+MARKDOWN = 'Markdown'
 
-def get_user_credits(user_id: int) -> int:
-    """Recupera i crediti dell'utente da Supabase. Crea un record se non esiste."""
-    supabase_client = get_supabase_client()
-    if not supabase_client:
-        return 0
-        
-    try:
-        response = supabase_client.table('users').select('credits').eq('id', user_id).execute()
-        
-        if response.data:
-            return response.data[0]['credits']
-        else:
-            # Inizializza l'utente con 0 crediti
-            supabase_client.table('users').insert({"id": user_id, "credits": 0}).execute()
-            return 0
-    except Exception as e:
-        print(f"Errore Supabase (get_user_credits): {e}")
-        return 0
-
-def decrement_user_credits(user_id: int) -> int:
-    """Decrementa i crediti dell'utente di 1 in modo atomico (o quasi) e restituisce il nuovo saldo. Restituisce -1 in caso di errore o crediti esauriti."""
-    supabase_client = get_supabase_client()
-    if not supabase_client:
-        return -1
-        
-    try:
-        # 1. Legge il saldo corrente
-        response = supabase_client.table('users').select('credits').eq('id', user_id).execute()
-        
-        if not response.data:
-            # L'utente non esiste, lo creiamo con 0 crediti e falliamo il decremento
-            supabase_client.table('users').insert({"id": user_id, "credits": 0}).execute()
-            return -1
-            
-        current_credits = response.data[0]['credits']
-        
-        if current_credits > 0:
-            new_credits = current_credits - 1
-            
-            # 2. Aggiorna il saldo
-            supabase_client.table('users').update({"credits": new_credits}).eq('id', user_id).execute()
-            return new_credits
-        
-        return -1 # Crediti esauriti
-    except Exception as e:
-        print(f"Errore Supabase (decrement_user_credits): {e}")
-        return -1
+# --- FUNZIONI DI GESTIONE CREDITI ---
+# Le operazioni sui crediti sono condivise con /api/stripe_webhook (vedi tinyagents/credits.py)
 
 # --- FUNZIONE DI ACQUISTO (STRIPE) ---
 
@@ -84,117 +47,431 @@ def create_stripe_checkout_session(user_id: int, bot_url: str) -> str:
     if not STRIPE_SECRET_KEY or not STRIPE_PRODUCT_ID:
         return "Errore di configurazione Stripe. Controlla STRIPE_PRODUCT_ID e STRIPE_SECRET_KEY."
     
-    try:
-        # Inizializzazione di Stripe all'interno della funzione
-        stripe.api_key = STRIPE_SECRET_KEY
-    except Exception as e:
-        print(f"Errore durante l'inizializzazione di Stripe: {e}")
+    # Stripe viene configurato una sola volta per istanza
+    stripe = get_stripe()
+    if not stripe:
         return "Errore interno durante l'inizializzazione di Stripe."
 
     success_url = f"https://t.me/TinyAgents_bot?start=success_{user_id}"
     cancel_url = f"https://t.me/TinyAgents_bot?start=cancel_{user_id}"
     
     try:
-        session = stripe.checkout.Session.create(
-            payment_method_types=['card'],
-            line_items=[{
-                'price': STRIPE_PRODUCT_ID,
-                'quantity': 1,
-            }],
-            mode='payment',
-            success_url=success_url,
-            cancel_url=cancel_url,
-            client_reference_id=str(user_id),
-            metadata={
-                'telegram_user_id': str(user_id),
-            }
-        )
+        with metrics.span("stripe", op="create_checkout_session"):
+            session = stripe.checkout.Session.create(
+                payment_method_types=['card'],
+                line_items=[{
+                    'price': STRIPE_PRODUCT_ID,
+                    'quantity': 1,
+                }],
+                mode='payment',
+                success_url=success_url,
+                cancel_url=cancel_url,
+                client_reference_id=str(user_id),
+                metadata={
+                    'telegram_user_id': str(user_id),
+                }
+            )
         return session.url
     except Exception as e:
         print(f"Errore Stripe: {e}")
         return "Errore durante la creazione della sessione di pagamento."
 
 
-# --- DEFINIZIONE DEI "TINY AGENTS" (10 AGENTI) ---
-AGENTS = {
-    "meme_persona": {
-        "description": "Trasforma una tua idea in una caption per un meme virale.",
-        "system_prompt": "Sei un generatore di meme. Data un'idea, crea una caption breve, divertente e virale in stile meme. Aggiungi 3-5 hashtag pertinenti e di tendenza. Rispondi solo con la caption e gli hashtag."
-    },
-    "viral_pitch": {
-        "description": "Scrivi un pitch freddo e conciso per LinkedIn.",
-        "system_prompt": "Sei un esperto di copywriting per LinkedIn. Scrivi un messaggio di direct message (DM) di massimo 50 parole basato sull'idea dell'utente. Il tono deve essere professionale ma accattivante. L'obiettivo è ottenere una risposta."
-    },
-    "roast_generator": {
-        "description": "Fornisci un argomento e io lo 'roasterò' simpaticamente.",
-        "system_prompt": "Sei un comico specializzato in 'roast'. Data una parola o una frase, crea una battuta divertente e pungente, ma mai offensiva o volgare. Sii creativo e inaspettato."
-    },
-    "email_writer": {
-        "description": "Scrivi email professionali e persuasive.",
-        "system_prompt": "Sei un esperto di email marketing. Scrivi un'email professionale e persuasiva basata sul tema fornito dall'utente. L'email deve essere breve (max 100 parole), con un oggetto accattivante e una call-to-action chiara."
-    },
-    "tweet_generator": {
-        "description": "Crea tweet virali e accattivanti.",
-        "system_prompt": "Sei un esperto di social media. Crea un tweet breve (max 280 caratteri), virale e accattivante basato sull'idea dell'utente. Aggiungi emoji pertinenti e hashtag di tendenza."
-    },
-    "product_description": {
-        "description": "Scrivi descrizioni di prodotti per e-commerce.",
-        "system_prompt": "Sei un copywriter di e-commerce. Scrivi una descrizione di prodotto breve e persuasiva (max 150 parole) basata sul prodotto descritto dall'utente. Evidenzia i benefici principali e crea urgenza d'acquisto."
-    },
-    "story_starter": {
-        "description": "Genera l'inizio di una storia affascinante.",
-        "system_prompt": "Sei uno scrittore creativo. Genera l'inizio di una storia affascinante (max 100 parole) basato sul tema fornito dall'utente. L'inizio deve catturare l'attenzione e creare suspense."
-    },
-    "code_explainer": {
-        "description": "Spiega concetti di programmazione in modo semplice.",
-        "system_prompt": "Sei un insegnante di programmazione. Spiega il concetto di programmazione fornito dall'utente in modo semplice e comprensibile (max 150 parole). Usa esempi pratici e evita il gergo tecnico complesso."
-    },
-    "motivational_quote": {
-        "description": "Genera citazioni motivazionali personalizzate.",
-        "system_prompt": "Sei un coach motivazionale. Genera una citazione motivazionale personalizzata (max 50 parole) basata sulla situazione o il tema fornito dall'utente. La citazione deve essere ispiratrice e pratica."
-    },
-    "seo_optimizer": {
-        "description": "Ottimizza il testo per i motori di ricerca.",
-        "system_prompt": "Sei un esperto SEO. Ottimizza il testo fornito dall'utente per i motori di ricerca (max 150 parole). Aggiungi parole chiave pertinenti, migliora la struttura e rendi il testo più accattivante per i lettori."
-    }
-}
+# --- DEFINIZIONE DEI "TINY AGENTS" ---
+# Gli agenti (prompt, modello, temperatura, max_tokens, cache) sono definiti in
+# agents.json e caricati una sola volta per istanza (vedi tinyagents/registry.py)
+registry = get_registry()
+AGENTS = registry.agents
+
+LLM_ERROR_MESSAGE = "Oops! Qualcosa è andato storto con l'intelligenza artificiale. Riprova tra poco."
+
+# Limiti di frequenza e di concorrenza davanti a Groq (vedi tinyagents/admission.py)
+admission_controller = create_admission_controller()
+
+# Cache delle risposte per gli agenti con "cacheable": True (vedi tinyagents/cache.py)
+response_cache = create_response_cache()
+
+def _llm_request_params(agent_name, user_input):
+    """Parametri della chiamata a Groq per l'agente richiesto."""
+    if agent_name not in AGENTS:
+        raise ValueError(f"Agente non valido: {agent_name}")
+
+    # Correzione: Aggiungere la sanitizzazione dell'input per prevenire Prompt Injection
+    # L'input dell'utente viene racchiuso in un delimitatore univoco.
+    return dict(
+        messages=[
+            {"role": "system", "content": AGENTS[agent_name]["system_prompt"]},
+            {"role": "user", "content": f"USER_INPUT_START\\n{user_input}\\nUSER_INPUT_END"},
+        ],
+        # Modello e budget di token specifici dell'agente
+        **registry.llm_params(agent_name),
+    )
+
+def _groq_client_or_raise():
+    # Client Groq condiviso: riusa le connessioni keep-alive dell'istanza
+    groq_client = get_groq_client()
+    if not groq_client:
+        raise RuntimeError("Chiave API Groq mancante.")
+    return groq_client
+
+# Instradamento delle chiamate a Groq (vedi tinyagents/hedging.py)
+llm_router = LLMRouter(_groq_client_or_raise)
+
+def _cache_key(agent_name, user_input, params):
+    """Chiave di cache della richiesta, o None se l'agente non usa la cache."""
+    if response_cache is None or not AGENTS[agent_name].get("cacheable"):
+        return None
+    return response_cache.make_key(agent_name, AGENTS[agent_name]["system_prompt"], params, user_input)
 
-def get_llm_response(agent_name, user_input):
+def request_llm_completion(agent_name, user_input):
     """
-    Funzione per interrogare l'LLM con il prompt specifico dell'agent.
+    Interroga l'LLM con il prompt specifico dell'agent e restituisce il testo generato.
+    Solleva un'eccezione se la chiamata non va a buon fine.
     """
-    if not GROQ_API_KEY:
-        return "Servizio AI non disponibile. Chiave API Groq mancante."
-        
-    if agent_name not in AGENTS:
-        return "Agente non valido."
+    params = _llm_request_params(agent_name, user_input)
+    cache_key = _cache_key(agent_name, user_input, params)
+    if cache_key:
+        cached = response_cache.get(agent_name, cache_key)
+        if cached is not None:
+            return cached
 
-    system_prompt = AGENTS[agent_name]["system_prompt"]
-    
+    # Circuit breaker per modello e, con LLM_HEDGING, richiesta duplicata al modello di riserva
+    chat_completion, _ = llm_router.complete(agent_name, params, AGENTS[agent_name].get("fallback_model"))
+    text = chat_completion.choices[0].message.content
+    if cache_key and text:
+        response_cache.set(cache_key, text)
+    return text
+
+def stream_llm_completion(agent_name, user_input):
+    """
+    Come `request_llm_completion`, ma restituisce un generatore che produce
+    i frammenti di testo man mano che Groq li genera.
+    """
+    params = _llm_request_params(agent_name, user_input)
+    cache_key = _cache_key(agent_name, user_input, params)
+    if cache_key:
+        cached = response_cache.get(agent_name, cache_key)
+        if cached is not None:
+            yield cached
+            return
+
+    # In streaming non si duplicano le richieste: il circuit breaker sceglie solo il modello
+    model = llm_router.select_model(params["model"], AGENTS[agent_name].get("fallback_model"))
+    parts = []
     try:
-        # Inizializzazione del client Groq all'interno della funzione
-        groq_client = Groq(api_key=GROQ_API_KEY)
-        
-        chat_completion = groq_client.chat.completions.create(
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_input},
-            ],
-            model="llama3-8b-8192",
-            temperature=0.7,
-            max_tokens=150,
-        )
-        return chat_completion.choices[0].message.content
+        with metrics.span("llm", agent=agent_name, model=model, stream=True):
+            stream = _groq_client_or_raise().chat.completions.create(stream=True, timeout=llm_router.timeout, **{**params, "model": model})
+            for chunk in stream:
+                # Groq riporta i token consumati nell'ultimo chunk (campo x_groq.usage)
+                x_groq = getattr(chunk, "x_groq", None)
+                if x_groq is not None and getattr(x_groq, "usage", None) is not None:
+                    metrics.record_llm_usage(agent_name, x_groq.usage, model)
+                if chunk.choices and chunk.choices[0].delta.content:
+                    parts.append(chunk.choices[0].delta.content)
+                    yield parts[-1]
+    except Exception:
+        llm_router.breaker(model).record_failure()
+        raise
+    # La durata dello stream include i tempi di Telegram: non entra nelle latenze del modello
+    llm_router.breaker(model).record_success()
+    if cache_key and parts:
+        response_cache.set(cache_key, "".join(parts))
+
+# --- RISPOSTE STATICHE ---
+PAYMENT_SUCCESS_MESSAGE = "🎉 Pagamento completato con successo! I tuoi crediti saranno aggiunti a breve. Usa /credits per controllare il saldo."
+PAYMENT_CANCEL_MESSAGE = "❌ Pagamento annullato. Puoi riprovare in qualsiasi momento con /buy."
+NO_CREDITS_MESSAGE = "🚫 **Crediti esauriti!** Per continuare a usare gli agenti, acquista nuovi crediti con il comando `/buy`."
+MULTI_NO_CREDITS_MESSAGE = "🚫 **Crediti insufficienti!** Servono {count} crediti, uno per agente. Acquista nuovi crediti con il comando `/buy`."
+CREDITS_ERROR_MESSAGE = "⚠️ Errore nel decremento dei crediti. Riprova o contatta l'assistenza."
+RATE_LIMITED_MESSAGE = "🐢 Troppe richieste in poco tempo. Riprova tra {seconds} secondi: nessun credito è stato utilizzato."
+BUSY_MESSAGE = "⏳ Gli agenti sono molto richiesti in questo momento. Riprova tra qualche secondo: nessun credito è stato utilizzato."
+UNKNOWN_COMMAND_MESSAGE = "Comando non riconosciuto. Usa /start per vedere la lista degli agenti disponibili."
+
+# --- RISPOSTE SENZA SERVIZI ESTERNI ---
+
+def static_response(command: str, args: str):
+    """
+    Risposta precalcolata (testo, parse_mode) per i comandi che non richiedono
+    Supabase, Groq o Stripe; None se il comando va eseguito da un gestore.
+    """
+    if command == "start":
+        # Deep link dei reindirizzamenti di Stripe: "/start success_<id>" o "/start cancel_<id>"
+        if args.startswith("success"):
+            return PAYMENT_SUCCESS_MESSAGE, None
+        if args.startswith("cancel"):
+            return PAYMENT_CANCEL_MESSAGE, None
+        # Il messaggio di benvenuto è precalcolato dal registro degli agenti
+        return registry.welcome_message, MARKDOWN
+    if command in AGENTS and not args:
+        return registry.usage_messages[command], MARKDOWN
+    if command == MULTI_COMMAND:
+        # Gli elenchi di agenti non validi vengono rifiutati senza toccare i crediti
+        try:
+            parse_agent_list(args, AGENTS)
+        except ValueError as e:
+            return str(e), None
+    if command not in COMMAND_HANDLERS:
+        return UNKNOWN_COMMAND_MESSAGE, None
+    return None
+
+def _message_fields(payload: dict):
+    """(chat_id, user_id, testo) del messaggio contenuto nell'update, senza usare l'SDK di Telegram."""
+    message = payload.get("message") or {}
+    chat_id = (message.get("chat") or {}).get("id")
+    user_id = (message.get("from") or {}).get("id")
+    return chat_id, user_id, message.get("text")
+
+def static_reply(payload: dict):
+    """
+    Se l'update ha una risposta precalcolata, restituisce la chiamata sendMessage
+    da inviare nel corpo della risposta al webhook (nessun SDK, nessuna chiamata HTTP).
+    """
+    chat_id, user_id, text = _message_fields(payload)
+    if chat_id is None or not text:
+        return None
+    command, args = parse_command(text)
+    if command is None:
+        return None
+    response = static_response(command, args)
+    if response is None:
+        return None
+    reply = {"method": "sendMessage", "chat_id": chat_id, "text": response[0]}
+    if response[1]:
+        reply["parse_mode"] = response[1]
+    return reply
+
+# --- GESTORI DEI COMANDI ---
+# Ogni gestore riceve (outbox, chat_id, user_id, comando, argomenti, bot_url)
+
+def handle_credits(outbox, chat_id, user_id, command, args, bot_url):
+    credits = get_user_credits(user_id)
+    outbox.send_message(chat_id=chat_id, text=f"Il tuo saldo attuale è di **{credits}** crediti. Usa `/buy` per ricaricare.", parse_mode=MARKDOWN)
+
+def handle_buy(outbox, chat_id, user_id, command, args, bot_url):
+    checkout_url = create_stripe_checkout_session(user_id, bot_url)
+
+    if "Errore" in checkout_url:
+        outbox.send_message(chat_id=chat_id, text=checkout_url)
+    else:
+        outbox.send_message(chat_id=chat_id, text=f"Clicca qui per acquistare crediti: [Acquista Crediti]({checkout_url})", parse_mode=MARKDOWN)
+
+def run_admitted(outbox, chat_id, user_id, calls, run):
+    """
+    Esegue `run()` se il controllo di ammissione concede `calls` chiamate a Groq.
+    Oltre i limiti si risponde subito, senza toccare i crediti.
+    """
+    admission = admission_controller.admit(user_id, calls=calls) if admission_controller else None
+    if admission is not None and not admission:
+        if admission.reason == "concurrency":
+            outbox.send_message(chat_id=chat_id, text=BUSY_MESSAGE)
+        else:
+            outbox.send_message(chat_id=chat_id, text=RATE_LIMITED_MESSAGE.format(seconds=max(1, math.ceil(admission.retry_after))))
+        return
+
+    try:
+        run()
+    finally:
+        if admission is not None:
+            admission.release()
+
+def handle_agent(outbox, chat_id, user_id, command, args, bot_url):
+    run_admitted(outbox, chat_id, user_id, 1, lambda: run_agent(outbox, chat_id, user_id, command, args))
+
+def run_agent(outbox, chat_id, user_id, command, args):
+    """Riserva il credito, interroga l'agente e invia la risposta."""
+    # Controllo e decremento del saldo in un'unica operazione atomica
+    new_credits = reserve_credits(user_id)
+    if new_credits == -1:
+        outbox.send_message(chat_id=chat_id, text=NO_CREDITS_MESSAGE, parse_mode=MARKDOWN)
+        return
+
+    if new_credits is None:
+        outbox.send_message(chat_id=chat_id, text=CREDITS_ERROR_MESSAGE)
+        return
+
+    if LLM_STREAMING:
+        # Il messaggio "Credito utilizzato" viene modificato man mano che arrivano i token
+        placeholder = outbox.send_message(chat_id=chat_id, text=f"✅ Credito utilizzato. Saldo rimanente: **{new_credits}**.\n⏳ Sto elaborando la tua richiesta...", parse_mode=MARKDOWN, wait=True)
+        if placeholder is not None:
+            stream_agent(outbox, chat_id, user_id, command, args, placeholder)
+            return
+
+    try:
+        response = request_llm_completion(command, args)
     except Exception as e:
+        # La risposta non è stata generata: il credito viene restituito
         print(f"Errore API Groq: {e}")
-        return "Oops! Qualcosa è andato storto con l'intelligenza artificiale. Riprova tra poco."
+        refund_credits(user_id)
+        outbox.send_message(chat_id=chat_id, text=LLM_ERROR_MESSAGE)
+        return
+
+    # Saldo e risposta in un solo messaggio, inviato con la Bot API: il Markdown dell'LLM
+    # non va nella risposta al webhook, dove Telegram non segnala errori
+    sent = outbox.send_message(chat_id=chat_id, text=f"✅ Credito utilizzato. Saldo rimanente: **{new_credits}**.\n\n{response}", parse_mode=MARKDOWN, wait=True)
+    if sent is None:
+        # La risposta non è arrivata all'utente: il credito viene restituito
+        refund_credits(user_id)
+
+def stream_agent(outbox, chat_id, user_id, command, args, placeholder):
+    """Mostra la risposta dell'agente modificando il messaggio `placeholder` man mano che arrivano i token."""
+    from tinyagents.streaming import MessageStreamer
+    streamer = MessageStreamer(outbox.bot, chat_id, placeholder.message_id)
+    try:
+        for delta in stream_llm_completion(command, args):
+            streamer.push(delta)
+        if not streamer.text:
+            raise RuntimeError("Risposta vuota dallo stream Groq.")
+        streamer.finish(parse_mode=MARKDOWN)
+    except Exception as e:
+        print(f"Errore API Groq (streaming): {e}")
+        refund_credits(user_id)
+        streamer.fail(LLM_ERROR_MESSAGE)
+
+def handle_multi(outbox, chat_id, user_id, command, args, bot_url):
+    agent_names, user_input = parse_agent_list(args, AGENTS)
+
+    # Una sola ammissione per tutte le chiamate: gettoni e slot di Groq per ogni agente
+    run_admitted(outbox, chat_id, user_id, len(agent_names),
+                 lambda: run_agents(outbox, chat_id, user_id, agent_names, user_input))
+
+def run_agents(outbox, chat_id, user_id, agent_names, user_input):
+    """Riserva un credito per agente, interroga gli agenti in parallelo e invia ogni risposta appena è pronta."""
+    # Tutti i crediti in un'unica operazione atomica
+    count = len(agent_names)
+    new_credits = reserve_credits(user_id, count)
+    if new_credits == -1:
+        outbox.send_message(chat_id=chat_id, text=MULTI_NO_CREDITS_MESSAGE.format(count=count), parse_mode=MARKDOWN)
+        return
+
+    if new_credits is None:
+        outbox.send_message(chat_id=chat_id, text=CREDITS_ERROR_MESSAGE)
+        return
+
+    # Il saldo viaggia insieme alla prima risposta pronta
+    header = f"✅ {count} crediti utilizzati. Saldo rimanente: **{new_credits}**.\n\n"
+    failed = 0
+    with metrics.span("multi_agent", agents=count):
+        for agent_name, response, error in run_concurrently(agent_names, lambda name: request_llm_completion(name, user_input)):
+            if error is not None:
+                print(f"Errore API Groq ({agent_name}): {error}")
+                failed += 1
+                response = LLM_ERROR_MESSAGE
+            # Ogni risposta parte appena è pronta, con la Bot API (Markdown dell'LLM)
+            sent = outbox.send_message(chat_id=chat_id, text=f"{header}{AGENTS[agent_name].get('emoji', '🔹')} `/{agent_name}`\n\n{response}",
+                                       parse_mode=MARKDOWN, wait=True)
+            if sent is None and error is None:
+                failed += 1
+            elif sent is not None:
+                header = ""
+
+    # Le risposte non generate o non consegnate vengono rimborsate insieme
+    if failed:
+        refund_credits(user_id, failed)
+
+# Tabella di dispatch: un solo lookup per comando invece di una catena di if/elif.
+# /start, i comandi senza argomenti e quelli sconosciuti hanno una risposta statica.
+COMMAND_HANDLERS = {
+    "credits": handle_credits,
+    "buy": handle_buy,
+    MULTI_COMMAND: handle_multi,
+    **{agent_name: handle_agent for agent_name in AGENTS},
+}
+
+# --- ELABORAZIONE DI UN UPDATE ---
+
+def process_update(payload: dict, bot_url: str = DEFAULT_BOT_URL, outbox: Outbox | None = None):
+    """
+    Esegue il comando contenuto in un update di Telegram (già decodificato da JSON).
+    Viene chiamata direttamente da do_POST oppure dai worker in modalità ack-first.
+    Se `outbox` è indicata, l'ultimo messaggio resta in sospeso per la risposta al
+    webhook; altrimenti tutti i messaggi vengono inviati con la Bot API.
+    """
+    with metrics.span("parse_update"):
+        chat_id, user_id, text = _message_fields(payload)
+
+    if chat_id is None or not text:
+        return
+
+    command, args = parse_command(text)
+    if command is None:
+        return
+
+    own_outbox = outbox is None
+    if own_outbox:
+        outbox = Outbox(get_bot)
+    try:
+        response = static_response(command, args)
+        if response is not None:
+            outbox.send_message(chat_id=chat_id, text=response[0], parse_mode=response[1])
+            return
+        COMMAND_HANDLERS[command](outbox, chat_id, user_id, command, args, bot_url)
+
+    except Exception as e:
+        # Logga l'errore specifico del gestore comandi
+        print(f"ERRORE GESTORE COMANDI: {e}")
+        outbox.send_message(chat_id=chat_id, text=f"Si è verificato un errore interno durante l'elaborazione del comando. Dettagli: {e}")
+    finally:
+        if own_outbox:
+            outbox.flush()
+
+# --- ELABORAZIONE ASINCRONA (ACK-FIRST) ---
+
+_job_queue = None
+_job_queue_lock = threading.Lock()
+
+def _process_job(job: dict):
+    process_update(job["update"], job["bot_url"])
+
+def get_job_queue():
+    """Restituisce la coda dei job, avviando i worker al primo utilizzo."""
+    global _job_queue
+    if _job_queue is None:
+        with _job_queue_lock:
+            if _job_queue is None:
+                job_queue = create_job_queue()
+                WorkerPool(job_queue, _process_job).start()
+                _job_queue = job_queue
+    return _job_queue
+
+def enqueue_update(payload: dict, bot_url: str = DEFAULT_BOT_URL) -> bool:
+    """
+    Valida l'update e lo accoda per i worker. Gli update senza testo vengono scartati subito.
+    Restituisce False se la coda è piena: in quel caso l'update va elaborato direttamente.
+    """
+    message = payload.get("message") or {}
+    if "update_id" not in payload or not message.get("text"):
+        return True
+    return get_job_queue().put({"update": payload, "bot_url": bot_url})
+
+# --- DEDUPLICAZIONE DEGLI UPDATE ---
+
+# Riconosce le riconsegne di Telegram dello stesso update_id (vedi tinyagents/dedup.py)
+update_deduplicator = create_deduplicator()
+
+def is_duplicate_update(payload: dict) -> bool:
+    """True se l'update è una riconsegna di uno già ricevuto da questa istanza."""
+    if update_deduplicator is None:
+        return False
+    if update_deduplicator.is_duplicate(payload.get("update_id")):
+        print(f"Update {payload.get('update_id')} duplicato ignorato (totale riconsegne assorbite: {update_deduplicator.duplicates})")
+        return True
+    return False
 
 # --- GESTORE DELLA RICHIESTA HTTP (SERVERLESS FUNCTION) ---
 class handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        # Metriche dell'istanza in formato Prometheus (route /api/metrics)
+        metrics.serve_metrics(self)
+
     def do_POST(self):
+        metrics.begin_request()
+        with metrics.span("request", handler="telegram"):
+            self._handle_post()
+
+    def _handle_post(self):
         # 1. CONTROLLO CRITICO DELLE VARIABILI D'AMBIENTE
         # Se le chiavi essenziali non sono presenti, invia un messaggio di errore all'utente
-        if not all([TELEGRAM_TOKEN, GROQ_API_KEY, SUPABASE_URL, SUPABASE_KEY]):
+        if not all([TELEGRAM_TOKEN, GROQ_API_KEY, DATABASE_CONFIGURED]):
             self.send_response(200)
             self.send_header('Content-type', 'application/json')
             self.end_headers()
@@ -204,17 +481,17 @@ class handler(BaseHTTPRequestHandler):
                 try:
                     content_length = int(self.headers['Content-Length'])
                     post_data = self.rfile.read(content_length)
-                    update = telegram.Update.from_dict(json.loads(post_data.decode('utf-8')))
-                    if update.message:
-                        bot = telegram.Bot(token=TELEGRAM_TOKEN)
+                    bot = get_bot()
+                    chat_id, _, _ = _message_fields(json.loads(post_data.decode('utf-8')))
+                    if chat_id is not None:
                         missing_keys = [k for k, v in {'GROQ_API_KEY': GROQ_API_KEY, 'SUPABASE_URL': SUPABASE_URL, 'STRIPE_SECRET_KEY': STRIPE_SECRET_KEY}.items() if not v]
-                        bot.send_message(chat_id=update.message.chat.id, text=f"⚠️ **ERRORE CRITICO DI CONFIGURAZIONE!** ⚠️\n\nIl bot non è configurato correttamente. Le seguenti chiavi sono mancanti o vuote in Vercel: {', '.join(missing_keys)}\n\n**SOLUZIONE:** Vai alla dashboard di Vercel e inserisci le chiavi mancanti.", parse_mode=ParseMode.MARKDOWN)
+                        bot.send_message(chat_id=chat_id, text=f"⚠️ **ERRORE CRITICO DI CONFIGURAZIONE!** ⚠️\n\nIl bot non è configurato correttamente. Le seguenti chiavi sono mancanti o vuote in Vercel: {', '.join(missing_keys)}\n\n**SOLUZIONE:** Vai alla dashboard di Vercel e inserisci le chiavi mancanti.", parse_mode=MARKDOWN)
                 except Exception as e:
                     print(f"Errore durante l'invio del messaggio di errore: {e}")
             
             return
         # Controllo delle chiavi API essenziali
-        if not TELEGRAM_TOKEN or not GROQ_API_KEY or not SUPABASE_URL or not SUPABASE_KEY:
+        if not TELEGRAM_TOKEN or not GROQ_API_KEY or not DATABASE_CONFIGURED:
             self.send_response(500)
             self.send_header('Content-type', 'application/json')
             self.end_headers()
@@ -234,128 +511,35 @@ class handler(BaseHTTPRequestHandler):
         content_length = int(self.headers['Content-Length'])
         post_data = self.rfile.read(content_length)
         
+        bot_url = self.headers.get('X-Forwarded-Host', DEFAULT_BOT_URL)
+        
         try:
-            update = telegram.Update.from_dict(json.loads(post_data.decode('utf-8')))
-            
-            if not update.message or not update.message.text:
-                self.send_response(200)
-                self.end_headers()
-                return
-
-            chat_id = update.message.chat.id
-            user_id = update.message.from_user.id
-            text = update.message.text
-
-            if not TELEGRAM_TOKEN:
-                bot = None
-            else:
-                bot = telegram.Bot(token=TELEGRAM_TOKEN)
-            
-            # Inizio del blocco di gestione dei comandi con try/except per debug
-            try:
-                # Logica di routing dei comandi
-                if text.startswith('/start'):
-                    # La logica di gestione dei pagamenti è stata spostata nella funzione do_GET per gestire i reindirizzamenti di Stripe
-                    # La logica di gestione dei pagamenti è stata spostata nella funzione do_GET per gestire i reindirizzamenti di Stripe
-                    # La logica di gestione dei pagamenti è stata spostata nella funzione do_GET per gestire i reindirizzamenti di Stripe
-                    
-                    # Gestione dei parametri di query per i reindirizzamenti di Stripe
-                    query = dict(parse_qsl(urlparse(text).query))
-                    
-                    if 'start' in query:
-                        start_param = query['start']
-                        if start_param.startswith("success"):
-                            bot.send_message(chat_id=chat_id, text="🎉 Pagamento completato con successo! I tuoi crediti saranno aggiunti a breve. Usa /credits per controllare il saldo.")
-                            self.send_response(200)
-                            self.end_headers()
-                            return
-                        elif start_param.startswith("cancel"):
-                            bot.send_message(chat_id=chat_id, text="❌ Pagamento annullato. Puoi riprovare in qualsiasi momento con /buy.")
-                            self.send_response(200)
-                            self.end_headers()
-                            return
-                    
-                    # Logica di benvenuto standard
-                    welcome_message = "Benvenuto in Tiny Agents! 🤖\n\n"
-                    welcome_message += "Scegli un micro-agente per un compito specifico:\n\n"
-                    for agent_name, data in AGENTS.items():
-                        welcome_message += f"🔹 `/{agent_name}` - {data['description']}\n"
-                    welcome_message += "\nUsa il comando seguito dalla tua richiesta. Esempio:\n`/meme_persona gatto che suona il pianoforte`\n\n"
-                    welcome_message += "💳 **Monetizzazione:** Usa `/credits` per vedere il tuo saldo e `/buy` per acquistare nuovi utilizzi."
-                    
-                    if bot:
-                        bot.send_message(chat_id=chat_id, text=welcome_message, parse_mode=ParseMode.MARKDOWN)
-                        welcome_message = "Benvenuto in Tiny Agents! 🤖\n\n"
-                        welcome_message += "Scegli un micro-agente per un compito specifico:\n\n"
-                        for agent_name, data in AGENTS.items():
-                            welcome_message += f"🔹 `/{agent_name}` - {data['description']}\n"
-                        welcome_message += "\nUsa il comando seguito dalla tua richiesta. Esempio:\n`/meme_persona gatto che suona il pianoforte`\n\n"
-                        welcome_message += "💳 **Monetizzazione:** Usa `/credits` per vedere il tuo saldo e `/buy` per acquistare nuovi utilizzi."
-                        
-                        if bot:
-                            bot.send_message(chat_id=chat_id, text=welcome_message, parse_mode=ParseMode.MARKDOWN)
-
-                elif text.startswith('/credits'):
-                    credits = get_user_credits(user_id)
-                    if bot:
-                        bot.send_message(chat_id=chat_id, text=f"Il tuo saldo attuale è di **{credits}** crediti. Usa `/buy` per ricaricare.", parse_mode=ParseMode.MARKDOWN)
-
-                elif text.startswith('/buy'):
-                    bot_url = self.headers.get('X-Forwarded-Host', 'https://t.me/TinyAgents_bot')
-                    checkout_url = create_stripe_checkout_session(user_id, bot_url)
-                    
-                    if "Errore" in checkout_url:
-                        bot.send_message(chat_id=chat_id, text=checkout_url)
-                    else:
-                        bot.send_message(chat_id=chat_id, text=f"Clicca qui per acquistare crediti: [Acquista Crediti]({checkout_url})", parse_mode=ParseMode.MARKDOWN)
-
-                elif text.startswith('/'):
-                    parts = text.split(' ', 1)
-                    command = parts[0][1:]
-                    
-                    if command in AGENTS:
-                        if len(parts) > 1:
-                            user_input = parts[1].strip()
-                            
-                            # Correzione: Aggiungere la sanitizzazione dell'input per prevenire Prompt Injection
-                            # L'input dell'utente viene racchiuso in un delimitatore univoco.
-                            user_input = f"USER_INPUT_START\\n{user_input}\\nUSER_INPUT_END"
-                            
-                            credits = get_user_credits(user_id)
-                            if credits <= 0:
-                                bot.send_message(chat_id=chat_id, text="🚫 **Crediti esauriti!** Per continuare a usare gli agenti, acquista nuovi crediti con il comando `/buy`.", parse_mode=ParseMode.MARKDOWN)
-                                self.send_response(200)
-                                self.end_headers()
-                                return
-
-                           new_credits = decrement_user_credits(user_id)
-                            
-                            if new_credits == -1:
-                                bot.send_message(chat_id=chat_id, text="⚠️ Errore nel decremento dei crediti o crediti esauriti. Riprova o contatta l'assistenza.")
-                                self.send_response(200)
-                                self.end_headers()
-                                return
-                            
-                            bot.send_message(chat_id=chat_id, text=f"✅ Credito utilizzato. Saldo rimanente: **{new_credits}**.\n⏳ Sto elaborando la tua richiesta...", parse_mode=ParseMode.MARKDOWN), parse_mode=ParseMode.MARKDOWN)
-                            
-                            response = get_llm_response(command, user_input)
-                            
-                            bot.send_message(chat_id=chat_id, text=response, parse_mode=ParseMode.MARKDOWN)
-                        else:
-                            if bot:
-                                bot.send_message(chat_id=chat_id, text=f"Uso corretto: `/{command} [la tua richiesta]`", parse_mode=ParseMode.MARKDOWN)
-                    else:
-                        if bot:
-                            bot.send_message(chat_id=chat_id, text="Comando non riconosciuto. Usa /start per vedere la lista degli agenti disponibili.")
-                
-                else:
-                    pass
-            
-            except Exception as e:
-                # Logga l'errore specifico del gestore comandi
-                print(f"ERRORE GESTORE COMANDI: {e}")
-                if bot and chat_id:
-                    bot.send_message(chat_id=chat_id, text=f"Si è verificato un errore interno durante l'elaborazione del comando. Dettagli: {e}")
+            with metrics.span("parse_body"):
+                payload = json.loads(post_data.decode('utf-8'))
+
+            # Le riconsegne dello stesso update vengono scartate prima di qualsiasi I/O
+            if not is_duplicate_update(payload):
+                # Percorso veloce: le risposte precalcolate viaggiano nel corpo della
+                # risposta al webhook, senza caricare gli SDK
+                reply = static_reply(payload)
+                if reply is not None:
+                    self._send_webhook_reply(reply)
+                    return
+
+                # In modalità ack-first l'update viene solo accodato e si risponde subito a Telegram
+                if not (ASYNC_UPDATES and enqueue_update(payload, bot_url)):
+                    # L'ultimo messaggio scritto dal bot viaggia nella risposta al webhook:
+                    # una chiamata alla Bot API in meno per update
+                    outbox = Outbox(get_bot)
+                    try:
+                        process_update(payload, bot_url, outbox)
+                    except Exception:
+                        outbox.flush()
+                        raise
+                    reply = outbox.webhook_reply()
+                    if reply is not None:
+                        self._send_webhook_reply(reply)
+                        return
 
         except Exception as e:
             # Logga l'errore di parsing o di inizializzazione
@@ -365,3 +549,12 @@ class handler(BaseHTTPRequestHandler):
         self.send_response(200)
         self.end_headers()
         return
+
+    def _send_webhook_reply(self, reply: dict):
+        """Risponde a Telegram con una chiamata alla Bot API nel corpo (eseguita da Telegram)."""
+        body = json.dumps(reply, ensure_ascii=False).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
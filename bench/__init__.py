@@ -0,0 +1 @@
+"""Benchmark e load test offline di TinyAgents (vedi `bench/run.py`)."""
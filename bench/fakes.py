@@ -0,0 +1,338 @@
+"""
+Servizi finti e locali per Telegram, Groq, Supabase e Stripe.
+
+Ogni servizio è un server HTTP reale su 127.0.0.1 che implementa solo gli
+endpoint usati dal bot. La latenza (fissa + jitter) e la percentuale di errori
+sono configurabili; ogni servizio conta le richieste ricevute, così il
+benchmark può misurare le chiamate esterne per update.
+"""
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlparse
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    # Il backlog predefinito (5) fa rifiutare connessioni con centinaia di client in parallelo
+    request_queue_size = 1024
+
+
+class FakeService:
+    """Server HTTP finto con latenza e iniezione di errori configurabili."""
+
+    name = "fake"
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, error_rate: float = 0.0, seed: int | None = None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.requests = 0
+        self.errors = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = None
+
+    # --- Ciclo di vita ---
+
+    def start(self):
+        service = self
+
+        class _Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                service._dispatch(self, "GET")
+
+            def do_POST(self):
+                service._dispatch(self, "POST")
+
+            def do_PATCH(self):
+                service._dispatch(self, "PATCH")
+
+            def log_message(self, *args):
+                pass
+
+        self._server = _Server(("127.0.0.1", 0), _Handler)
+        threading.Thread(target=self._server.serve_forever, name=f"fake-{self.name}", daemon=True).start()
+        return self
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address
+        return f"http://{host}:{port}"
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {"requests": self.requests, "errors": self.errors}
+
+    # --- Gestione delle richieste ---
+
+    def _dispatch(self, request, method):
+        length = int(request.headers.get("Content-Length") or 0)
+        raw = request.rfile.read(length) if length else b""
+        with self._lock:
+            self.requests += 1
+            fail = self._random.random() < self.error_rate
+            delay = self.latency + self._random.uniform(0, self.jitter)
+        if delay:
+            time.sleep(delay)
+        if fail:
+            with self._lock:
+                self.errors += 1
+            self._send_json(request, 500, {"error": "errore iniettato dal benchmark"})
+            return
+        url = urlparse(request.path)
+        try:
+            status, body, content_type = self.handle(method, url.path, dict(parse_qsl(url.query)), raw, request.headers)
+        except Exception as e:
+            status, body, content_type = 500, {"error": str(e)}, None
+        self._send_json(request, status, body, content_type)
+
+    @staticmethod
+    def _send_json(request, status, body, content_type=None):
+        data = body if isinstance(body, bytes) else json.dumps(body).encode("utf-8")
+        request.send_response(status)
+        request.send_header("Content-Type", content_type or "application/json")
+        request.send_header("Content-Length", str(len(data)))
+        request.end_headers()
+        request.wfile.write(data)
+
+    def handle(self, method, path, query, raw, headers):
+        raise NotImplementedError
+
+
+class FakeTelegram(FakeService):
+    """Bot API: sendMessage, editMessageText, getMe e getUpdates (long polling)."""
+
+    name = "telegram"
+
+    def __init__(self, flood_rate: float = 0.0, retry_after: int = 1, **kwargs):
+        super().__init__(**kwargs)
+        # Percentuale di sendMessage respinti con 429 (flood control di Telegram)
+        self.flood_rate = flood_rate
+        self.retry_after = retry_after
+        self.floods = 0
+        self._message_ids = iter(range(1, 2 ** 31))
+        self._updates = []
+        self._updates_ready = threading.Condition()
+
+    def push_updates(self, updates):
+        """Accoda update da consegnare con getUpdates."""
+        with self._updates_ready:
+            self._updates.extend(updates)
+            self._updates_ready.notify_all()
+
+    def _get_updates(self, params):
+        offset = int(params.get("offset") or 0)
+        limit = int(params.get("limit") or 100)
+        deadline = time.monotonic() + float(params.get("timeout") or 0)
+        with self._updates_ready:
+            # Come Telegram: l'offset conferma (e scarta) gli update precedenti
+            self._updates = [u for u in self._updates if u["update_id"] >= offset]
+            while not self._updates and time.monotonic() < deadline:
+                self._updates_ready.wait(deadline - time.monotonic())
+            return self._updates[:limit]
+
+    def handle(self, method, path, query, raw, headers):
+        api_method = path.rsplit("/", 1)[-1]
+        params = _parse_body(raw, headers)
+        if api_method == "getUpdates":
+            return 200, {"ok": True, "result": self._get_updates(params)}, None
+        if api_method == "getMe":
+            return 200, {"ok": True, "result": {"id": 1, "is_bot": True, "first_name": "TinyAgents", "username": "TinyAgents_bot"}}, None
+        if api_method == "sendMessage" and self.flood_rate:
+            with self._lock:
+                flood = self._random.random() < self.flood_rate
+                self.floods += flood
+            if flood:
+                return 429, {
+                    "ok": False, "error_code": 429,
+                    "description": f"Too Many Requests: retry after {self.retry_after}",
+                    "parameters": {"retry_after": self.retry_after},
+                }, None
+        if api_method in ("sendMessage", "editMessageText"):
+            with self._lock:
+                message_id = int(params.get("message_id") or next(self._message_ids))
+            chat_id = int(params.get("chat_id", 0))
+            result = {
+                "message_id": message_id,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "text": params.get("text", ""),
+            }
+            return 200, {"ok": True, "result": result}, None
+        return 200, {"ok": True, "result": True}, None
+
+
+class FakeGroq(FakeService):
+    """Chat completions compatibili con OpenAI (anche in streaming SSE)."""
+
+    name = "groq"
+    reply = "Questa è una risposta generata dal servizio Groq finto del benchmark."
+
+    def handle(self, method, path, query, raw, headers):
+        request = json.loads(raw or b"{}")
+        model = request.get("model", "fake-model")
+        usage = {"prompt_tokens": 40, "completion_tokens": 16, "total_tokens": 56}
+        if request.get("stream"):
+            events = []
+            for word in self.reply.split(" "):
+                chunk = {"id": "chatcmpl-fake", "object": "chat.completion.chunk", "created": 0, "model": model,
+                         "choices": [{"index": 0, "delta": {"content": word + " "}, "finish_reason": None}]}
+                events.append(f"data: {json.dumps(chunk)}\n\n")
+            final = {"id": "chatcmpl-fake", "object": "chat.completion.chunk", "created": 0, "model": model,
+                     "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}], "x_groq": {"usage": usage}}
+            events.append(f"data: {json.dumps(final)}\n\ndata: [DONE]\n\n")
+            return 200, "".join(events).encode("utf-8"), "text/event-stream"
+        return 200, {
+            "id": "chatcmpl-fake",
+            "object": "chat.completion",
+            "created": 0,
+            "model": model,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": self.reply}, "finish_reason": "stop"}],
+            "usage": usage,
+        }, None
+
+
+class FakeSupabase(FakeService):
+    """PostgREST: tabella `users` e funzioni RPC di `sql/credits.sql`, `sql/admission.sql`, `sql/leases.sql` e `sql/dedup.sql`."""
+
+    name = "supabase"
+
+    def __init__(self, initial_credits: int = 1_000_000, **kwargs):
+        super().__init__(**kwargs)
+        self.initial_credits = initial_credits
+        self.users = {}
+        self.stripe_events = {}
+        self.rate_buckets = {}
+        self.seen_updates = {}
+        self.credit_leases = {}
+        self._lease_ids = iter(range(1, 2 ** 31))
+
+    def _reclaim_leases(self, user_id, reclaim_all):
+        now = time.monotonic()
+        reclaimed = 0
+        for lease_id, (owner, credits, expires_at) in list(self.credit_leases.items()):
+            if owner == int(user_id) and (reclaim_all or expires_at <= now):
+                del self.credit_leases[lease_id]
+                self.users[owner] = self._user(owner) + credits
+                reclaimed += credits
+        return reclaimed
+
+    def _user(self, user_id):
+        return self.users.setdefault(int(user_id), self.initial_credits)
+
+    def handle(self, method, path, query, raw, headers):
+        body = json.loads(raw or b"null")
+        if path.startswith("/rest/v1/rpc/"):
+            return 200, self._rpc(path.rsplit("/", 1)[-1], body or {}), None
+        if path == "/rest/v1/stripe_events" and method == "GET":
+            user_id = int(query.get("user_id", "eq.0").split(".", 1)[1])
+            with self._lock:
+                rows = [{"id": event_id} for event_id, owner in self.stripe_events.items() if owner == user_id]
+            return 200, rows[:1], None
+        if path == "/rest/v1/users":
+            with self._lock:
+                if method == "GET":
+                    operator, _, value = query.get("id", "eq.0").partition(".")
+                    if operator == "in":
+                        user_ids = [int(item) for item in value.strip("()").split(",") if item]
+                        return 200, [{"id": uid, "credits": self.users[uid]} for uid in user_ids if uid in self.users], None
+                    user_id = int(value)
+                    return 200, [{"id": user_id, "credits": self._user(user_id)}], None
+                if method == "POST":
+                    rows = body if isinstance(body, list) else [body]
+                    for row in rows:
+                        self.users.setdefault(int(row["id"]), row.get("credits", 0))
+                    return 201, rows, None
+                if method == "PATCH":
+                    user_id = int(query.get("id", "eq.0").split(".", 1)[1])
+                    self.users[user_id] = body["credits"]
+                    return 200, [{"id": user_id, "credits": body["credits"]}], None
+        return 404, {"message": f"{method} {path} non implementato"}, None
+
+    def _rpc(self, function, params):
+        with self._lock:
+            user_id = params.get("p_user_id")
+            amount = params.get("p_amount", 1)
+            if function == "reserve_credits":
+                balance = self._user(user_id)
+                if balance < amount:
+                    return -1
+                self.users[int(user_id)] = balance - amount
+                return balance - amount
+            if function in ("refund_credits", "add_credits"):
+                self.users[int(user_id)] = self._user(user_id) + amount
+                return self.users[int(user_id)]
+            if function == "apply_stripe_event":
+                if params["p_event_id"] in self.stripe_events:
+                    return -1
+                self.stripe_events[params["p_event_id"]] = int(user_id)
+                self.users[int(user_id)] = self._user(user_id) + amount
+                return self.users[int(user_id)]
+            if function == "take_rate_tokens":
+                now = time.monotonic()
+                tokens, updated_at = self.rate_buckets.get(params["p_key"], (params["p_capacity"], now))
+                tokens = min(params["p_capacity"], tokens + (now - updated_at) * params["p_rate"])
+                cost, floor = params.get("p_cost", 1), params.get("p_floor", 0)
+                wait = 0 if tokens - cost >= floor else (floor + cost - tokens) / params["p_rate"]
+                self.rate_buckets[params["p_key"]] = (tokens - cost if not wait else tokens, now)
+                return wait
+            if function == "mark_update_seen":
+                now = time.monotonic()
+                seen_at = self.seen_updates.get(params["p_update_id"])
+                if seen_at is not None and seen_at > now - params.get("p_window_seconds", 3600):
+                    return True
+                self.seen_updates[params["p_update_id"]] = now
+                return False
+            if function == "reclaim_credit_leases":
+                return self._reclaim_leases(user_id, params.get("p_all", False))
+            if function == "lease_credits":
+                self._reclaim_leases(user_id, False)
+                balance = self._user(user_id)
+                if balance < params["p_min"]:
+                    return [{"lease_id": None, "leased": 0, "balance": balance}]
+                leased = min(balance, params["p_max"])
+                lease_id = next(self._lease_ids)
+                self.credit_leases[lease_id] = (int(user_id), leased, time.monotonic() + params["p_ttl_seconds"])
+                self.users[int(user_id)] = balance - leased
+                return [{"lease_id": lease_id, "leased": leased, "balance": balance - leased}]
+            if function == "return_credit_lease":
+                lease = self.credit_leases.pop(params["p_lease_id"], None)
+                used = params["p_used"]
+                if lease is not None:
+                    self.users[int(user_id)] = self._user(user_id) + max(lease[1] - used, 0)
+                else:
+                    self.users[int(user_id)] = self._user(user_id) - used
+                return self.users[int(user_id)]
+        raise ValueError(f"Funzione RPC sconosciuta: {function}")
+
+
+class FakeStripe(FakeService):
+    """API Stripe: creazione delle sessioni di checkout."""
+
+    name = "stripe"
+
+    def handle(self, method, path, query, raw, headers):
+        if path == "/v1/checkout/sessions":
+            with self._lock:
+                session_id = f"cs_test_{self.requests}"
+            return 200, {"id": session_id, "object": "checkout.session", "url": f"https://checkout.stripe.com/c/pay/{session_id}"}, None
+        return 404, {"error": {"message": f"{method} {path} non implementato"}}, None
+
+
+def _parse_body(raw, headers):
+    """Decodifica un corpo JSON o form-urlencoded."""
+    if not raw:
+        return {}
+    if "json" in (headers.get("Content-Type") or ""):
+        return json.loads(raw)
+    return dict(parse_qsl(raw.decode("utf-8")))
@@ -0,0 +1,98 @@
+"""
+Benchmark del runner in long polling (`tinyagents/polling.py`).
+
+Accoda sul finto Telegram di `bench/fakes.py` una raffica di comandi agli
+agenti, avvia il runner e misura in quanto tempo un solo processo li elabora:
+update al secondo, durata p50/p95/p99 di ogni update e chiamate esterne per
+update. Alla fine il runner viene arrestato come con SIGTERM.
+
+Uso (dalla root del repository):
+
+    python -m bench.polling --updates 1000 --concurrency 200
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import threading
+import time
+
+from bench.fakes import FakeGroq, FakeStripe, FakeSupabase, FakeTelegram
+from bench.run import configure_environment, percentile, telegram_update
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark del runner in long polling di TinyAgents.")
+    parser.add_argument("--updates", type=int, default=500, help="comandi agli agenti da elaborare")
+    parser.add_argument("--concurrency", type=int, default=200, help="worker del runner")
+    parser.add_argument("--users", type=int, default=200, help="numero di utenti distinti")
+    parser.add_argument("--telegram-latency", type=float, default=0.03, help="latenza del finto Telegram (s)")
+    parser.add_argument("--groq-latency", type=float, default=0.3, help="latenza del finto Groq (s)")
+    parser.add_argument("--supabase-latency", type=float, default=0.02, help="latenza del finto Supabase (s)")
+    parser.add_argument("--timeout", type=float, default=120.0, help="tempo massimo di attesa (s)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    fakes = {
+        "telegram": FakeTelegram(latency=args.telegram_latency).start(),
+        "groq": FakeGroq(latency=args.groq_latency).start(),
+        "supabase": FakeSupabase(latency=args.supabase_latency).start(),
+        "stripe": FakeStripe().start(),
+    }
+    configure_environment(fakes)
+    from tinyagents.polling import OffsetStore, PollingRunner, configure_pools, load_bot_module
+    configure_pools(args.concurrency)
+    bot = load_bot_module()
+
+    durations = []
+    lock = threading.Lock()
+
+    def timed_update(update):
+        started = time.perf_counter()
+        try:
+            bot.process_update(update)
+        finally:
+            with lock:
+                durations.append(time.perf_counter() - started)
+
+    offset_path = os.path.join(tempfile.mkdtemp(prefix="tinyagents-poll-"), "offset.json")
+    runner = PollingRunner(timed_update, concurrency=args.concurrency, poll_timeout=1,
+                           offset_store=OffsetStore(offset_path), is_duplicate=bot.is_duplicate_update)
+    fakes["telegram"].push_updates(
+        telegram_update(i, 1 + i % args.users, f"/meme_persona gatto che suona il pianoforte numero {i}")
+        for i in range(1, args.updates + 1)
+    )
+    before = {name: fake.snapshot()["requests"] for name, fake in fakes.items()}
+
+    async def run():
+        started = time.perf_counter()
+        task = asyncio.create_task(runner.run())
+        deadline = started + args.timeout
+        while runner.processed < args.updates and time.perf_counter() < deadline and not task.done():
+            await asyncio.sleep(0.05)
+        elapsed = time.perf_counter() - started
+        runner.stop()
+        await task
+        return elapsed
+
+    elapsed = asyncio.run(run())
+    count = runner.processed
+    calls = {name: round((fake.snapshot()["requests"] - before[name]) / max(count, 1), 3) for name, fake in fakes.items()}
+    for fake in fakes.values():
+        fake.stop()
+
+    if not durations:
+        print("Nessun update elaborato.")
+        return 1
+    print(f"{count}/{args.updates} update in {elapsed:.2f} s ({count / elapsed:.1f} update/s) con {args.concurrency} worker")
+    print(f"durata per update: p50 {percentile(durations, 50) * 1000:.1f} ms  "
+          f"p95 {percentile(durations, 95) * 1000:.1f} ms  p99 {percentile(durations, 99) * 1000:.1f} ms")
+    print(f"chiamate esterne per update: {calls}")
+    return 0 if count == args.updates else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
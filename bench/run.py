@@ -0,0 +1,323 @@
+"""
+Benchmark offline dei webhook di TinyAgents.
+
+Avvia i servizi finti di `bench/fakes.py`, punta il bot verso di essi tramite
+le variabili d'ambiente e serve `api/telegram.py` e `api/stripe_webhook.py` su
+server HTTP locali. Per ogni percorso (`/start`, `/credits`, `/buy`, comando di
+un agente e webhook Stripe) invia richieste sintetiche e misura:
+
+- latenza p50/p95/p99 e richieste al secondo;
+- chiamate esterne per update, per servizio (Telegram, Groq, Supabase, Stripe).
+
+Uso (dalla root del repository):
+
+    python -m bench.run --requests 200 --concurrency 8 --output bench/baseline.json
+    python -m bench.run --baseline bench/baseline.json  # fallisce se ci sono regressioni rispetto alla baseline
+    CREDITS_BACKEND=sqlite python -m bench.run          # crediti su SQLite invece che sul finto Supabase
+    python -m bench.run --paths agent,multi             # /multi con tre agenti contro un agente singolo
+
+I risultati sono salvati in JSON, così due esecuzioni si possono confrontare
+prima di un deploy.
+"""
+import argparse
+import hashlib
+import hmac
+import http.client
+import importlib.util
+import itertools
+import json
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer
+from threading import Thread
+
+from bench.fakes import FakeGroq, FakeStripe, FakeSupabase, FakeTelegram
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+TELEGRAM_PATHS = {
+    "/start": lambda i: "/start",
+    "/credits": lambda i: "/credits",
+    "/buy": lambda i: "/buy",
+    "agent": lambda i: f"/meme_persona gatto che suona il pianoforte numero {i}",
+    # Tre agenti in parallelo: la latenza va confrontata con quella di "agent"
+    "multi": lambda i: f"/multi meme_persona,tweet_generator,seo_optimizer gatto che suona il pianoforte numero {i}",
+}
+WEBHOOK_SECRET = "whsec_benchmark"
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark offline dei webhook di TinyAgents.")
+    parser.add_argument("--requests", type=int, default=100, help="richieste per percorso")
+    parser.add_argument("--concurrency", type=int, default=8, help="richieste in parallelo")
+    parser.add_argument("--users", type=int, default=50, help="numero di utenti distinti")
+    parser.add_argument("--paths", default="/start,/credits,/buy,agent,stripe", help="percorsi da misurare, separati da virgola")
+    parser.add_argument("--telegram-latency", type=float, default=0.03, help="latenza del finto Telegram (s)")
+    parser.add_argument("--telegram-flood-rate", type=float, default=0.0, help="percentuale di sendMessage respinti con 429 dal finto Telegram (0-1)")
+    parser.add_argument("--groq-latency", type=float, default=0.3, help="latenza del finto Groq (s)")
+    parser.add_argument("--supabase-latency", type=float, default=0.02, help="latenza del finto Supabase (s)")
+    parser.add_argument("--stripe-latency", type=float, default=0.1, help="latenza del finto Stripe (s)")
+    parser.add_argument("--jitter", type=float, default=0.0, help="jitter casuale aggiunto a ogni latenza (s)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="percentuale di risposte 500 dei servizi finti (0-1)")
+    parser.add_argument("--stripe-retries", type=int, default=1, help="riconsegne aggiuntive di ogni evento Stripe")
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--output", default=os.path.join(ROOT, "bench", "results.json"))
+    parser.add_argument("--baseline", help="file JSON di un'esecuzione precedente da confrontare")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="peggioramento massimo ammesso di p95 rispetto alla baseline")
+    return parser.parse_args(argv)
+
+
+# --- AVVIO DELL'AMBIENTE ---
+
+def start_fakes(args):
+    common = dict(jitter=args.jitter, error_rate=args.error_rate, seed=args.seed)
+    return {
+        "telegram": FakeTelegram(latency=args.telegram_latency, flood_rate=args.telegram_flood_rate, **common).start(),
+        "groq": FakeGroq(latency=args.groq_latency, **common).start(),
+        "supabase": FakeSupabase(latency=args.supabase_latency, **common).start(),
+        "stripe": FakeStripe(latency=args.stripe_latency, **common).start(),
+    }
+
+
+def configure_environment(fakes):
+    """Punta il bot verso i servizi finti. Va chiamata prima di importare i moduli del bot."""
+    os.environ.update({
+        "TELEGRAM_TOKEN": "123456:benchmark",
+        "TELEGRAM_API_URL": fakes["telegram"].url,
+        "GROQ_API_KEY": "gsk_benchmark",
+        "GROQ_BASE_URL": fakes["groq"].url,
+        "SUPABASE_URL": fakes["supabase"].url,
+        "SUPABASE_KEY": "bench.mark.key",
+        "STRIPE_SECRET_KEY": "sk_test_benchmark",
+        "STRIPE_API_BASE": fakes["stripe"].url,
+        "STRIPE_PRODUCT_ID": "price_benchmark",
+        "STRIPE_WEBHOOK_SECRET": WEBHOOK_SECRET,
+    })
+    # I log strutturati per span falserebbero le misure
+    os.environ.setdefault("METRICS_LOG", "false")
+    # Il benchmark invia raffiche volutamente oltre i limiti di frequenza
+    os.environ.setdefault("RATE_LIMIT_BACKEND", "off")
+    # Il finto Telegram non applica limiti per chat: i 429 si simulano con --telegram-flood-rate
+    os.environ.setdefault("TELEGRAM_FLOOD_CONTROL", "false")
+    if os.environ.get("CREDITS_BACKEND") == "sqlite":
+        os.environ.setdefault("CREDITS_PATH", os.path.join(tempfile.mkdtemp(prefix="tinyagents-bench-"), "credits.sqlite3"))
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+
+
+def seed_credits(users, amount=1_000_000):
+    """Accredita gli utenti del benchmark quando i crediti sono su SQLite (il finto Supabase li crea già pieni)."""
+    from tinyagents.credits import credit_store
+    if credit_store.stage == "sqlite":
+        for user_id in range(1, users + 1):
+            credit_store.add(user_id, amount)
+
+
+def load_handler(relative_path):
+    name = "bench_" + os.path.splitext(os.path.basename(relative_path))[0]
+    spec = importlib.util.spec_from_file_location(name, os.path.join(ROOT, relative_path))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def serve(handler_class):
+    # Gli access log di http.server falserebbero le misure
+    quiet_handler = type(handler_class.__name__, (handler_class,), {"log_message": lambda self, *args: None})
+    server = ThreadingHTTPServer(("127.0.0.1", 0), quiet_handler)
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# --- GENERAZIONE DEL CARICO ---
+
+def telegram_update(update_id, user_id, text):
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "Bench"},
+            "text": text,
+        },
+    }
+
+
+def stripe_request(event_id, user_id):
+    payload = json.dumps({
+        "id": event_id,
+        "object": "event",
+        "type": "checkout.session.completed",
+        "data": {"object": {"object": "checkout.session", "client_reference_id": str(user_id)}},
+    }).encode("utf-8")
+    timestamp = int(time.time())
+    signature = hmac.new(WEBHOOK_SECRET.encode(), f"{timestamp}.".encode() + payload, hashlib.sha256).hexdigest()
+    return payload, {"Stripe-Signature": f"t={timestamp},v1={signature}"}
+
+
+def post(server, path, body, headers=None):
+    """Esegue una POST e restituisce (status, latenza in secondi)."""
+    host, port = server.server_address
+    connection = http.client.HTTPConnection(host, port, timeout=60)
+    started = time.perf_counter()
+    try:
+        connection.request("POST", path, body=body, headers={"Content-Type": "application/json", **(headers or {})})
+        response = connection.getresponse()
+        response.read()
+        return response.status, time.perf_counter() - started
+    finally:
+        connection.close()
+
+
+def wait_until_idle(telegram_module, timeout=120.0, poll_interval=0.02):
+    """
+    In modalità ack-first attende che la coda dei job sia vuota e che i worker abbiano
+    completato i job in corso, così le chiamate esterne restano nella fase giusta.
+    """
+    deadline = time.monotonic() + timeout
+    # La coda esiste solo se almeno un update è stato accodato
+    while telegram_module._job_queue is not None and telegram_module._job_queue.unfinished():
+        if time.monotonic() >= deadline:
+            raise SystemExit(f"Job ancora in corso dopo {timeout:.0f}s: la fase non può essere misurata")
+        time.sleep(poll_interval)
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def hedging_snapshot():
+    """Contatori dell'hedging delle chiamate a Groq (vedi tinyagents/hedging.py)."""
+    from tinyagents import metrics
+    snapshot = {f"winner_{k}": v for k, v in metrics.counter_totals("tinyagents_llm_hedges_total", by="winner").items()}
+    snapshot["wasted_tokens"] = metrics.counter_totals("tinyagents_llm_hedge_wasted_tokens_total").get(None, 0)
+    return snapshot
+
+
+def run_phase(fakes, telegram_module, requests, concurrency):
+    """Esegue le richieste `requests` (callable senza argomenti) e ne raccoglie le metriche."""
+    before = {name: fake.snapshot() for name, fake in fakes.items()}
+    hedging_before = hedging_snapshot()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(lambda send: send(), requests))
+    elapsed = time.perf_counter() - started
+    wait_until_idle(telegram_module)
+
+    latencies = [latency for _, latency in results]
+    count = len(results)
+    calls = {}
+    for name, fake in fakes.items():
+        after = fake.snapshot()
+        calls[name] = round((after["requests"] - before[name]["requests"]) / count, 3)
+    calls["total"] = round(sum(calls.values()), 3)
+    hedging_after = hedging_snapshot()
+    hedging = {k: v - hedging_before.get(k, 0) for k, v in hedging_after.items() if v - hedging_before.get(k, 0)}
+    return {
+        "requests": count,
+        "errors": sum(1 for status, _ in results if status != 200),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+        "rps": round(count / elapsed, 2),
+        "external_calls_per_update": calls,
+        "hedging": hedging,
+    }
+
+
+# --- CONFRONTO CON LA BASELINE ---
+
+def compare(results, baseline, tolerance):
+    """Restituisce l'elenco delle regressioni rispetto a una baseline."""
+    regressions = []
+    for path, current in results["paths"].items():
+        previous = baseline.get("paths", {}).get(path)
+        if not previous:
+            continue
+        for service, calls in current["external_calls_per_update"].items():
+            old = previous["external_calls_per_update"].get(service)
+            if old is not None and calls > old:
+                regressions.append(f"{path}: chiamate {service} per update {old} -> {calls}")
+        if current["p95_ms"] > previous["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{path}: p95 {previous['p95_ms']} ms -> {current['p95_ms']} ms")
+    return regressions
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    # La baseline si legge prima di scrivere i risultati: può essere lo stesso file di --output
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+    fakes = start_fakes(args)
+    configure_environment(fakes)
+
+    telegram_module = load_handler(os.path.join("api", "telegram.py"))
+    stripe_module = load_handler(os.path.join("api", "stripe_webhook.py"))
+    seed_credits(args.users)
+    telegram_server = serve(telegram_module.handler)
+    stripe_server = serve(stripe_module.handler)
+
+    update_ids = itertools.count(1)
+    event_ids = itertools.count(1)
+    selected = [path.strip() for path in args.paths.split(",") if path.strip()]
+    results = {
+        "config": {k: v for k, v in vars(args).items() if k not in ("output", "baseline")},
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "paths": {},
+    }
+
+    for path in selected:
+        if path == "stripe":
+            requests = []
+            for i in range(args.requests // (1 + args.stripe_retries) or 1):
+                body, headers = stripe_request(f"evt_bench_{next(event_ids)}", 1 + i % args.users)
+                for _ in range(1 + args.stripe_retries):
+                    requests.append(lambda body=body, headers=headers: post(stripe_server, "/api/stripe-webhook", body, headers))
+        elif path in TELEGRAM_PATHS:
+            requests = []
+            for i in range(args.requests):
+                update = telegram_update(next(update_ids), 1 + i % args.users, TELEGRAM_PATHS[path](i))
+                body = json.dumps(update).encode("utf-8")
+                requests.append(lambda body=body: post(telegram_server, "/api/telegram", body))
+        else:
+            raise SystemExit(f"Percorso sconosciuto: {path}")
+
+        results["paths"][path] = run_phase(fakes, telegram_module, requests, args.concurrency)
+        phase = results["paths"][path]
+        print(f"{path:10} p50 {phase['p50_ms']:>8} ms  p95 {phase['p95_ms']:>8} ms  p99 {phase['p99_ms']:>8} ms  "
+              f"{phase['rps']:>8} req/s  chiamate/update {phase['external_calls_per_update']['total']}  errori {phase['errors']}")
+        if phase["hedging"]:
+            print(f"{'':10} hedging {phase['hedging']}")
+
+    telegram_server.shutdown()
+    stripe_server.shutdown()
+    for fake in fakes.values():
+        fake.stop()
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2, ensure_ascii=False)
+    print(f"Risultati salvati in {args.output}")
+
+    if baseline is not None:
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSIONE: {regression}")
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
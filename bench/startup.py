@@ -0,0 +1,179 @@
+"""
+Benchmark del cold start dei webhook.
+
+Per ogni handler (`api/telegram.py`, `api/stripe_webhook.py`, `api/agents.py`,
+`api/credits.py`) avvia un interprete Python nuovo, come fa Vercel a ogni cold
+start, e misura:
+
+- il tempo totale di import dell'handler;
+- il tempo di import di ogni pacchetto di primo livello (da `python -X importtime`);
+- gli SDK pesanti (telegram, groq, supabase, stripe) caricati all'avvio, che
+  devono essere importati solo al primo utilizzo.
+
+Ogni misura è la mediana di `--runs` esecuzioni. Con `--baseline` il risultato
+viene confrontato con un'esecuzione precedente e il comando esce con codice 1
+se il tempo di import peggiora oltre la tolleranza o se un SDK torna a essere
+importato all'avvio; `--budget-ms` fissa invece un limite assoluto.
+
+Uso (dalla root del repository):
+
+    python -m bench.startup --output bench/startup-baseline.json
+    python -m bench.startup --baseline bench/startup-baseline.json --budget-ms 300
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+HANDLERS = ("api/telegram.py", "api/stripe_webhook.py", "api/agents.py", "api/credits.py")
+HEAVY_SDKS = ("telegram", "groq", "supabase", "stripe")
+
+# Variabili d'ambiente fittizie: il codice eseguito all'import non fa chiamate di rete
+ENVIRONMENT = {
+    "TELEGRAM_TOKEN": "123456:startup",
+    "GROQ_API_KEY": "gsk_startup",
+    "SUPABASE_URL": "http://127.0.0.1:9",
+    "SUPABASE_KEY": "startup.key",
+    "STRIPE_SECRET_KEY": "sk_test_startup",
+    "STRIPE_PRODUCT_ID": "price_startup",
+    "STRIPE_WEBHOOK_SECRET": "whsec_startup",
+    "METRICS_LOG": "false",
+}
+
+# Eseguito nel processo figlio: importa l'handler e stampa tempo e SDK caricati
+_PROBE = """
+import importlib.util, json, sys, time
+sys.path.insert(0, {root!r})
+started = time.perf_counter()
+spec = importlib.util.spec_from_file_location("startup_handler", {path!r})
+module = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(module)
+elapsed = time.perf_counter() - started
+sdks = sorted(name for name in {sdks!r} if name in sys.modules)
+print(json.dumps({{"import_ms": elapsed * 1000, "sdks": sdks}}))
+"""
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark del cold start dei webhook di TinyAgents.")
+    parser.add_argument("--runs", type=int, default=5, help="esecuzioni per handler (si usa la mediana)")
+    parser.add_argument("--top", type=int, default=10, help="pacchetti più lenti da mostrare")
+    parser.add_argument("--output", default=os.path.join(ROOT, "bench", "startup.json"))
+    parser.add_argument("--baseline", help="file JSON di un'esecuzione precedente da confrontare")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="peggioramento massimo ammesso rispetto alla baseline")
+    parser.add_argument("--budget-ms", type=float, help="tempo massimo di import per handler (ms)")
+    return parser.parse_args(argv)
+
+
+# --- MISURA ---
+
+def parse_importtime(stderr: str) -> dict:
+    """Tempo cumulativo (ms) dei moduli di primo livello dall'output di `-X importtime`."""
+    packages = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        # I moduli importati da altri moduli sono indentati: contano già nel padre
+        if name.startswith("  "):
+            continue
+        package = name.strip().split(".", 1)[0]
+        packages[package] = packages.get(package, 0.0) + int(cumulative) / 1000
+    return packages
+
+
+def measure(handler: str) -> dict:
+    """Importa l'handler in un interprete nuovo e restituisce le misure."""
+    code = _PROBE.format(root=ROOT, path=os.path.join(ROOT, handler), sdks=HEAVY_SDKS)
+    environment = {**os.environ, **ENVIRONMENT}
+    started = time.perf_counter()
+    completed = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        cwd=ROOT, env=environment, capture_output=True, text=True, check=False,
+    )
+    process_ms = (time.perf_counter() - started) * 1000
+    if completed.returncode != 0:
+        raise RuntimeError(f"Import di {handler} fallito:\n{completed.stderr[-2000:]}")
+    probe = json.loads(completed.stdout.strip().splitlines()[-1])
+    return {
+        "import_ms": probe["import_ms"],
+        "process_ms": process_ms,
+        "sdks": probe["sdks"],
+        "packages": parse_importtime(completed.stderr),
+    }
+
+
+def summarize(samples: list, top: int) -> dict:
+    """Mediana delle esecuzioni di uno stesso handler."""
+    packages = {}
+    for sample in samples:
+        for name, ms in sample["packages"].items():
+            packages.setdefault(name, []).append(ms)
+    medians = {name: round(statistics.median(values), 2) for name, values in packages.items()}
+    slowest = dict(sorted(medians.items(), key=lambda item: item[1], reverse=True)[:top])
+    return {
+        "import_ms": round(statistics.median(s["import_ms"] for s in samples), 2),
+        "process_ms": round(statistics.median(s["process_ms"] for s in samples), 2),
+        "sdks_at_import": samples[-1]["sdks"],
+        "packages_ms": slowest,
+    }
+
+
+# --- CONFRONTO CON LA BASELINE ---
+
+def compare(results, baseline, tolerance, budget_ms=None):
+    """Restituisce l'elenco delle regressioni rispetto a una baseline e al budget."""
+    regressions = []
+    for handler, current in results["handlers"].items():
+        if budget_ms is not None and current["import_ms"] > budget_ms:
+            regressions.append(f"{handler}: import {current['import_ms']} ms oltre il budget di {budget_ms} ms")
+        previous = (baseline or {}).get("handlers", {}).get(handler)
+        if not previous:
+            continue
+        if current["import_ms"] > previous["import_ms"] * (1 + tolerance):
+            regressions.append(f"{handler}: import {previous['import_ms']} ms -> {current['import_ms']} ms")
+        added = sorted(set(current["sdks_at_import"]) - set(previous["sdks_at_import"]))
+        if added:
+            regressions.append(f"{handler}: SDK importati all'avvio: {', '.join(added)}")
+    return regressions
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    # La baseline si legge prima di scrivere i risultati: può essere lo stesso file di --output
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+    results = {
+        "config": {"runs": args.runs, "python": sys.version.split()[0]},
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "handlers": {},
+    }
+
+    for handler in HANDLERS:
+        summary = summarize([measure(handler) for _ in range(args.runs)], args.top)
+        results["handlers"][handler] = summary
+        sdks = ", ".join(summary["sdks_at_import"]) or "nessuno"
+        print(f"{handler:22} import {summary['import_ms']:>8} ms  processo {summary['process_ms']:>8} ms  SDK all'avvio: {sdks}")
+        for package, ms in summary["packages_ms"].items():
+            print(f"    {package:30} {ms:>8} ms")
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2, ensure_ascii=False)
+    print(f"Risultati salvati in {args.output}")
+
+    regressions = compare(results, baseline, args.tolerance, args.budget_ms)
+    for regression in regressions:
+        print(f"REGRESSIONE: {regression}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
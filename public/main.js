@@ -2,48 +2,8 @@
 const tg = window.Telegram.WebApp;
 
 // Configurazione iniziale
-const AGENTS = {
-    "meme_persona": {
-        "description": "Trasforma una tua idea in una caption per un meme virale.",
-        "emoji": "😂"
-    },
-    "viral_pitch": {
-        "description": "Scrivi un pitch freddo e conciso per LinkedIn.",
-        "emoji": "💼"
-    },
-    "roast_generator": {
-        "description": "Fornisci un argomento e io lo 'roasterò' simpaticamente.",
-        "emoji": "🔥"
-    },
-    "email_writer": {
-        "description": "Scrivi email professionali e persuasive.",
-        "emoji": "📧"
-    },
-    "tweet_generator": {
-        "description": "Crea tweet virali e accattivanti.",
-        "emoji": "🐦"
-    },
-    "product_description": {
-        "description": "Scrivi descrizioni di prodotti per e-commerce.",
-        "emoji": "🛍️"
-    },
-    "story_starter": {
-        "description": "Genera l'inizio di una storia affascinante.",
-        "emoji": "📖"
-    },
-    "code_explainer": {
-        "description": "Spiega concetti di programmazione in modo semplice.",
-        "emoji": "💻"
-    },
-    "motivational_quote": {
-        "description": "Genera citazioni motivazionali personalizzate.",
-        "emoji": "⭐"
-    },
-    "seo_optimizer": {
-        "description": "Ottimizza il testo per i motori di ricerca.",
-        "emoji": "🔍"
-    }
-};
+// Gli agenti arrivano dallo stesso registro usato dal bot (agents.json, via /api/agents)
+let AGENTS = {};
 
 let currentAgent = null;
 let chatHistory = [];
@@ -59,27 +19,54 @@ document.addEventListener('DOMContentLoaded', () => {
     // Carica i crediti
     loadCredits();
     
-    // Renderizza gli agenti
-    renderAgents();
+    // Carica e renderizza gli agenti
+    loadAgents();
 });
 
+// Funzione per caricare gli agenti dal registro
+async function loadAgents() {
+    try {
+        const response = await fetch('/api/agents');
+        if (!response.ok) {
+            throw new Error(`HTTP ${response.status}`);
+        }
+        AGENTS = (await response.json()).agents;
+    } catch (error) {
+        console.error('Errore nel caricamento degli agenti:', error);
+    }
+    renderAgents();
+}
+
 // Funzione per caricare i crediti
+// /api/credits risponde con ETag e Cache-Control brevi: le richieste ripetute
+// vengono servite dalla cache del browser o con un 304 senza corpo.
 async function loadCredits() {
     try {
-        const userId = tg.initDataUnsafe?.user?.id;
-        if (!userId) {
+        if (!tg.initData) {
             document.getElementById('creditsAmount').textContent = '0';
             return;
         }
         
-        // Simula il caricamento dei crediti (in produzione, chiamerebbe l'API)
-        document.getElementById('creditsAmount').textContent = '0';
+        const response = await fetch('/api/credits', {
+            headers: { 'Authorization': `tma ${tg.initData}` }
+        });
+        if (!response.ok) {
+            throw new Error(`HTTP ${response.status}`);
+        }
+        const data = await response.json();
+        document.getElementById('creditsAmount').textContent = String(data.credits);
     } catch (error) {
         console.error('Errore nel caricamento dei crediti:', error);
-        document.getElementById('creditsAmount').textContent = '0';
     }
 }
 
+// Aggiorna i crediti quando la Mini App torna in primo piano (es. dopo un acquisto)
+document.addEventListener('visibilitychange', () => {
+    if (document.visibilityState === 'visible') {
+        loadCredits();
+    }
+});
+
 // Funzione per renderizzare gli agenti
 function renderAgents() {
     const grid = document.getElementById('agentsGrid');
@@ -119,6 +106,8 @@ function backToAgents() {
     document.getElementById('agentsView').style.display = 'block';
     document.getElementById('chatView').classList.remove('active');
     document.getElementById('chatMessages').innerHTML = '';
+    
+    loadCredits();
 }
 
 // Funzione per inviare un messaggio
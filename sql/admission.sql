@@ -0,0 +1,50 @@
+-- Token bucket condivisi per il controllo di ammissione (RATE_LIMIT_BACKEND=supabase).
+-- Eseguire questo script una volta nell'SQL Editor di Supabase, dopo credits.sql:
+-- la funzione viene chiamata via RPC da tinyagents/admission.py, così tutte le
+-- istanze del bot rispettano lo stesso budget globale di chiamate a Groq.
+
+create table if not exists rate_buckets (
+    key text primary key,
+    tokens double precision not null,
+    updated_at timestamptz not null default clock_timestamp()
+);
+
+-- Ricarica il bucket `p_key` (`p_rate` gettoni al secondo, al massimo
+-- `p_capacity`) e preleva `p_cost` gettoni se ne restano almeno `p_floor`.
+-- Restituisce 0 se la richiesta è ammessa, altrimenti i secondi da attendere.
+create or replace function take_rate_tokens(
+    p_key text,
+    p_rate double precision,
+    p_capacity double precision,
+    p_cost double precision default 1,
+    p_floor double precision default 0
+)
+returns double precision
+language plpgsql
+as $$
+declare
+    now_ts timestamptz := clock_timestamp();
+    available double precision;
+begin
+    insert into rate_buckets (key, tokens, updated_at) values (p_key, p_capacity, now_ts)
+    on conflict (key) do nothing;
+
+    select least(p_capacity, tokens + extract(epoch from (now_ts - updated_at)) * p_rate)
+      into available
+      from rate_buckets
+     where key = p_key
+       for update;
+
+    if available - p_cost >= p_floor then
+        update rate_buckets set tokens = available - p_cost, updated_at = now_ts where key = p_key;
+        return 0;
+    end if;
+
+    update rate_buckets set tokens = available, updated_at = now_ts where key = p_key;
+    return (p_floor + p_cost - available) / p_rate;
+end;
+$$;
+
+-- Gli utenti paganti sono quelli con almeno un evento in stripe_events
+-- (vedi is_paying_user in tinyagents/credits.py).
+create index if not exists stripe_events_user_id_idx on stripe_events (user_id);
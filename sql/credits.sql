@@ -0,0 +1,84 @@
+-- Funzioni Postgres per la gestione atomica dei crediti.
+-- Eseguire questo script una volta nell'SQL Editor di Supabase: le funzioni
+-- vengono chiamate via RPC da tinyagents/credits.py, così ogni operazione
+-- richiede un solo round trip e non soffre di lost update sotto carico.
+
+-- Riserva `p_amount` crediti: decrementa il saldo solo se è sufficiente.
+-- Restituisce il nuovo saldo, oppure -1 se i crediti non bastano (l'utente
+-- viene creato con 0 crediti se non esiste).
+create or replace function reserve_credits(p_user_id bigint, p_amount integer default 1)
+returns integer
+language plpgsql
+as $$
+declare
+    new_balance integer;
+begin
+    update users
+       set credits = credits - p_amount
+     where id = p_user_id
+       and credits >= p_amount
+    returning credits into new_balance;
+
+    if not found then
+        insert into users (id, credits) values (p_user_id, 0)
+        on conflict (id) do nothing;
+        return -1;
+    end if;
+
+    return new_balance;
+end;
+$$;
+
+-- Restituisce `p_amount` crediti riservati (es. se la chiamata all'LLM fallisce).
+create or replace function refund_credits(p_user_id bigint, p_amount integer default 1)
+returns integer
+language sql
+as $$
+    update users
+       set credits = credits + p_amount
+     where id = p_user_id
+    returning credits;
+$$;
+
+-- Aggiunge `p_amount` crediti (acquisto Stripe), creando l'utente se non esiste.
+create or replace function add_credits(p_user_id bigint, p_amount integer)
+returns integer
+language sql
+as $$
+    insert into users (id, credits) values (p_user_id, p_amount)
+    on conflict (id) do update set credits = users.credits + excluded.credits
+    returning credits;
+$$;
+
+-- Eventi Stripe già applicati: la chiave primaria sull'id dell'evento rende
+-- il controllo "già applicato" una lookup su indice.
+create table if not exists stripe_events (
+    id text primary key,
+    user_id bigint not null,
+    credits integer not null,
+    processed_at timestamptz not null default now()
+);
+
+-- Registra l'evento e accredita i crediti nella stessa transazione.
+-- Restituisce il nuovo saldo, oppure -1 se l'evento era già stato applicato.
+create or replace function apply_stripe_event(p_event_id text, p_user_id bigint, p_amount integer)
+returns integer
+language plpgsql
+as $$
+declare
+    new_balance integer;
+begin
+    insert into stripe_events (id, user_id, credits) values (p_event_id, p_user_id, p_amount)
+    on conflict (id) do nothing;
+
+    if not found then
+        return -1;
+    end if;
+
+    insert into users (id, credits) values (p_user_id, p_amount)
+    on conflict (id) do update set credits = users.credits + excluded.credits
+    returning credits into new_balance;
+
+    return new_balance;
+end;
+$$;
@@ -0,0 +1,37 @@
+-- Deduplicazione degli update di Telegram tra le istanze (UPDATE_DEDUP_BACKEND=supabase).
+-- Eseguire questo script una volta nell'SQL Editor di Supabase: la funzione viene
+-- chiamata via RPC da tinyagents/dedup.py, così una riconsegna arrivata a
+-- un'istanza diversa da quella che ha ricevuto l'update viene comunque scartata.
+
+create table if not exists seen_updates (
+    update_id bigint primary key,
+    seen_at timestamptz not null default clock_timestamp()
+);
+
+create index if not exists seen_updates_seen_at_idx on seen_updates (seen_at);
+
+-- Registra `p_update_id` e restituisce true se era già stato visto negli ultimi
+-- `p_window_seconds` secondi. Gli id fuori dalla finestra vengono rimossi di tanto in tanto.
+create or replace function mark_update_seen(
+    p_update_id bigint,
+    p_window_seconds integer default 3600
+)
+returns boolean
+language plpgsql
+as $$
+declare
+    now_ts timestamptz := clock_timestamp();
+    inserted integer;
+begin
+    insert into seen_updates (update_id, seen_at) values (p_update_id, now_ts)
+    on conflict (update_id) do update set seen_at = excluded.seen_at
+        where seen_updates.seen_at <= now_ts - make_interval(secs => p_window_seconds);
+    get diagnostics inserted = row_count;
+
+    if inserted > 0 and random() < 0.001 then
+        delete from seen_updates where seen_at <= now_ts - make_interval(secs => p_window_seconds);
+    end if;
+
+    return inserted = 0;
+end;
+$$;
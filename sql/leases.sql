@@ -0,0 +1,105 @@
+-- Lease dei crediti (opzionale, CREDIT_LEASES=true).
+-- Un'istanza preleva dal saldo un blocco di crediti dell'utente e lo consuma in
+-- memoria; alla scadenza, alla chiusura dell'istanza o dopo una ricarica il
+-- blocco viene chiuso con return_credit_lease, che restituisce i crediti non
+-- usati. I lease attivi delle altre istanze non vanno recuperati: quelle
+-- istanze continuano a spenderne la copia locale. Eseguire dopo sql/credits.sql.
+
+create table if not exists credit_leases (
+    id bigint generated always as identity primary key,
+    user_id bigint not null,
+    credits integer not null,
+    expires_at timestamptz not null
+);
+
+create index if not exists credit_leases_user_id on credit_leases (user_id);
+
+-- Chiude i lease dell'utente (solo quelli scaduti, o tutti con p_all) e
+-- restituisce al saldo i crediti che contenevano. Serve per le istanze
+-- terminate senza restituire il lease. Restituisce i crediti recuperati.
+create or replace function reclaim_credit_leases(p_user_id bigint, p_all boolean default false)
+returns integer
+language plpgsql
+as $$
+declare
+    reclaimed integer;
+begin
+    with removed as (
+        delete from credit_leases
+         where user_id = p_user_id
+           and (p_all or expires_at <= now())
+        returning credits
+    )
+    select coalesce(sum(credits), 0) into reclaimed from removed;
+
+    if reclaimed > 0 then
+        update users set credits = credits + reclaimed where id = p_user_id;
+    end if;
+
+    return reclaimed;
+end;
+$$;
+
+-- Preleva min(saldo, p_max) crediti in un nuovo lease, se il saldo è almeno
+-- p_min. Restituisce l'id del lease (null se i crediti non bastano), i
+-- crediti prelevati e il saldo rimasto.
+create or replace function lease_credits(p_user_id bigint, p_min integer, p_max integer, p_ttl_seconds integer)
+returns table (lease_id bigint, leased integer, balance integer)
+language plpgsql
+as $$
+declare
+    current_balance integer;
+    amount integer;
+begin
+    perform reclaim_credit_leases(p_user_id, false);
+
+    select u.credits into current_balance from users u where u.id = p_user_id for update;
+    if not found then
+        insert into users (id, credits) values (p_user_id, 0)
+        on conflict (id) do nothing;
+        current_balance := 0;
+    end if;
+
+    if current_balance < p_min then
+        return query select null::bigint, 0, current_balance;
+        return;
+    end if;
+
+    amount := least(current_balance, p_max);
+    update users u set credits = u.credits - amount where u.id = p_user_id;
+
+    return query
+        insert into credit_leases (user_id, credits, expires_at)
+        values (p_user_id, amount, now() + make_interval(secs => p_ttl_seconds))
+        returning id, amount, current_balance - amount;
+end;
+$$;
+
+-- Chiude un lease dopo averne usati p_used crediti e restituisce il resto.
+-- Se il lease era già stato recuperato (scaduto) i suoi crediti sono già
+-- tornati all'utente: si addebitano quelli usati, anche se il saldo diventa
+-- negativo, così nessun credito viene speso due volte senza essere pagato.
+-- Restituisce il nuovo saldo.
+create or replace function return_credit_lease(p_lease_id bigint, p_user_id bigint, p_used integer)
+returns integer
+language plpgsql
+as $$
+declare
+    granted integer;
+    new_balance integer;
+begin
+    delete from credit_leases where id = p_lease_id returning credits into granted;
+
+    if found then
+        update users set credits = credits + greatest(granted - p_used, 0)
+         where id = p_user_id
+        returning credits into new_balance;
+    else
+        update users set credits = credits - p_used
+         where id = p_user_id
+        returning credits into new_balance;
+    end if;
+
+    return new_balance;
+end;
+$$;
@@ -0,0 +1,68 @@
+"""
+Lease dei crediti con più istanze sullo stesso database: i crediti spesi non
+devono mai superare quelli disponibili.
+
+    python -m unittest tests.test_leases
+"""
+import os
+import tempfile
+import unittest
+
+from tinyagents.credit_store import SQLiteCreditStore
+from tinyagents.leases import CreditLeaseManager
+
+USER_ID = 42
+MAX_COMMANDS = 100
+
+
+class TwoInstancesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.store = SQLiteCreditStore(os.path.join(self.directory.name, "credits.sqlite3"))
+        self.instances = [CreditLeaseManager(self.store, size=10), CreditLeaseManager(self.store, size=10)]
+
+    def tearDown(self):
+        self.store._conn.close()
+        self.directory.cleanup()
+
+    def serve_all(self):
+        """Alterna i comandi tra le istanze finché entrambe li rifiutano; restituisce i comandi serviti."""
+        served = 0
+        refused = set()
+        # Limite di sicurezza: se i crediti venissero duplicati le istanze servirebbero all'infinito
+        while len(refused) < len(self.instances) and served <= MAX_COMMANDS:
+            for index, instance in enumerate(self.instances):
+                if index in refused:
+                    continue
+                if instance.reserve(USER_ID) == -1:
+                    refused.add(index)
+                else:
+                    served += 1
+        return served
+
+    def close_all(self):
+        for instance in self.instances:
+            instance.release_all()
+
+    def test_served_never_exceed_balance(self):
+        self.store.add(USER_ID, 10)
+        served = self.serve_all()
+        self.close_all()
+        self.assertLessEqual(served, 10)
+        self.assertEqual(self.store.get_credits(USER_ID), 10 - served)
+
+    def test_top_up_does_not_duplicate_credits(self):
+        self.store.add(USER_ID, 10)
+        self.instances[0].reserve(USER_ID)
+        # Ricarica elaborata da una delle istanze mentre l'altra ha un lease attivo
+        self.store.apply_stripe_event("evt_1", USER_ID, 5)
+        self.instances[1].invalidate(USER_ID)
+        served = 1 + self.serve_all()
+        self.close_all()
+        self.assertLessEqual(served, 15)
+        self.assertEqual(self.store.get_credits(USER_ID), 15 - served)
+
+
+if __name__ == "__main__":
+    unittest.main()
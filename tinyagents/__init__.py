@@ -0,0 +1 @@
+"""Moduli condivisi tra le serverless function di TinyAgents (`api/*.py`)."""
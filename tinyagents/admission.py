@@ -0,0 +1,266 @@
+"""
+Controllo di ammissione davanti a Groq.
+
+Prima di riservare il credito, ogni richiesta a un agente deve superare:
+
+1. il token bucket dell'utente (`RATE_LIMIT_USER_PER_MINUTE`, `RATE_LIMIT_USER_BURST`);
+2. il token bucket globale del bot (`RATE_LIMIT_GLOBAL_PER_MINUTE`, `RATE_LIMIT_GLOBAL_BURST`);
+3. il limite di chiamate a Groq in corso nell'istanza (`LLM_MAX_INFLIGHT`).
+
+Le richieste oltre i limiti vengono rifiutate subito, senza toccare i crediti.
+
+Gli utenti paganti (almeno un acquisto Stripe) hanno la priorità: ogni loro
+richiesta consuma `1 / RATE_LIMIT_PAYING_MULTIPLIER` gettoni del proprio
+bucket, e solo loro possono usare la quota `RATE_LIMIT_PRIORITY_RESERVE` del
+bucket globale e degli slot di Groq. Il tipo di utente viene verificato solo
+quando una richiesta sta per essere rifiutata, e poi tenuto in cache.
+
+Backend del bucket globale (`RATE_LIMIT_BACKEND`):
+
+- `memory`: stato in-process, ogni istanza ha il proprio budget;
+- `supabase`: bucket condiviso da tutte le istanze (funzione `take_rate_tokens`
+  di `sql/admission.sql`); i bucket per utente restano in memoria;
+- `off`: nessun controllo.
+"""
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from tinyagents import metrics
+from tinyagents.clients import get_supabase_client
+from tinyagents.credits import is_paying_user
+
+# --- CONFIGURAZIONE ---
+RATE_LIMIT_BACKEND = os.environ.get('RATE_LIMIT_BACKEND', 'memory')
+RATE_LIMIT_USER_PER_MINUTE = float(os.environ.get('RATE_LIMIT_USER_PER_MINUTE', '10'))
+RATE_LIMIT_USER_BURST = float(os.environ.get('RATE_LIMIT_USER_BURST', '5'))
+RATE_LIMIT_GLOBAL_PER_MINUTE = float(os.environ.get('RATE_LIMIT_GLOBAL_PER_MINUTE', '600'))
+RATE_LIMIT_GLOBAL_BURST = float(os.environ.get('RATE_LIMIT_GLOBAL_BURST', '60'))
+RATE_LIMIT_PAYING_MULTIPLIER = float(os.environ.get('RATE_LIMIT_PAYING_MULTIPLIER', '3'))
+RATE_LIMIT_PRIORITY_RESERVE = float(os.environ.get('RATE_LIMIT_PRIORITY_RESERVE', '0.2'))
+LLM_MAX_INFLIGHT = int(os.environ.get('LLM_MAX_INFLIGHT', '16'))
+# Attesa massima (secondi) di uno slot libero per la chiamata a Groq
+LLM_SLOT_WAIT = float(os.environ.get('LLM_SLOT_WAIT', '5'))
+
+# Per quanto tempo (secondi) si ricorda se un utente è pagante
+PAYING_CACHE_TTL = 600
+_MAX_TRACKED = 10000
+
+
+class MemoryBucketStore:
+    """Token bucket in memoria, indicizzati per chiave (es. `user:123`)."""
+
+    def __init__(self, maxsize: int = _MAX_TRACKED, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.clock = clock
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key: str, rate: float, capacity: float, cost: float = 1.0, floor: float = 0.0) -> float:
+        """
+        Preleva `cost` gettoni se nel bucket ne restano almeno `floor` dopo il prelievo.
+        Restituisce 0 se la richiesta è ammessa, altrimenti i secondi da attendere.
+        """
+        now = self.clock()
+        with self._lock:
+            tokens, updated_at = self._buckets.get(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated_at) * rate)
+            if tokens - cost >= floor:
+                tokens -= cost
+                wait = 0.0
+            else:
+                wait = (floor + cost - tokens) / rate if rate > 0 else math.inf
+            self._buckets[key] = (tokens, now)
+            self._buckets.move_to_end(key)
+            # I bucket toccati meno di recente sono quelli (quasi) pieni: si possono dimenticare
+            while len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+        return wait
+
+
+class SupabaseBucketStore:
+    """Token bucket condivisi tra le istanze, aggiornati in un'unica chiamata RPC."""
+
+    def take(self, key: str, rate: float, capacity: float, cost: float = 1.0, floor: float = 0.0) -> float:
+        supabase_client = get_supabase_client()
+        if not supabase_client:
+            return 0.0
+        try:
+            with metrics.span("supabase", op="take_rate_tokens"):
+                response = supabase_client.rpc('take_rate_tokens', {
+                    "p_key": key, "p_rate": rate, "p_capacity": capacity, "p_cost": cost, "p_floor": floor,
+                }).execute()
+            return float(response.data or 0)
+        except Exception as e:
+            # Se il backend condiviso non risponde si lascia passare la richiesta:
+            # i limiti per utente e per istanza restano comunque attivi
+            print(f"Errore Supabase (take_rate_tokens): {e}")
+            return 0.0
+
+
+class Admission:
+    """Esito del controllo di ammissione. Se ammessa, va chiusa con `release()`."""
+
+    def __init__(self, controller=None, reason: str | None = None, retry_after: float = 0.0, slots: int = 1):
+        self._controller = controller
+        self.reason = reason
+        self.retry_after = retry_after
+        self.slots = slots
+
+    def __bool__(self) -> bool:
+        return self.reason is None
+
+    def release(self):
+        """Libera gli slot di Groq occupati dalla richiesta."""
+        if self._controller is not None:
+            self._controller._release_slot(self.slots)
+            self._controller = None
+
+
+class AdmissionController:
+    """Token bucket per utente e globale più un limite di chiamate a Groq in corso."""
+
+    def __init__(self, global_store=None, paying_lookup=None,
+                 user_per_minute: float = RATE_LIMIT_USER_PER_MINUTE, user_burst: float = RATE_LIMIT_USER_BURST,
+                 global_per_minute: float = RATE_LIMIT_GLOBAL_PER_MINUTE, global_burst: float = RATE_LIMIT_GLOBAL_BURST,
+                 max_inflight: int = LLM_MAX_INFLIGHT, slot_wait: float = LLM_SLOT_WAIT,
+                 paying_multiplier: float = RATE_LIMIT_PAYING_MULTIPLIER,
+                 priority_reserve: float = RATE_LIMIT_PRIORITY_RESERVE, clock=time.monotonic):
+        self.user_buckets = MemoryBucketStore(clock=clock)
+        self.global_store = global_store if global_store is not None else MemoryBucketStore(clock=clock)
+        self.paying_lookup = paying_lookup
+        self.user_rate = user_per_minute / 60
+        self.user_burst = user_burst
+        self.global_rate = global_per_minute / 60
+        self.global_burst = global_burst
+        self.max_inflight = max_inflight
+        self.slot_wait = slot_wait
+        self.paying_multiplier = max(1.0, paying_multiplier)
+        self.global_reserve = global_burst * priority_reserve
+        # Slot riservati ai paganti (almeno uno, se il limite lo consente)
+        self.reserved_slots = min(max_inflight - 1, math.ceil(max_inflight * priority_reserve)) if max_inflight > 1 else 0
+        self.clock = clock
+        self.inflight = 0
+        self._slots = threading.Condition()
+        self._paying = OrderedDict()
+        self._paying_lock = threading.Lock()
+
+    # --- Tipo di utente ---
+
+    def cached_paying(self, user_id) -> bool | None:
+        """Tipo di utente già noto, senza interrogare il database (None se sconosciuto)."""
+        with self._paying_lock:
+            cached = self._paying.get(user_id)
+        if cached is not None and cached[1] > self.clock():
+            return cached[0]
+        return None
+
+    def is_paying(self, user_id) -> bool:
+        """True se l'utente ha acquistato crediti (risultato in cache per `PAYING_CACHE_TTL` secondi)."""
+        if self.paying_lookup is None:
+            return False
+        cached = self.cached_paying(user_id)
+        if cached is not None:
+            return cached
+        now = self.clock()
+        try:
+            paying = bool(self.paying_lookup(user_id))
+        except Exception as e:
+            print(f"Errore durante la verifica dell'utente pagante {user_id}: {e}")
+            return False
+        with self._paying_lock:
+            self._paying[user_id] = (paying, now + PAYING_CACHE_TTL)
+            self._paying.move_to_end(user_id)
+            while len(self._paying) > _MAX_TRACKED:
+                self._paying.popitem(last=False)
+        return paying
+
+    # --- Ammissione ---
+
+    def admit(self, user_id, calls: int = 1) -> Admission:
+        """
+        Decide se la richiesta può procedere. Non blocca oltre `slot_wait` secondi.
+        `calls` è il numero di chiamate a Groq della richiesta (es. `/multi`): ognuna
+        consuma gettoni e occupa uno slot, senza superare la capienza dei bucket.
+        """
+        paying = self.cached_paying(user_id)
+
+        # 1. Bucket dell'utente: i paganti consumano meno gettoni per richiesta
+        key = f"user:{user_id}"
+        wait = self.user_buckets.take(key, self.user_rate, self.user_burst, cost=self._user_cost(paying, calls))
+        if wait and paying is None:
+            paying = self.is_paying(user_id)
+            if paying:
+                wait = self.user_buckets.take(key, self.user_rate, self.user_burst, cost=self._user_cost(paying, calls))
+        if wait:
+            return self._reject("user", paying, wait)
+
+        # 2. Bucket globale: la riserva è accessibile solo ai paganti
+        if self.global_rate > 0:
+            cost = min(calls, self.global_burst)
+            wait = self.global_store.take("global", self.global_rate, self.global_burst, cost=cost, floor=self._global_floor(paying))
+            if wait and paying is None:
+                paying = self.is_paying(user_id)
+                if paying:
+                    wait = self.global_store.take("global", self.global_rate, self.global_burst, cost=cost, floor=self._global_floor(paying))
+            if wait:
+                return self._reject("global", paying, wait)
+
+        # 3. Slot per le chiamate a Groq: si attende al massimo `slot_wait` secondi
+        slots = min(calls, self._slot_limit(paying))
+        if not self._acquire_slot(self._slot_limit(paying), timeout=0, count=slots):
+            if paying is None:
+                paying = self.is_paying(user_id)
+                slots = min(calls, self._slot_limit(paying))
+            if not self._acquire_slot(self._slot_limit(paying), timeout=self.slot_wait, count=slots):
+                return self._reject("concurrency", paying, self.slot_wait)
+
+        metrics.inc("tinyagents_admission_total", result="admitted", tier=self._tier(paying))
+        return Admission(self, slots=slots)
+
+    def _reject(self, reason, paying, retry_after) -> Admission:
+        metrics.inc("tinyagents_admission_total", result="rejected", reason=reason, tier=self._tier(paying))
+        return Admission(reason=reason, retry_after=retry_after)
+
+    @staticmethod
+    def _tier(paying) -> str:
+        return "paying" if paying else "free"
+
+    def _user_cost(self, paying, calls: int = 1) -> float:
+        cost = calls / self.paying_multiplier if paying else float(calls)
+        return min(cost, self.user_burst)
+
+    def _global_floor(self, paying) -> float:
+        return 0.0 if paying else self.global_reserve
+
+    def _slot_limit(self, paying) -> int:
+        return self.max_inflight if paying else self.max_inflight - self.reserved_slots
+
+    def _acquire_slot(self, limit: int, timeout: float, count: int = 1) -> bool:
+        deadline = self.clock() + timeout
+        with self._slots:
+            while self.inflight + count > limit:
+                remaining = deadline - self.clock()
+                if remaining <= 0:
+                    return False
+                self._slots.wait(remaining)
+            self.inflight += count
+            return True
+
+    def _release_slot(self, count: int = 1):
+        with self._slots:
+            self.inflight -= count
+            self._slots.notify_all()
+
+
+def create_admission_controller(backend: str = RATE_LIMIT_BACKEND) -> AdmissionController | None:
+    """Crea il controllo di ammissione configurato tramite `RATE_LIMIT_BACKEND` (`memory`, `supabase` o `off`)."""
+    if backend == 'off':
+        return None
+    if backend == 'memory':
+        return AdmissionController(paying_lookup=is_paying_user)
+    if backend == 'supabase':
+        return AdmissionController(global_store=SupabaseBucketStore(), paying_lookup=is_paying_user)
+    raise ValueError(f"Backend di controllo di ammissione non supportato: {backend}")
@@ -0,0 +1,177 @@
+"""
+Cache delle risposte dell'LLM.
+
+La chiave dipende dal nome dell'agente, dall'hash del suo system prompt, dai
+parametri del modello e dall'input dell'utente normalizzato, così richieste
+come "spiega ricorsione" e "Spiega la ricorsione!" condividono la stessa voce.
+Le voci scadono dopo `LLM_CACHE_TTL` secondi e, superata la dimensione massima,
+vengono rimosse quelle usate meno di recente (LRU).
+
+Backend disponibili:
+
+- `memory`: dizionario ordinato in-process;
+- `sqlite`: file SQLite locale condiviso tra i processi della stessa macchina;
+- `off`: cache disattivata.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import Counter, OrderedDict
+
+from tinyagents import metrics
+
+# --- CONFIGURAZIONE ---
+LLM_CACHE_BACKEND = os.environ.get('LLM_CACHE_BACKEND', 'memory')
+LLM_CACHE_PATH = os.environ.get('LLM_CACHE_PATH', '/tmp/tinyagents_cache.sqlite3')
+LLM_CACHE_TTL = float(os.environ.get('LLM_CACHE_TTL', '86400'))
+LLM_CACHE_SIZE = int(os.environ.get('LLM_CACHE_SIZE', '1000'))
+
+# Articoli italiani, ignorati solo come parole intere. Le lettere singole
+# ("i", "a") restano: nelle domande sul codice sono spesso identificatori.
+_ARTICLES = frozenset("il lo la gli le un uno una".split())
+# Punteggiatura di fine frase: i simboli all'interno del testo (C++, ===, &&) cambiano il senso
+_TRAILING_PUNCTUATION = ".!?;:…"
+
+
+def normalize_input(text: str) -> str:
+    """Minuscole, niente accenti né spazi ripetuti, senza punteggiatura finale e articoli."""
+    text = unicodedata.normalize('NFKD', text.lower())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    words = text.rstrip().rstrip(_TRAILING_PUNCTUATION).split()
+    return " ".join(w for w in words if w not in _ARTICLES)
+
+
+class MemoryCache:
+    """Cache LRU con TTL in memoria, condivisa dai thread dell'istanza."""
+
+    def __init__(self, ttl: float = LLM_CACHE_TTL, maxsize: int = LLM_CACHE_SIZE, clock=time.monotonic):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.clock = clock
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            value, expires_at = item
+            if expires_at <= self.clock():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: str):
+        with self._lock:
+            self._data[key] = (value, self.clock() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def __len__(self):
+        return len(self._data)
+
+
+class SQLiteCache:
+    """Cache LRU con TTL su un file SQLite, condivisibile tra più processi."""
+
+    def __init__(self, path: str = LLM_CACHE_PATH, ttl: float = LLM_CACHE_TTL, maxsize: int = LLM_CACHE_SIZE, clock=time.time):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=5.0)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS llm_cache ("
+            " key TEXT PRIMARY KEY,"
+            " value TEXT NOT NULL,"
+            " expires_at REAL NOT NULL,"
+            " last_used REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS llm_cache_last_used ON llm_cache (last_used)")
+
+    def get(self, key: str):
+        now = self.clock()
+        with self._lock:
+            row = self._conn.execute(
+                "UPDATE llm_cache SET last_used = ? WHERE key = ? AND expires_at > ? RETURNING value",
+                (now, key, now),
+            ).fetchone()
+        return row[0] if row else None
+
+    def set(self, key: str, value: str):
+        now = self.clock()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, value, expires_at, last_used) VALUES (?, ?, ?, ?)",
+                (key, value, now + self.ttl, now),
+            )
+            self._conn.execute(
+                "DELETE FROM llm_cache WHERE expires_at <= ? OR key IN"
+                " (SELECT key FROM llm_cache ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                (now, self.maxsize),
+            )
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0]
+
+
+class ResponseCache:
+    """Cache delle risposte degli agenti, con contatori di hit e miss per agente."""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = Counter()
+        self.misses = Counter()
+
+    @staticmethod
+    def make_key(agent_name: str, system_prompt: str, params: dict, user_input: str) -> str:
+        prompt_hash = hashlib.sha256(system_prompt.encode('utf-8')).hexdigest()
+        material = json.dumps(
+            [agent_name, prompt_hash, params.get('model'), params.get('temperature'), params.get('max_tokens'), normalize_input(user_input)],
+            ensure_ascii=False,
+        )
+        return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+    def get(self, agent_name: str, key: str):
+        value = self.backend.get(key)
+        if value is None:
+            self.misses[agent_name] += 1
+            metrics.inc("tinyagents_llm_cache_misses_total", agent=agent_name)
+        else:
+            self.hits[agent_name] += 1
+            metrics.inc("tinyagents_llm_cache_hits_total", agent=agent_name)
+        return value
+
+    def set(self, key: str, value: str):
+        self.backend.set(key, value)
+
+    def stats(self) -> dict:
+        """Hit e miss totali e per agente."""
+        return {
+            "hits": sum(self.hits.values()),
+            "misses": sum(self.misses.values()),
+            "per_agent": {
+                agent: {"hits": self.hits[agent], "misses": self.misses[agent]}
+                for agent in sorted(set(self.hits) | set(self.misses))
+            },
+        }
+
+
+def create_response_cache(backend: str = LLM_CACHE_BACKEND) -> ResponseCache | None:
+    """Crea la cache configurata tramite `LLM_CACHE_BACKEND`, o None se disattivata."""
+    if backend == 'off':
+        return None
+    if backend == 'memory':
+        return ResponseCache(MemoryCache())
+    if backend == 'sqlite':
+        return ResponseCache(SQLiteCache())
+    raise ValueError(f"Backend della cache non supportato: {backend}")
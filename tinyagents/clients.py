@@ -0,0 +1,118 @@
+"""
+Client condivisi per Supabase, Groq, Telegram e Stripe.
+
+Ogni client viene creato una sola volta per istanza "calda" e poi riutilizzato
+dagli update successivi: in questo modo le connessioni HTTP keep-alive restano
+aperte e non si paga un nuovo handshake TLS a ogni richiesta.
+"""
+import os
+import threading
+
+from tinyagents.metrics import InstrumentedClient
+
+# --- CONFIGURAZIONE ---
+TELEGRAM_TOKEN = os.environ.get('TELEGRAM_TOKEN')
+GROQ_API_KEY = os.environ.get('GROQ_API_KEY')
+SUPABASE_URL = os.environ.get('SUPABASE_URL')
+SUPABASE_KEY = os.environ.get('SUPABASE_KEY')
+STRIPE_SECRET_KEY = os.environ.get('STRIPE_SECRET_KEY')
+
+# Endpoint alternativi (es. Bot API server locale o servizi finti per i benchmark).
+# Per Groq si usa la variabile GROQ_BASE_URL, letta direttamente dall'SDK.
+TELEGRAM_API_URL = os.environ.get('TELEGRAM_API_URL')
+STRIPE_API_BASE = os.environ.get('STRIPE_API_BASE')
+
+# Numero di connessioni keep-alive verso l'API di Telegram
+TELEGRAM_POOL_SIZE = int(os.environ.get('TELEGRAM_POOL_SIZE', '8'))
+# Connessioni contemporanee verso Groq (il default dell'SDK è 100)
+GROQ_MAX_CONNECTIONS = int(os.environ.get('GROQ_MAX_CONNECTIONS', '100'))
+
+_clients = {}
+_lock = threading.Lock()
+
+
+def _get_or_create(name: str, factory):
+    """Restituisce il client `name`, creandolo con `factory` al primo utilizzo.
+
+    Se la creazione fallisce l'errore viene loggato e si restituisce None; il
+    tentativo viene ripetuto alla chiamata successiva.
+    """
+    client = _clients.get(name)
+    if client is not None:
+        return client
+
+    with _lock:
+        client = _clients.get(name)
+        if client is None:
+            try:
+                client = factory()
+            except Exception as e:
+                print(f"Errore durante l'inizializzazione del client {name}: {e}")
+                return None
+            _clients[name] = client
+    return client
+
+
+# --- SUPABASE ---
+
+def _create_supabase():
+    from supabase.client import create_client
+    return create_client(SUPABASE_URL, SUPABASE_KEY)
+
+def get_supabase_client():
+    """Restituisce il client Supabase condiviso, o None se non configurato."""
+    if not SUPABASE_URL or not SUPABASE_KEY:
+        return None
+    return _get_or_create('supabase', _create_supabase)
+
+
+# --- GROQ ---
+
+def _create_groq():
+    import httpx
+    from groq import DefaultHttpxClient, Groq
+    limits = httpx.Limits(max_connections=GROQ_MAX_CONNECTIONS, max_keepalive_connections=min(GROQ_MAX_CONNECTIONS, 100))
+    return Groq(api_key=GROQ_API_KEY, http_client=DefaultHttpxClient(limits=limits))
+
+def get_groq_client():
+    """Restituisce il client Groq condiviso, o None se manca la chiave API."""
+    if not GROQ_API_KEY:
+        return None
+    return _get_or_create('groq', _create_groq)
+
+
+# --- TELEGRAM ---
+
+def _create_bot():
+    import telegram
+    from telegram.utils.request import Request
+    # Il pool di default ha una sola connessione: ne teniamo qualcuna in più
+    # per gli invii concorrenti dalla stessa istanza.
+    base_url = f"{TELEGRAM_API_URL}/bot" if TELEGRAM_API_URL else None
+    bot = telegram.Bot(token=TELEGRAM_TOKEN, base_url=base_url, request=Request(con_pool_size=TELEGRAM_POOL_SIZE))
+    # Ogni chiamata all'API di Telegram viene misurata come fase "telegram"
+    return InstrumentedClient(bot, "telegram")
+
+def get_bot():
+    """Restituisce il `telegram.Bot` condiviso, o None se manca il token."""
+    if not TELEGRAM_TOKEN:
+        return None
+    return _get_or_create('telegram', _create_bot)
+
+
+# --- STRIPE ---
+
+def _configure_stripe():
+    import stripe
+    stripe.api_key = STRIPE_SECRET_KEY
+    if STRIPE_API_BASE:
+        stripe.api_base = STRIPE_API_BASE
+    # Il client HTTP basato su requests mantiene una sessione keep-alive per thread
+    stripe.default_http_client = stripe.RequestsClient()
+    return stripe
+
+def get_stripe():
+    """Restituisce il modulo `stripe` configurato una sola volta, o None se manca la chiave."""
+    if not STRIPE_SECRET_KEY:
+        return None
+    return _get_or_create('stripe', _configure_stripe)
@@ -0,0 +1,234 @@
+"""
+Archivio dei crediti: backend intercambiabili dietro `tinyagents/credits.py`.
+
+Il backend si sceglie con `CREDITS_BACKEND`:
+
+- `supabase`: tabelle e funzioni Postgres di `sql/credits.sql` e
+  `sql/leases.sql`, una chiamata RPC per operazione;
+- `sqlite`: database SQLite locale in modalità WAL (`CREDITS_PATH`), per
+  installazioni su un solo nodo e per provare il bot end to end senza servizi
+  esterni. Le stesse operazioni delle funzioni Postgres sono eseguite con
+  `UPDATE ... RETURNING` atomici; le query sono costanti e parametrizzate,
+  quindi `sqlite3` le prepara una sola volta per connessione.
+
+Ogni metodo solleva un'eccezione in caso di errore: log e valori di ripiego
+restano in `tinyagents/credits.py`.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from tinyagents.clients import get_supabase_client
+
+# --- CONFIGURAZIONE ---
+CREDITS_BACKEND = os.environ.get('CREDITS_BACKEND', 'supabase')
+CREDITS_PATH = os.environ.get('CREDITS_PATH', '/tmp/tinyagents_credits.sqlite3')
+
+
+class SupabaseCreditStore:
+    """Crediti su Supabase, tramite le funzioni RPC di `sql/credits.sql` e `sql/leases.sql`."""
+
+    name = "Supabase"
+    # Nome della fase nelle metriche
+    stage = "supabase"
+
+    def available(self) -> bool:
+        return get_supabase_client() is not None
+
+    def _rpc(self, function: str, params: dict):
+        return get_supabase_client().rpc(function, params).execute().data
+
+    def get_credits(self, user_id) -> int:
+        client = get_supabase_client()
+        response = client.table('users').select('credits').eq('id', user_id).execute()
+        if response.data:
+            return response.data[0]['credits']
+        # Inizializza l'utente con 0 crediti
+        client.table('users').insert({"id": user_id, "credits": 0}).execute()
+        return 0
+
+    def get_credits_many(self, user_ids) -> dict:
+        response = get_supabase_client().table('users').select('id,credits').in_('id', list(user_ids)).execute()
+        return {row['id']: row['credits'] for row in response.data}
+
+    def reserve(self, user_id, amount: int) -> int:
+        return self._rpc('reserve_credits', {"p_user_id": user_id, "p_amount": amount})
+
+    def refund(self, user_id, amount: int) -> int | None:
+        return self._rpc('refund_credits', {"p_user_id": user_id, "p_amount": amount})
+
+    def add(self, user_id, amount: int) -> int:
+        return self._rpc('add_credits', {"p_user_id": user_id, "p_amount": amount})
+
+    def apply_stripe_event(self, event_id: str, user_id, amount: int) -> int:
+        return self._rpc('apply_stripe_event', {"p_event_id": event_id, "p_user_id": user_id, "p_amount": amount})
+
+    def is_paying(self, user_id) -> bool:
+        response = get_supabase_client().table('stripe_events').select('id').eq('user_id', user_id).limit(1).execute()
+        return bool(response.data)
+
+    def lease(self, user_id, minimum: int, maximum: int, ttl: float):
+        row = self._rpc('lease_credits', {
+            "p_user_id": user_id, "p_min": minimum, "p_max": maximum, "p_ttl_seconds": int(ttl),
+        })[0]
+        return row["lease_id"], row["leased"], row["balance"]
+
+    def return_lease(self, lease_id, user_id, used: int) -> int:
+        return self._rpc('return_credit_lease', {"p_lease_id": lease_id, "p_user_id": user_id, "p_used": used})
+
+
+# --- SQLITE ---
+
+_SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS users ("
+    " id INTEGER PRIMARY KEY,"
+    " credits INTEGER NOT NULL DEFAULT 0,"
+    " created_at REAL NOT NULL DEFAULT (CAST(strftime('%s', 'now') AS REAL)))",
+    "CREATE TABLE IF NOT EXISTS stripe_events ("
+    " id TEXT PRIMARY KEY,"
+    " user_id INTEGER NOT NULL,"
+    " credits INTEGER NOT NULL,"
+    " processed_at REAL NOT NULL DEFAULT (CAST(strftime('%s', 'now') AS REAL)))",
+    "CREATE INDEX IF NOT EXISTS stripe_events_user_id ON stripe_events (user_id)",
+    "CREATE TABLE IF NOT EXISTS credit_leases ("
+    " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+    " user_id INTEGER NOT NULL,"
+    " credits INTEGER NOT NULL,"
+    " expires_at REAL NOT NULL)",
+    "CREATE INDEX IF NOT EXISTS credit_leases_user_id ON credit_leases (user_id)",
+)
+
+_SELECT_CREDITS = "SELECT credits FROM users WHERE id = ?"
+# Un solo statement preparato per qualunque numero di utenti
+_SELECT_CREDITS_MANY = "SELECT id, credits FROM users WHERE id IN (SELECT value FROM json_each(?))"
+_INSERT_USER = "INSERT OR IGNORE INTO users (id, credits) VALUES (?, 0)"
+_RESERVE = "UPDATE users SET credits = credits - ? WHERE id = ? AND credits >= ? RETURNING credits"
+_REFUND = "UPDATE users SET credits = credits + ? WHERE id = ? RETURNING credits"
+_ADD = (
+    "INSERT INTO users (id, credits) VALUES (?, ?)"
+    " ON CONFLICT (id) DO UPDATE SET credits = credits + excluded.credits RETURNING credits"
+)
+_INSERT_EVENT = "INSERT OR IGNORE INTO stripe_events (id, user_id, credits) VALUES (?, ?, ?)"
+_SELECT_PAYING = "SELECT 1 FROM stripe_events WHERE user_id = ? LIMIT 1"
+_DELETE_EXPIRED_LEASES = "DELETE FROM credit_leases WHERE user_id = ? AND expires_at <= ? RETURNING credits"
+_INSERT_LEASE = "INSERT INTO credit_leases (user_id, credits, expires_at) VALUES (?, ?, ?) RETURNING id"
+_DELETE_LEASE = "DELETE FROM credit_leases WHERE id = ? RETURNING credits"
+_CHARGE = "UPDATE users SET credits = credits - ? WHERE id = ? RETURNING credits"
+
+
+class SQLiteCreditStore:
+    """Crediti in un database SQLite locale (WAL), con le stesse regole delle funzioni Postgres."""
+
+    name = "SQLite"
+    stage = "sqlite"
+
+    def __init__(self, path: str = CREDITS_PATH, clock=time.time):
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=5.0)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        # In WAL basta sincronizzare ai checkpoint: un commit resta durevole anche se il processo termina
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        for statement in _SCHEMA:
+            self._conn.execute(statement)
+
+    def available(self) -> bool:
+        return True
+
+    def _one(self, sql: str, params: tuple):
+        # fetchall: con RETURNING lo statement deve arrivare in fondo per chiudere la scrittura
+        rows = self._conn.execute(sql, params).fetchall()
+        return rows[0][0] if rows else None
+
+    def _transaction(self, operation, *args):
+        """Esegue `operation` in una transazione che blocca subito le scritture degli altri processi."""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = operation(*args)
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+            return result
+
+    def get_credits(self, user_id) -> int:
+        with self._lock:
+            credits = self._one(_SELECT_CREDITS, (user_id,))
+            if credits is None:
+                self._conn.execute(_INSERT_USER, (user_id,))
+                return 0
+            return credits
+
+    def get_credits_many(self, user_ids) -> dict:
+        with self._lock:
+            return dict(self._conn.execute(_SELECT_CREDITS_MANY, (json.dumps(list(user_ids)),)).fetchall())
+
+    def reserve(self, user_id, amount: int) -> int:
+        with self._lock:
+            credits = self._one(_RESERVE, (amount, user_id, amount))
+            if credits is None:
+                self._conn.execute(_INSERT_USER, (user_id,))
+                return -1
+            return credits
+
+    def refund(self, user_id, amount: int) -> int | None:
+        with self._lock:
+            return self._one(_REFUND, (amount, user_id))
+
+    def add(self, user_id, amount: int) -> int:
+        with self._lock:
+            return self._one(_ADD, (user_id, amount))
+
+    def apply_stripe_event(self, event_id: str, user_id, amount: int) -> int:
+        def apply():
+            if self._conn.execute(_INSERT_EVENT, (event_id, user_id, amount)).rowcount == 0:
+                return -1
+            return self._one(_ADD, (user_id, amount))
+        return self._transaction(apply)
+
+    def is_paying(self, user_id) -> bool:
+        with self._lock:
+            return self._one(_SELECT_PAYING, (user_id,)) is not None
+
+    def _reclaim_expired(self, user_id) -> int:
+        reclaimed = sum(row[0] for row in self._conn.execute(_DELETE_EXPIRED_LEASES, (user_id, self.clock())).fetchall())
+        if reclaimed:
+            self._conn.execute(_REFUND, (reclaimed, user_id)).fetchall()
+        return reclaimed
+
+    def lease(self, user_id, minimum: int, maximum: int, ttl: float):
+        def lease():
+            self._reclaim_expired(user_id)
+            balance = self._one(_SELECT_CREDITS, (user_id,))
+            if balance is None:
+                self._conn.execute(_INSERT_USER, (user_id,))
+                balance = 0
+            if balance < minimum:
+                return None, 0, balance
+            amount = min(balance, maximum)
+            balance = self._one(_RESERVE, (amount, user_id, amount))
+            lease_id = self._one(_INSERT_LEASE, (user_id, amount, self.clock() + ttl))
+            return lease_id, amount, balance
+        return self._transaction(lease)
+
+    def return_lease(self, lease_id, user_id, used: int) -> int:
+        def close():
+            granted = self._one(_DELETE_LEASE, (lease_id,))
+            if granted is not None:
+                return self._one(_REFUND, (max(granted - used, 0), user_id))
+            # Lease già recuperato: i suoi crediti sono tornati all'utente, si addebitano
+            # quelli usati anche se il saldo diventa negativo
+            return self._one(_CHARGE, (used, user_id))
+        return self._transaction(close)
+
+
+def create_credit_store(backend: str = CREDITS_BACKEND):
+    """Crea l'archivio dei crediti configurato tramite `CREDITS_BACKEND` (`supabase` o `sqlite`)."""
+    if backend == 'supabase':
+        return SupabaseCreditStore()
+    if backend == 'sqlite':
+        return SQLiteCreditStore()
+    raise ValueError(f"Backend dei crediti non supportato: {backend}")
@@ -0,0 +1,117 @@
+"""
+Gestione dei crediti.
+
+I dati sono nell'archivio scelto con `CREDITS_BACKEND` (vedi
+`tinyagents/credit_store.py`): Supabase, con le funzioni Postgres di
+`sql/credits.sql`, oppure un database SQLite locale. In entrambi i casi
+controllo e aggiornamento del saldo avvengono in un'unica operazione atomica,
+anche quando lo stesso utente invia più messaggi in parallelo.
+
+Con `CREDIT_LEASES=true` le riserve e i rimborsi usano i lease di
+`tinyagents/leases.py`: la maggior parte dei comandi non tocca il database.
+"""
+from tinyagents import metrics
+from tinyagents.credit_store import create_credit_store
+from tinyagents.leases import create_credit_leases
+
+credit_store = create_credit_store()
+credit_leases = create_credit_leases(credit_store)
+
+
+def get_user_credits(user_id: int) -> int:
+    """Recupera i crediti dell'utente. Crea un record se non esiste."""
+    if not credit_store.available():
+        return 0
+
+    try:
+        with metrics.span(credit_store.stage, op="select_credits"):
+            credits = credit_store.get_credits(user_id)
+        # I crediti prelevati in un lease di questa istanza fanno ancora parte del saldo
+        leased = credit_leases.available(user_id) if credit_leases is not None else 0
+        return credits + leased
+    except Exception as e:
+        print(f"Errore {credit_store.name} (get_user_credits): {e}")
+        return 0
+
+def get_users_credits(user_ids) -> dict | None:
+    """
+    Saldi di più utenti con una sola query, senza creare record (chi non è registrato ha 0 crediti).
+    Restituisce None in caso di errore.
+    """
+    if not credit_store.available():
+        return None
+
+    try:
+        with metrics.span(credit_store.stage, op="select_credits_many"):
+            found = credit_store.get_credits_many(user_ids)
+    except Exception as e:
+        print(f"Errore {credit_store.name} (get_users_credits): {e}")
+        return None
+    leased = credit_leases.available if credit_leases is not None else (lambda user_id: 0)
+    return {user_id: found.get(user_id, 0) + leased(user_id) for user_id in user_ids}
+
+def reserve_credits(user_id: int, amount: int = 1) -> int | None:
+    """
+    Riserva `amount` crediti con una sola operazione atomica (RPC `reserve_credits` su Supabase).
+    Restituisce il nuovo saldo, -1 se i crediti non bastano, None in caso di errore.
+    """
+    if credit_leases is not None:
+        return credit_leases.reserve(user_id, amount)
+
+    if not credit_store.available():
+        return None
+
+    try:
+        with metrics.span(credit_store.stage, op="reserve_credits"):
+            return credit_store.reserve(user_id, amount)
+    except Exception as e:
+        print(f"Errore {credit_store.name} (reserve_credits): {e}")
+        return None
+
+def refund_credits(user_id: int, amount: int = 1) -> int | None:
+    """Restituisce `amount` crediti riservati in precedenza. Restituisce il nuovo saldo o None in caso di errore."""
+    if credit_leases is not None:
+        new_credits = credit_leases.refund(user_id, amount)
+        if new_credits is not None:
+            return new_credits
+
+    if not credit_store.available():
+        return None
+
+    try:
+        with metrics.span(credit_store.stage, op="refund_credits"):
+            return credit_store.refund(user_id, amount)
+    except Exception as e:
+        print(f"Errore {credit_store.name} (refund_credits): {e}")
+        return None
+
+def is_paying_user(user_id: int) -> bool:
+    """True se l'utente ha almeno un acquisto registrato nella tabella `stripe_events`."""
+    if not credit_store.available():
+        return False
+
+    try:
+        with metrics.span(credit_store.stage, op="select_stripe_events"):
+            return credit_store.is_paying(user_id)
+    except Exception as e:
+        print(f"Errore {credit_store.name} (is_paying_user): {e}")
+        return False
+
+def apply_stripe_event(event_id: str, user_id: int, amount: int) -> int | None:
+    """
+    Accredita `amount` crediti per l'evento Stripe `event_id`, una sola volta (RPC `apply_stripe_event` su Supabase).
+    Registrazione dell'evento e accredito avvengono nella stessa transazione.
+    Restituisce il nuovo saldo, -1 se l'evento era già stato applicato, None in caso di errore.
+    """
+    if not credit_store.available():
+        return None
+
+    try:
+        with metrics.span(credit_store.stage, op="apply_stripe_event"):
+            new_credits = credit_store.apply_stripe_event(event_id, user_id, amount)
+        if credit_leases is not None and new_credits != -1:
+            credit_leases.invalidate(user_id)
+        return new_credits
+    except Exception as e:
+        print(f"Errore {credit_store.name} (apply_stripe_event): {e}")
+        return None
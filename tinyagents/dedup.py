@@ -0,0 +1,164 @@
+"""
+Deduplicazione degli update di Telegram.
+
+Quando il webhook risponde lentamente, Telegram invia di nuovo lo stesso
+update (stesso `update_id`). Il deduplicatore ricorda gli `update_id` visti
+nell'ultima finestra temporale, così le riconsegne vengono scartate prima di
+qualsiasi chiamata a Supabase o Groq.
+
+- Il set in memoria è limitato sia nel tempo (`UPDATE_DEDUP_WINDOW`) sia nel
+  numero di elementi (`UPDATE_DEDUP_SIZE`): gli id più vecchi escono per primi.
+- Con `UPDATE_DEDUP_BACKEND=sqlite` gli id vengono registrati anche in un file
+  SQLite condiviso, per riconoscere le riconsegne arrivate a un altro processo
+  della stessa macchina.
+- Con `UPDATE_DEDUP_BACKEND=supabase` gli id vengono registrati su Supabase
+  (funzione `mark_update_seen` di `sql/dedup.sql`): è il backend da usare su
+  Vercel, dove ogni istanza ha la propria `/tmp` e una riconsegna può arrivare
+  a un'istanza diversa.
+"""
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from tinyagents import metrics
+from tinyagents.clients import get_supabase_client
+
+# --- CONFIGURAZIONE ---
+UPDATE_DEDUP_BACKEND = os.environ.get('UPDATE_DEDUP_BACKEND', 'memory')
+UPDATE_DEDUP_PATH = os.environ.get('UPDATE_DEDUP_PATH', '/tmp/tinyagents_updates.sqlite3')
+UPDATE_DEDUP_WINDOW = float(os.environ.get('UPDATE_DEDUP_WINDOW', '3600'))
+UPDATE_DEDUP_SIZE = int(os.environ.get('UPDATE_DEDUP_SIZE', '10000'))
+
+
+class MemorySeenSet:
+    """Insieme limitato degli id visti di recente, in ordine di arrivo."""
+
+    def __init__(self, window: float = UPDATE_DEDUP_WINDOW, maxsize: int = UPDATE_DEDUP_SIZE, clock=time.monotonic):
+        self.window = window
+        self.maxsize = maxsize
+        self.clock = clock
+        self._seen = OrderedDict()
+        self._lock = threading.Lock()
+
+    def check_and_add(self, item_id) -> bool:
+        """Registra `item_id` e restituisce True se era già stato visto."""
+        with self._lock:
+            if self._contains(item_id):
+                return True
+            self._add(item_id)
+            return False
+
+    def add(self, item_id):
+        """Registra `item_id` come visto."""
+        with self._lock:
+            self._add(item_id)
+
+    def __contains__(self, item_id) -> bool:
+        with self._lock:
+            return self._contains(item_id)
+
+    def _contains(self, item_id) -> bool:
+        seen_at = self._seen.get(item_id)
+        return seen_at is not None and seen_at > self.clock() - self.window
+
+    def _add(self, item_id):
+        now = self.clock()
+        # Gli elementi più vecchi sono in testa: basta scartarli finché sono scaduti
+        while self._seen and (len(self._seen) >= self.maxsize or next(iter(self._seen.values())) <= now - self.window):
+            self._seen.popitem(last=False)
+        self._seen.pop(item_id, None)
+        self._seen[item_id] = now
+
+    def __len__(self):
+        return len(self._seen)
+
+
+class SQLiteSeenSet:
+    """Insieme degli id visti, persistente e condiviso tra processi tramite SQLite."""
+
+    def __init__(self, path: str = UPDATE_DEDUP_PATH, window: float = UPDATE_DEDUP_WINDOW, clock=time.time):
+        self.window = window
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._inserts = 0
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=5.0)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS seen_updates ("
+            " update_id INTEGER PRIMARY KEY,"
+            " seen_at REAL NOT NULL)"
+        )
+
+    def check_and_add(self, item_id) -> bool:
+        """Registra `item_id` e restituisce True se era già stato visto."""
+        now = self.clock()
+        with self._lock:
+            # Un id visto fuori dalla finestra ma non ancora eliminato conta come nuovo
+            cursor = self._conn.execute(
+                "INSERT INTO seen_updates (update_id, seen_at) VALUES (?, ?)"
+                " ON CONFLICT (update_id) DO UPDATE SET seen_at = excluded.seen_at WHERE seen_at <= ?",
+                (item_id, now, now - self.window),
+            )
+            if cursor.rowcount == 0:
+                return True
+            # Pulizia periodica degli id fuori dalla finestra
+            self._inserts += 1
+            if self._inserts % 1000 == 0:
+                self._conn.execute("DELETE FROM seen_updates WHERE seen_at <= ?", (now - self.window,))
+            return False
+
+
+class SupabaseSeenSet:
+    """Insieme degli id visti condiviso da tutte le istanze, aggiornato in un'unica chiamata RPC."""
+
+    def __init__(self, window: float = UPDATE_DEDUP_WINDOW):
+        self.window = window
+
+    def check_and_add(self, item_id) -> bool:
+        """Registra `item_id` e restituisce True se era già stato visto."""
+        supabase_client = get_supabase_client()
+        if not supabase_client:
+            return False
+        with metrics.span("supabase", op="mark_update_seen"):
+            response = supabase_client.rpc('mark_update_seen', {
+                "p_update_id": item_id, "p_window_seconds": int(self.window),
+            }).execute()
+        return bool(response.data)
+
+
+class UpdateDeduplicator:
+    """Riconosce le riconsegne dello stesso `update_id` e conta quante ne sono state assorbite."""
+
+    def __init__(self, shared=None):
+        self.local = MemorySeenSet()
+        self.shared = shared
+        self.duplicates = 0
+
+    def is_duplicate(self, update_id) -> bool:
+        if update_id is None:
+            return False
+        duplicate = self.local.check_and_add(update_id)
+        if not duplicate and self.shared is not None:
+            try:
+                duplicate = self.shared.check_and_add(update_id)
+            except Exception as e:
+                print(f"Errore del backend di deduplicazione: {e}")
+        if duplicate:
+            self.duplicates += 1
+            metrics.inc("tinyagents_update_duplicates_total")
+        return duplicate
+
+
+def create_deduplicator(backend: str = UPDATE_DEDUP_BACKEND) -> UpdateDeduplicator | None:
+    """Crea il deduplicatore configurato tramite `UPDATE_DEDUP_BACKEND` (`memory`, `sqlite`, `supabase` o `off`)."""
+    if backend == 'off':
+        return None
+    if backend == 'memory':
+        return UpdateDeduplicator()
+    if backend == 'sqlite':
+        return UpdateDeduplicator(shared=SQLiteSeenSet())
+    if backend == 'supabase':
+        return UpdateDeduplicator(shared=SupabaseSeenSet())
+    raise ValueError(f"Backend di deduplicazione non supportato: {backend}")
@@ -0,0 +1,73 @@
+"""
+Esecuzione di più agenti sulla stessa richiesta (`/multi`).
+
+`/multi meme_persona,tweet_generator,seo_optimizer <richiesta>` interroga gli
+agenti indicati in parallelo: i crediti vengono riservati tutti insieme con
+una sola operazione, le chiamate a Groq partono contemporaneamente su un pool
+di thread condiviso dall'istanza e ogni risposta viene inviata appena è
+pronta. Il tempo totale è quello dell'agente più lento, non la somma.
+
+Gli agenti falliti vengono rimborsati insieme alla fine, con una sola
+operazione.
+"""
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from tinyagents import metrics
+
+# --- CONFIGURAZIONE ---
+# Numero massimo di agenti per comando (ognuno costa un credito)
+MULTI_AGENT_MAX = int(os.environ.get('MULTI_AGENT_MAX', '5'))
+MULTI_AGENT_WORKERS = int(os.environ.get('MULTI_AGENT_WORKERS', '32'))
+
+MULTI_COMMAND = "multi"
+
+
+def parse_agent_list(args: str, agents, limit: int = MULTI_AGENT_MAX):
+    """
+    Divide `agente1,agente2 richiesta` in (agenti, richiesta).
+    Solleva ValueError con un messaggio per l'utente (testo semplice) se l'elenco non è valido.
+    """
+    parts = args.split(None, 1)
+    if len(parts) < 2:
+        raise ValueError(f"Uso corretto: /{MULTI_COMMAND} agente1,agente2 [la tua richiesta]")
+    names = []
+    for name in parts[0].lower().split(','):
+        name = name.strip().lstrip('/')
+        if name and name not in names:
+            names.append(name)
+    unknown = [name for name in names if name not in agents]
+    if unknown:
+        raise ValueError(f"Agenti non validi: {', '.join(unknown)}. Usa /start per vedere la lista degli agenti disponibili.")
+    if not names:
+        raise ValueError(f"Uso corretto: /{MULTI_COMMAND} agente1,agente2 [la tua richiesta]")
+    if len(names) > limit:
+        raise ValueError(f"Puoi usare al massimo {limit} agenti per richiesta.")
+    return names, parts[1].strip()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _get_pool() -> ThreadPoolExecutor:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=MULTI_AGENT_WORKERS, thread_name_prefix="multi-agent")
+        return _pool
+
+
+def run_concurrently(names, call):
+    """
+    Esegue `call(nome)` per ogni agente in parallelo e produce (nome, risposta, errore)
+    nell'ordine di completamento.
+    """
+    pool = _get_pool()
+    futures = {metrics.submit(pool, call, name): name for name in names}
+    for future in as_completed(futures):
+        name = futures[future]
+        error = future.exception()
+        metrics.inc("tinyagents_multi_agent_calls_total", result="error" if error else "ok")
+        yield name, None if error else future.result(), error
@@ -0,0 +1,261 @@
+"""
+Instradamento delle chiamate all'LLM: richieste "hedged" e circuit breaker.
+
+Con `LLM_HEDGING=true`, se il modello principale non ha risposto entro il
+percentile `LLM_HEDGE_PERCENTILE` delle sue latenze recenti, la stessa
+richiesta parte anche verso il modello di riserva dell'agente
+(`fallback_model` in agents.json). Vince la prima risposta valida; l'altra
+chiamata viene abbandonata (annullata se non è ancora partita, altrimenti il
+suo risultato viene scartato) ed è comunque limitata da `LLM_TIMEOUT`.
+
+Ogni modello ha un circuit breaker: dopo `LLM_BREAKER_FAILURES` errori o
+timeout consecutivi il modello non riceve richieste per `LLM_BREAKER_COOLDOWN`
+secondi, e le chiamate vanno direttamente al modello di riserva.
+
+Metriche per la taratura della soglia:
+
+- `tinyagents_llm_hedges_total{agent,winner}`: richieste duplicate e chi ha vinto
+  (`primary`, `hedge`, `none` se nessuna delle due ha risposto);
+- `tinyagents_llm_hedge_wasted_tokens_total{model}`: token spesi dalle chiamate scartate;
+- `tinyagents_llm_breaker_trips_total{model}`: aperture dei circuit breaker.
+"""
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from tinyagents import metrics
+
+# --- CONFIGURAZIONE ---
+LLM_HEDGING = os.environ.get('LLM_HEDGING', '').lower() in ('1', 'true', 'yes')
+LLM_HEDGE_PERCENTILE = float(os.environ.get('LLM_HEDGE_PERCENTILE', '95'))
+# Soglia usata finché non ci sono abbastanza latenze osservate, e soglia minima
+LLM_HEDGE_INITIAL_DELAY = float(os.environ.get('LLM_HEDGE_INITIAL_DELAY', '2.0'))
+LLM_HEDGE_MIN_DELAY = float(os.environ.get('LLM_HEDGE_MIN_DELAY', '0.5'))
+LLM_HEDGE_WORKERS = int(os.environ.get('LLM_HEDGE_WORKERS', '16'))
+LLM_TIMEOUT = float(os.environ.get('LLM_TIMEOUT', '30'))
+LLM_BREAKER_FAILURES = int(os.environ.get('LLM_BREAKER_FAILURES', '5'))
+LLM_BREAKER_COOLDOWN = float(os.environ.get('LLM_BREAKER_COOLDOWN', '30'))
+
+# Latenze osservate per modello e numero minimo per calcolare il percentile
+LATENCY_WINDOW = 200
+MIN_SAMPLES = 20
+
+
+class LatencyWindow:
+    """Ultime latenze (secondi) delle chiamate riuscite a un modello."""
+
+    def __init__(self, size: int = LATENCY_WINDOW):
+        self._samples = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def add(self, seconds: float):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentile(self, pct: float) -> float | None:
+        """Percentile delle latenze recenti, o None se i campioni sono troppo pochi."""
+        with self._lock:
+            if len(self._samples) < MIN_SAMPLES:
+                return None
+            ordered = sorted(self._samples)
+        index = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered))) - 1))
+        return ordered[index]
+
+
+class CircuitBreaker:
+    """Circuit breaker per modello: chiuso, aperto dopo errori ripetuti, semiaperto dopo il cooldown."""
+
+    def __init__(self, name: str, failures: int = LLM_BREAKER_FAILURES, cooldown: float = LLM_BREAKER_COOLDOWN, clock=time.monotonic):
+        self.name = name
+        self.max_failures = failures
+        self.cooldown = cooldown
+        self.clock = clock
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._state()
+
+    def _state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if self.clock() - self.opened_at >= self.cooldown:
+            return "half_open"
+        return "open"
+
+    def allow(self) -> bool:
+        """True se il modello può ricevere richieste (nello stato semiaperto passa una richiesta di prova)."""
+        with self._lock:
+            state = self._state()
+            if state == "half_open":
+                # Una sola richiesta di prova per cooldown
+                self.opened_at = self.clock()
+                return True
+            return state == "closed"
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.max_failures:
+                if self.opened_at is None:
+                    metrics.inc("tinyagents_llm_breaker_trips_total", model=self.name)
+                    print(f"Circuit breaker aperto per il modello {self.name} dopo {self.failures} errori consecutivi.")
+                self.opened_at = self.clock()
+
+
+class LLMRouter:
+    """Esegue le chiamate a Groq scegliendo il modello e, se attivo, duplicando le richieste lente."""
+
+    def __init__(self, client_factory, hedging: bool = LLM_HEDGING, percentile: float = LLM_HEDGE_PERCENTILE,
+                 initial_delay: float = LLM_HEDGE_INITIAL_DELAY, min_delay: float = LLM_HEDGE_MIN_DELAY,
+                 timeout: float = LLM_TIMEOUT, workers: int = LLM_HEDGE_WORKERS):
+        self.client_factory = client_factory
+        self.hedging = hedging
+        self.percentile = percentile
+        self.initial_delay = initial_delay
+        self.min_delay = min_delay
+        self.timeout = timeout
+        self.workers = workers
+        self._breakers = {}
+        self._latencies = {}
+        self._lock = threading.Lock()
+        self._pool = None
+
+    # --- Stato per modello ---
+
+    def breaker(self, model: str) -> CircuitBreaker:
+        with self._lock:
+            if model not in self._breakers:
+                self._breakers[model] = CircuitBreaker(model)
+            return self._breakers[model]
+
+    def latencies(self, model: str) -> LatencyWindow:
+        with self._lock:
+            if model not in self._latencies:
+                self._latencies[model] = LatencyWindow()
+            return self._latencies[model]
+
+    def hedge_delay(self, model: str) -> float:
+        """Attesa prima di duplicare la richiesta: percentile delle latenze recenti del modello."""
+        observed = self.latencies(model).percentile(self.percentile)
+        if observed is None:
+            return self.initial_delay
+        return max(self.min_delay, observed)
+
+    def select_model(self, primary: str, fallback: str | None) -> str:
+        """Il modello principale, o quello di riserva se il circuit breaker del principale è aperto."""
+        if self.breaker(primary).allow():
+            return primary
+        if fallback and fallback != primary and self.breaker(fallback).allow():
+            return fallback
+        # Tutti i modelli sono in errore: si riprova comunque il principale
+        return primary
+
+    def backup_for(self, model: str, primary: str, fallback: str | None) -> str | None:
+        """L'altro modello dell'agente, se il suo circuit breaker lo consente."""
+        other = fallback if model == primary else primary
+        if other and other != model and self.breaker(other).allow():
+            return other
+        return None
+
+    def record(self, model: str, seconds: float, ok: bool):
+        """Aggiorna latenze e circuit breaker dopo una chiamata."""
+        if ok:
+            self.latencies(model).add(seconds)
+            self.breaker(model).record_success()
+        else:
+            self.breaker(model).record_failure()
+
+    # --- Chiamate ---
+
+    def _get_pool(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="llm-hedge")
+            return self._pool
+
+    def _call(self, agent: str, params: dict, model: str, role: str):
+        client = self.client_factory()
+        started = time.perf_counter()
+        try:
+            with metrics.span("llm", agent=agent, model=model, role=role):
+                completion = client.chat.completions.create(**{**params, "model": model}, timeout=self.timeout)
+        except Exception:
+            self.record(model, time.perf_counter() - started, ok=False)
+            raise
+        self.record(model, time.perf_counter() - started, ok=True)
+        metrics.record_llm_usage(agent, getattr(completion, "usage", None), model)
+        return completion
+
+    def complete(self, agent: str, params: dict, fallback: str | None = None):
+        """
+        Esegue la chat completion e restituisce (risposta, modello usato).
+        Solleva l'ultima eccezione se nessun modello risponde.
+        """
+        primary = params["model"]
+        first = self.select_model(primary, fallback)
+        if not self.hedging:
+            try:
+                return self._call(agent, params, first, "primary"), first
+            except Exception:
+                # Senza hedging il modello di riserva viene usato solo dopo un errore
+                backup = self.backup_for(first, primary, fallback)
+                if backup is None:
+                    raise
+            return self._call(agent, params, backup, "fallback"), backup
+
+        pool = self._get_pool()
+        futures = {metrics.submit(pool, self._call, agent, params, first, "primary"): (first, "primary")}
+        hedge_at = time.monotonic() + self.hedge_delay(first)
+        hedged = False
+        error = None
+
+        while futures or not hedged:
+            done = set()
+            if futures:
+                timeout = None if hedged else max(0.0, hedge_at - time.monotonic())
+                done, _ = wait(futures, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                model, role = futures.pop(future)
+                if future.exception() is None:
+                    self._abandon(futures)
+                    if hedged:
+                        metrics.inc("tinyagents_llm_hedges_total", agent=agent, winner=role)
+                    return future.result(), model
+                error = future.exception()
+
+            # Il modello principale è lento (o è già fallito): la richiesta parte anche verso l'altro
+            if not hedged and (not done or not futures):
+                hedged = True
+                backup = self.backup_for(first, primary, fallback)
+                if backup is not None:
+                    futures[metrics.submit(pool, self._call, agent, params, backup, "hedge")] = (backup, "hedge")
+                    metrics.log_event("llm_hedge", agent=agent, primary=first, hedge=backup, after_error=bool(done))
+
+        metrics.inc("tinyagents_llm_hedges_total", agent=agent, winner="none")
+        raise error
+
+    def _abandon(self, futures: dict):
+        """Abbandona le chiamate perdenti: i token che consumeranno sono costo extra dell'hedging."""
+        for future, (model, _) in futures.items():
+            if not future.cancel():
+                future.add_done_callback(lambda f, model=model: self._count_wasted(f, model))
+
+    @staticmethod
+    def _count_wasted(future, model: str):
+        if future.cancelled() or future.exception() is not None:
+            return
+        usage = getattr(future.result(), "usage", None)
+        total = getattr(usage, "total_tokens", None) if usage is not None else None
+        if total:
+            metrics.inc("tinyagents_llm_hedge_wasted_tokens_total", total, model=model)
@@ -0,0 +1,172 @@
+"""
+Coda dei job per l'elaborazione asincrona degli update ("ack-first").
+
+Il webhook valida l'update, lo mette in coda e risponde subito 200 a Telegram;
+un pool di worker con concorrenza limitata esegue poi il lavoro degli agenti.
+Il backend della coda è intercambiabile:
+
+- `memory`: coda in-process (`queue.Queue`), la più veloce;
+- `sqlite`: coda persistente su un file SQLite locale, utile nei test e per
+  non perdere i job se il processo si riavvia.
+
+Nota: su Vercel un'istanza può essere sospesa appena la risposta è stata
+inviata. Questa modalità è pensata per istanze a lunga vita (es. self-hosting).
+"""
+import itertools
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+# --- CONFIGURAZIONE ---
+JOB_QUEUE_BACKEND = os.environ.get('JOB_QUEUE_BACKEND', 'memory')
+JOB_QUEUE_PATH = os.environ.get('JOB_QUEUE_PATH', '/tmp/tinyagents_jobs.sqlite3')
+# Numero massimo di job in attesa: oltre questo limite `put` rifiuta il job
+JOB_QUEUE_SIZE = int(os.environ.get('JOB_QUEUE_SIZE', '1000'))
+# Numero di worker, cioè di update elaborati in parallelo
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', '4'))
+
+
+class InProcessQueue:
+    """Coda in memoria, condivisa dai thread della stessa istanza."""
+
+    def __init__(self, maxsize: int = JOB_QUEUE_SIZE):
+        self._queue = queue.Queue(maxsize)
+        self._ids = itertools.count(1)
+
+    def put(self, payload: dict) -> bool:
+        """Accoda un job. Restituisce False se la coda è piena."""
+        try:
+            self._queue.put_nowait((next(self._ids), payload))
+            return True
+        except queue.Full:
+            return False
+
+    def get(self, timeout: float | None = None):
+        """Restituisce il prossimo job come `(job_id, payload)`, o None allo scadere del timeout."""
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def ack(self, job_id):
+        """Segna come completato un job restituito da `get`."""
+        self._queue.task_done()
+
+    def __len__(self):
+        return self._queue.qsize()
+
+    def unfinished(self) -> int:
+        """Job accodati e non ancora completati (in attesa o in corso)."""
+        return self._queue.unfinished_tasks
+
+
+class SQLiteQueue:
+    """Coda persistente su SQLite. I job rimasti 'running' dopo un crash tornano in coda."""
+
+    def __init__(self, path: str = JOB_QUEUE_PATH, maxsize: int = JOB_QUEUE_SIZE, poll_interval: float = 0.05):
+        self.maxsize = maxsize
+        self.poll_interval = poll_interval
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " payload TEXT NOT NULL,"
+            " status TEXT NOT NULL DEFAULT 'pending',"
+            " created_at REAL NOT NULL)"
+        )
+        self._conn.execute("UPDATE jobs SET status = 'pending' WHERE status = 'running'")
+
+    def put(self, payload: dict) -> bool:
+        """Accoda un job. Restituisce False se la coda è piena."""
+        with self._lock:
+            if self._pending_count() >= self.maxsize:
+                return False
+            self._conn.execute(
+                "INSERT INTO jobs (payload, created_at) VALUES (?, ?)",
+                (json.dumps(payload), time.time()),
+            )
+        return True
+
+    def get(self, timeout: float | None = None):
+        """Prende in carico il job più vecchio, attendendo al massimo `timeout` secondi."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._lock:
+                row = self._conn.execute(
+                    "UPDATE jobs SET status = 'running'"
+                    " WHERE id = (SELECT id FROM jobs WHERE status = 'pending' ORDER BY id LIMIT 1)"
+                    " RETURNING id, payload"
+                ).fetchone()
+            if row:
+                return row[0], json.loads(row[1])
+            if deadline is not None and time.monotonic() >= deadline:
+                return None
+            time.sleep(self.poll_interval)
+
+    def ack(self, job_id):
+        """Elimina un job completato."""
+        with self._lock:
+            self._conn.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+
+    def _pending_count(self) -> int:
+        return self._conn.execute("SELECT COUNT(*) FROM jobs WHERE status = 'pending'").fetchone()[0]
+
+    def __len__(self):
+        with self._lock:
+            return self._pending_count()
+
+    def unfinished(self) -> int:
+        """Job accodati e non ancora completati (in attesa o in corso)."""
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM jobs").fetchone()[0]
+
+
+def create_job_queue(backend: str = JOB_QUEUE_BACKEND):
+    """Crea la coda configurata tramite `JOB_QUEUE_BACKEND` (`memory` o `sqlite`)."""
+    if backend == 'memory':
+        return InProcessQueue()
+    if backend == 'sqlite':
+        return SQLiteQueue()
+    raise ValueError(f"Backend della coda non supportato: {backend}")
+
+
+class WorkerPool:
+    """Pool di thread che eseguono `handler(payload)` per ogni job in coda."""
+
+    def __init__(self, job_queue, handler, concurrency: int = JOB_WORKERS):
+        self.queue = job_queue
+        self.handler = handler
+        self.concurrency = concurrency
+        self._threads = []
+        self._stop = threading.Event()
+
+    def start(self):
+        for i in range(self.concurrency):
+            thread = threading.Thread(target=self._run, name=f"tinyagents-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def stop(self, timeout: float | None = None):
+        """Ferma i worker dopo il job in corso."""
+        self._stop.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def _run(self):
+        while not self._stop.is_set():
+            job = self.queue.get(timeout=0.5)
+            if job is None:
+                continue
+            job_id, payload = job
+            try:
+                self.handler(payload)
+            except Exception as e:
+                print(f"ERRORE WORKER (job {job_id}): {e}")
+            finally:
+                self.queue.ack(job_id)
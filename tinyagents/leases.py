@@ -0,0 +1,201 @@
+"""
+Lease dei crediti: blocchi di crediti consumati in locale.
+
+Con `CREDIT_LEASES=true`, al primo comando di un utente l'istanza preleva dal
+saldo un blocco di min(saldo, `CREDIT_LEASE_SIZE`) crediti (RPC
+`lease_credits` di `sql/leases.sql`, o la stessa operazione su SQLite) e i
+comandi successivi lo consumano in memoria, senza chiamate al database. Il
+blocco viene chiuso, restituendo i crediti non usati (`return_credit_lease`):
+
+- quando scade (`CREDIT_LEASE_TTL` secondi) o si esaurisce;
+- quando l'istanza si chiude normalmente (`atexit`);
+- dopo una ricarica Stripe (`invalidate`), così il saldo mostrato include la
+  ricarica.
+
+I lease ancora attivi delle altre istanze non vengono mai recuperati: quelle
+istanze continuerebbero a spendere la propria copia locale dei crediti. Prima
+di rifiutare un comando `lease_credits` recupera solo i lease scaduti.
+
+Se un'istanza termina senza restituire il lease, il database lo recupera per
+intero dopo il doppio del TTL. Su Vercel le istanze vengono sospese senza
+preavviso: questa modalità è pensata per processi a lunga vita come il runner
+in long polling (`tinyagents/polling.py`).
+"""
+import atexit
+import os
+import threading
+import time
+
+from tinyagents import metrics
+
+# --- CONFIGURAZIONE ---
+CREDIT_LEASES = os.environ.get('CREDIT_LEASES', '').lower() in ('1', 'true', 'yes')
+CREDIT_LEASE_SIZE = int(os.environ.get('CREDIT_LEASE_SIZE', '10'))
+CREDIT_LEASE_TTL = float(os.environ.get('CREDIT_LEASE_TTL', '60'))
+
+# Lock per gruppi di utenti: le richieste dello stesso utente sono serializzate
+_LOCK_STRIPES = 64
+
+
+class CreditLease:
+    """Blocco di crediti prelevato dal saldo di un utente."""
+
+    def __init__(self, lease_id, user_id, granted: int, balance: int, expires_at: float):
+        self.lease_id = lease_id
+        self.user_id = user_id
+        self.granted = granted
+        # Saldo rimasto sul database al momento del prelievo
+        self.balance = balance
+        self.expires_at = expires_at
+        self.used = 0
+
+    @property
+    def remaining(self) -> int:
+        return self.granted - self.used
+
+
+class CreditLeaseManager:
+    """Lease dei crediti di questa istanza, indicizzati per utente."""
+
+    def __init__(self, store, size: int = CREDIT_LEASE_SIZE, ttl: float = CREDIT_LEASE_TTL, clock=time.monotonic):
+        self.store = store
+        self.size = size
+        self.ttl = ttl
+        self.clock = clock
+        self._leases = {}
+        self._stripes = [threading.Lock() for _ in range(_LOCK_STRIPES)]
+        self._sweeper = None
+        self._sweeper_lock = threading.Lock()
+
+    def _user_lock(self, user_id) -> threading.Lock:
+        return self._stripes[hash(user_id) % _LOCK_STRIPES]
+
+    def _live_lease(self, user_id) -> CreditLease | None:
+        lease = self._leases.get(user_id)
+        if lease is not None and lease.expires_at > self.clock():
+            return lease
+        return None
+
+    # --- Operazioni sui crediti ---
+
+    def reserve(self, user_id, amount: int = 1) -> int | None:
+        """
+        Consuma `amount` crediti dal lease dell'utente, prelevandone uno nuovo se serve.
+        Restituisce il saldo rimanente, -1 se i crediti non bastano, None in caso di errore.
+        """
+        with self._user_lock(user_id):
+            lease = self._live_lease(user_id)
+            if lease is not None and lease.remaining >= amount:
+                lease.used += amount
+                metrics.inc("tinyagents_credit_leases_total", result="local")
+                return lease.balance + lease.remaining
+
+            # Lease scaduto o insufficiente: si chiude e se ne preleva uno nuovo
+            if user_id in self._leases:
+                self._close(self._leases.pop(user_id))
+            lease = self._acquire(user_id, amount)
+            if lease is None:
+                metrics.inc("tinyagents_credit_leases_total", result="error")
+                return None
+            if lease.lease_id is None:
+                metrics.inc("tinyagents_credit_leases_total", result="insufficient")
+                return -1
+            lease.used += amount
+            self._leases[user_id] = lease
+            metrics.inc("tinyagents_credit_leases_total", result="leased")
+        self._ensure_sweeper()
+        return lease.balance + lease.remaining
+
+    def refund(self, user_id, amount: int = 1) -> int | None:
+        """
+        Restituisce al lease `amount` crediti riservati con `reserve`.
+        Restituisce None se il lease non è più attivo: il rimborso va fatto sul database.
+        """
+        with self._user_lock(user_id):
+            lease = self._live_lease(user_id)
+            if lease is None or lease.used < amount:
+                return None
+            lease.used -= amount
+            return lease.balance + lease.remaining
+
+    def available(self, user_id) -> int:
+        """Crediti ancora disponibili nel lease dell'utente (0 se non ce n'è uno attivo)."""
+        lease = self._live_lease(user_id)
+        return lease.remaining if lease is not None else 0
+
+    def invalidate(self, user_id):
+        """Chiude il lease dell'utente in questa istanza (es. dopo una ricarica)."""
+        with self._user_lock(user_id):
+            lease = self._leases.pop(user_id, None)
+            if lease is not None:
+                self._close(lease)
+
+    def release_all(self):
+        """Restituisce tutti i lease (chiusura dell'istanza)."""
+        for user_id in list(self._leases):
+            with self._user_lock(user_id):
+                lease = self._leases.pop(user_id, None)
+                if lease is not None:
+                    self._close(lease)
+
+    # --- Database ---
+
+    def _acquire(self, user_id, amount: int) -> CreditLease | None:
+        if not self.store.available():
+            return None
+        try:
+            with metrics.span(self.store.stage, op="lease_credits"):
+                # Il database recupera il lease solo dopo il doppio del TTL locale
+                lease_id, leased, balance = self.store.lease(user_id, amount, max(self.size, amount), self.ttl * 2)
+            return CreditLease(lease_id, user_id, leased, balance, self.clock() + self.ttl)
+        except Exception as e:
+            print(f"Errore {self.store.name} (lease_credits): {e}")
+            return None
+
+    def _close(self, lease: CreditLease):
+        if not self.store.available():
+            return
+        try:
+            with metrics.span(self.store.stage, op="return_credit_lease"):
+                self.store.return_lease(lease.lease_id, lease.user_id, lease.used)
+        except Exception as e:
+            # Il lease resta sul database e verrà recuperato alla scadenza
+            print(f"Errore {self.store.name} (return_credit_lease): {e}")
+
+    # --- Scadenza ---
+
+    def _ensure_sweeper(self):
+        if self._sweeper is not None:
+            return
+        with self._sweeper_lock:
+            if self._sweeper is None:
+                self._sweeper = threading.Thread(target=self._sweep_forever, name="tinyagents-leases", daemon=True)
+                self._sweeper.start()
+
+    def _sweep_forever(self):
+        while True:
+            time.sleep(max(1.0, self.ttl / 4))
+            try:
+                self.sweep()
+            except Exception as e:
+                print(f"Errore durante la restituzione dei lease scaduti: {e}")
+
+    def sweep(self):
+        """Restituisce i lease scaduti."""
+        now = self.clock()
+        for user_id, lease in list(self._leases.items()):
+            if lease.expires_at > now:
+                continue
+            with self._user_lock(user_id):
+                if self._leases.get(user_id) is lease:
+                    del self._leases[user_id]
+                    self._close(lease)
+
+
+def create_credit_leases(store, enabled: bool = CREDIT_LEASES) -> CreditLeaseManager | None:
+    """Crea il gestore dei lease sull'archivio dei crediti `store`, se `CREDIT_LEASES` è attivo."""
+    if not enabled:
+        return None
+    manager = CreditLeaseManager(store)
+    atexit.register(manager.release_all)
+    return manager
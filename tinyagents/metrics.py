@@ -0,0 +1,230 @@
+"""
+Strumentazione della pipeline delle richieste.
+
+Ogni fase (parsing, chiamate a Supabase, Groq, Telegram e Stripe) viene
+misurata con `span(stage, **tags)`. Le misure finiscono in:
+
+- istogrammi e contatori in memoria, esportati in formato Prometheus da
+  `render_prometheus()` (vedi `GET /api/metrics`);
+- una riga di log JSON per span (disattivabile con `METRICS_LOG=false`),
+  utile per aggregare i dati di più istanze tramite i log di Vercel.
+
+Ogni misura ha il tag `instance`: `cold` per la prima richiesta servita
+dall'istanza, `warm` per le successive.
+"""
+import contextvars
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+# --- CONFIGURAZIONE ---
+METRICS_LOG = os.environ.get('METRICS_LOG', 'true').lower() in ('1', 'true', 'yes')
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+STAGE_SECONDS = "tinyagents_stage_duration_seconds"
+STAGE_ERRORS = "tinyagents_stage_errors_total"
+
+_HELP = {
+    STAGE_SECONDS: "Durata delle fasi della pipeline delle richieste",
+    STAGE_ERRORS: "Fasi terminate con un'eccezione",
+    "tinyagents_llm_tokens_total": "Token consumati su Groq, per agente",
+    "tinyagents_llm_cache_hits_total": "Risposte servite dalla cache dell'LLM",
+    "tinyagents_llm_cache_misses_total": "Richieste non trovate nella cache dell'LLM",
+    "tinyagents_update_duplicates_total": "Riconsegne di update Telegram scartate",
+    "tinyagents_stripe_duplicates_total": "Eventi Stripe già applicati ricevuti di nuovo",
+    "tinyagents_llm_hedges_total": "Richieste all'LLM duplicate verso il modello di riserva, per vincitore",
+    "tinyagents_llm_hedge_wasted_tokens_total": "Token consumati dalle chiamate all'LLM scartate dall'hedging",
+    "tinyagents_llm_breaker_trips_total": "Aperture del circuit breaker, per modello",
+    "tinyagents_admission_total": "Richieste agli agenti ammesse o rifiutate dal controllo di ammissione",
+    "tinyagents_credit_leases_total": "Riserve di crediti servite dal lease locale, con un nuovo lease o rifiutate",
+    "tinyagents_credits_api_total": "Risposte di /api/credits per stato e origine del saldo (cache o database)",
+    "tinyagents_multi_agent_calls_total": "Chiamate agli agenti del comando /multi, riuscite o fallite",
+    "tinyagents_telegram_sends_total": "Messaggi verso Telegram: inviati, ritardati, 429, ripetuti senza Markdown, scartati, in errore o nella risposta al webhook",
+    "tinyagents_poll_updates_total": "Update ricevuti con getUpdates e accodati ai worker del polling",
+}
+
+_lock = threading.Lock()
+_histograms = {}
+_counters = {}
+
+_request_instance = contextvars.ContextVar('tinyagents_instance', default='warm')
+_cold_request_pending = True
+_started_at = time.time()
+
+
+def _key(name, tags):
+    return name, tuple(sorted((k, str(v)) for k, v in tags.items() if v is not None))
+
+
+# --- CONTESTO DELLA RICHIESTA ---
+
+def begin_request() -> str:
+    """Segna l'inizio di una richiesta e restituisce il suo stato (`cold` o `warm`)."""
+    global _cold_request_pending
+    with _lock:
+        state = 'cold' if _cold_request_pending else 'warm'
+        _cold_request_pending = False
+    _request_instance.set(state)
+    return state
+
+
+def submit(pool, fn, *args):
+    """
+    Esegue `fn(*args)` in un pool di thread con il contesto della richiesta corrente:
+    i thread del pool non ereditano il tag `instance` (`cold`/`warm`).
+    """
+    return pool.submit(contextvars.copy_context().run, fn, *args)
+
+
+# --- REGISTRAZIONE ---
+
+def observe(name: str, value: float, **tags):
+    """Aggiunge un valore all'istogramma `name`."""
+    key = _key(name, tags)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = {"buckets": [0] * len(BUCKETS), "sum": 0.0, "count": 0}
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                histogram["buckets"][i] += 1
+        histogram["sum"] += value
+        histogram["count"] += 1
+
+
+def inc(name: str, amount: float = 1, **tags):
+    """Incrementa il contatore `name`."""
+    key = _key(name, tags)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + amount
+
+
+def log_event(event: str, **fields):
+    """Scrive una riga di log strutturato (JSON)."""
+    if METRICS_LOG:
+        line = json.dumps({"event": event, "instance": _request_instance.get(), **fields}, ensure_ascii=False, default=str)
+        # Una sola write per riga, così i log di thread diversi non si mescolano
+        sys.stdout.write(line + "\n")
+
+
+@contextmanager
+def span(stage: str, **tags):
+    """Misura la durata di una fase della pipeline."""
+    tags = {"instance": _request_instance.get(), **tags}
+    started = time.perf_counter()
+    ok = True
+    try:
+        yield tags
+    except BaseException:
+        ok = False
+        raise
+    finally:
+        duration = time.perf_counter() - started
+        observe(STAGE_SECONDS, duration, stage=stage, **tags)
+        if not ok:
+            inc(STAGE_ERRORS, stage=stage, **tags)
+        log_event("span", stage=stage, duration_ms=round(duration * 1000, 2), ok=ok, **tags)
+
+
+def record_llm_usage(agent: str, usage, model: str | None = None):
+    """Registra i token riportati da Groq nel campo `usage` di una risposta."""
+    if usage is None:
+        return
+    for kind in ("prompt_tokens", "completion_tokens"):
+        value = getattr(usage, kind, None)
+        if value is None and isinstance(usage, dict):
+            value = usage.get(kind)
+        if value:
+            inc("tinyagents_llm_tokens_total", value, agent=agent, kind=kind.split('_')[0], model=model)
+
+
+class InstrumentedClient:
+    """Proxy che misura ogni chiamata ai metodi di un client (es. `telegram.Bot`)."""
+
+    def __init__(self, client, stage: str):
+        self._client = client
+        self._stage = stage
+
+    def __getattr__(self, name):
+        attribute = getattr(self._client, name)
+        if not callable(attribute) or name.startswith('_'):
+            return attribute
+
+        def call(*args, **kwargs):
+            with span(self._stage, op=name):
+                return attribute(*args, **kwargs)
+        return call
+
+
+def counter_totals(name: str, by: str | None = None) -> dict:
+    """Valori del contatore `name`, sommati per il tag `by` (o in totale, con chiave None)."""
+    totals = {}
+    with _lock:
+        for (metric, labels), value in _counters.items():
+            if metric == name:
+                key = dict(labels).get(by) if by else None
+                totals[key] = totals.get(key, 0) + value
+    return totals
+
+
+# --- ESPORTAZIONE ---
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(labels, extra=()):
+    items = list(labels) + list(extra)
+    if not items:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in items) + "}"
+
+
+def render_prometheus() -> str:
+    """Restituisce tutte le metriche nel formato di testo di Prometheus."""
+    lines = []
+    with _lock:
+        histograms = {k: {"buckets": list(v["buckets"]), "sum": v["sum"], "count": v["count"]} for k, v in _histograms.items()}
+        counters = dict(_counters)
+
+    for name in sorted({name for name, _ in histograms}):
+        lines.append(f"# HELP {name} {_HELP.get(name, name)}")
+        lines.append(f"# TYPE {name} histogram")
+        for (metric, labels), data in sorted(histograms.items()):
+            if metric != name:
+                continue
+            for bound, count in zip(BUCKETS, data["buckets"]):
+                lines.append(f"{name}_bucket{_format_labels(labels, [('le', bound)])} {count}")
+            lines.append(f"{name}_bucket{_format_labels(labels, [('le', '+Inf')])} {data['count']}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {data['sum']}")
+            lines.append(f"{name}_count{_format_labels(labels)} {data['count']}")
+
+    for name in sorted({name for name, _ in counters}):
+        lines.append(f"# HELP {name} {_HELP.get(name, name)}")
+        lines.append(f"# TYPE {name} counter")
+        for (metric, labels), value in sorted(counters.items()):
+            if metric == name:
+                lines.append(f"{name}{_format_labels(labels)} {value}")
+
+    lines.append("# HELP tinyagents_instance_uptime_seconds Secondi dall'avvio dell'istanza")
+    lines.append("# TYPE tinyagents_instance_uptime_seconds gauge")
+    lines.append(f"tinyagents_instance_uptime_seconds {time.time() - _started_at}")
+    return "\n".join(lines) + "\n"
+
+
+def serve_metrics(request_handler):
+    """Risponde a una GET con le metriche dell'istanza (richiede `METRICS_TOKEN`, se impostato)."""
+    if METRICS_TOKEN and request_handler.headers.get('Authorization') != f"Bearer {METRICS_TOKEN}":
+        request_handler.send_response(401)
+        request_handler.end_headers()
+        return
+    body = render_prometheus().encode('utf-8')
+    request_handler.send_response(200)
+    request_handler.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+    request_handler.send_header('Content-Length', str(len(body)))
+    request_handler.end_headers()
+    request_handler.wfile.write(body)
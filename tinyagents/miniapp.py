@@ -0,0 +1,209 @@
+"""
+Saldo dei crediti per la Mini App (`GET /api/credits`).
+
+La Mini App invia `Authorization: tma <initData>`. La firma di `initData`
+viene verificata con HMAC-SHA256 come descritto nella documentazione delle
+Web App di Telegram; l'esito viene tenuto in cache per l'hash della stringa,
+così le richieste successive della stessa sessione non ricalcolano la firma.
+
+Il saldo viene servito da una cache in memoria con TTL breve
+(`CREDITS_CACHE_TTL`): i saldi non in cache richiesti mentre è già in corso
+una lettura vengono raccolti e letti insieme con una sola query alla
+successiva. Ogni risposta ha un ETag: con `If-None-Match` uguale la risposta
+è un 304 senza corpo, e `Cache-Control: private, max-age` evita anche la
+richiesta per qualche secondo.
+"""
+import hashlib
+import hmac
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import parse_qsl
+
+from tinyagents import metrics
+from tinyagents.clients import TELEGRAM_TOKEN
+from tinyagents.credits import get_users_credits
+
+# --- CONFIGURAZIONE ---
+CREDITS_CACHE_TTL = float(os.environ.get('CREDITS_CACHE_TTL', '5'))
+# Validità massima di initData dal momento in cui Telegram l'ha firmato (secondi)
+INIT_DATA_MAX_AGE = float(os.environ.get('INIT_DATA_MAX_AGE', '86400'))
+
+_MAX_TRACKED = 10000
+# Attesa massima di una lettura dei saldi in corso (secondi)
+_BATCH_TIMEOUT = 10.0
+
+
+# --- VALIDAZIONE DI initData ---
+
+def validate_init_data(init_data: str, bot_token: str, max_age: float = INIT_DATA_MAX_AGE, now: float | None = None):
+    """
+    Verifica la firma di `initData` e restituisce (utente, auth_date), oppure None se non è valida o è scaduta.
+    """
+    fields = dict(parse_qsl(init_data, keep_blank_values=True))
+    received_hash = fields.pop('hash', None)
+    if not received_hash or not bot_token:
+        return None
+    data_check_string = "\n".join(f"{key}={fields[key]}" for key in sorted(fields))
+    secret_key = hmac.new(b"WebAppData", bot_token.encode('utf-8'), hashlib.sha256).digest()
+    expected = hmac.new(secret_key, data_check_string.encode('utf-8'), hashlib.sha256).hexdigest()
+    if not hmac.compare_digest(expected, received_hash):
+        return None
+    try:
+        auth_date = int(fields['auth_date'])
+        user = json.loads(fields['user'])
+        int(user['id'])
+    except (KeyError, TypeError, ValueError):
+        return None
+    if (now if now is not None else time.time()) - auth_date > max_age:
+        return None
+    return user, auth_date
+
+
+class InitDataCache:
+    """initData già verificati, indicizzati per hash, fino alla loro scadenza."""
+
+    def __init__(self, bot_token: str | None = TELEGRAM_TOKEN, max_age: float = INIT_DATA_MAX_AGE,
+                 maxsize: int = _MAX_TRACKED, clock=time.time):
+        self.bot_token = bot_token
+        self.max_age = max_age
+        self.maxsize = maxsize
+        self.clock = clock
+        self._verified = OrderedDict()
+        self._lock = threading.Lock()
+
+    def user(self, init_data: str) -> dict | None:
+        """L'utente Telegram di `init_data`, o None se la firma non è valida."""
+        key = hashlib.sha256(init_data.encode('utf-8')).digest()
+        now = self.clock()
+        with self._lock:
+            cached = self._verified.get(key)
+            if cached is not None and cached[1] > now:
+                self._verified.move_to_end(key)
+                return cached[0]
+        verified = validate_init_data(init_data, self.bot_token, self.max_age, now)
+        if verified is None:
+            return None
+        user, auth_date = verified
+        with self._lock:
+            self._verified[key] = (user, auth_date + self.max_age)
+            while len(self._verified) > self.maxsize:
+                self._verified.popitem(last=False)
+        return user
+
+
+# --- SALDI ---
+
+class _Batch:
+    def __init__(self):
+        self.user_ids = set()
+        self.values = None
+
+
+class BalanceCache:
+    """Saldi recenti in memoria; le letture dei saldi mancanti vengono raggruppate."""
+
+    def __init__(self, loader=get_users_credits, ttl: float = CREDITS_CACHE_TTL,
+                 maxsize: int = _MAX_TRACKED, clock=time.monotonic):
+        self.loader = loader
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.clock = clock
+        self._values = OrderedDict()
+        self._cond = threading.Condition()
+        self._loading = False
+        self._next = None
+
+    def cached(self, user_id) -> int | None:
+        entry = self._values.get(user_id)
+        if entry is not None and entry[1] > self.clock():
+            return entry[0]
+        return None
+
+    def get(self, user_id):
+        """Restituisce (saldo, origine) con origine `cache` o `database`; saldo None in caso di errore."""
+        with self._cond:
+            balance = self.cached(user_id)
+            if balance is not None:
+                return balance, "cache"
+            # Il saldo si aggiunge al prossimo batch; lo legge il primo thread che trova libero il database
+            if self._next is None:
+                self._next = _Batch()
+            batch = self._next
+            batch.user_ids.add(user_id)
+            while batch.values is None:
+                if not self._loading:
+                    self._loading = True
+                    self._next = None
+                    break
+                if not self._cond.wait(_BATCH_TIMEOUT):
+                    return None, "database"
+            else:
+                return batch.values.get(user_id), "database"
+
+        values = None
+        try:
+            values = self.loader(sorted(batch.user_ids))
+        finally:
+            with self._cond:
+                batch.values = values or {}
+                expires_at = self.clock() + self.ttl
+                for batch_user, balance in batch.values.items():
+                    self._values[batch_user] = (balance, expires_at)
+                    self._values.move_to_end(batch_user)
+                while len(self._values) > self.maxsize:
+                    self._values.popitem(last=False)
+                self._loading = False
+                self._cond.notify_all()
+        return batch.values.get(user_id), "database"
+
+
+init_data_cache = InitDataCache()
+balance_cache = BalanceCache()
+
+
+def _send_json(request_handler, status: int, body: dict, headers: dict | None = None):
+    data = json.dumps(body).encode('utf-8')
+    request_handler.send_response(status)
+    request_handler.send_header('Content-Type', 'application/json; charset=utf-8')
+    request_handler.send_header('Content-Length', str(len(data)))
+    for name, value in (headers or {}).items():
+        request_handler.send_header(name, value)
+    request_handler.end_headers()
+    request_handler.wfile.write(data)
+
+
+def serve_credits(request_handler):
+    """Risponde a una GET con il saldo dell'utente autenticato da initData."""
+    authorization = request_handler.headers.get('Authorization') or ''
+    scheme, _, init_data = authorization.partition(' ')
+    user = init_data_cache.user(init_data.strip()) if scheme.lower() == 'tma' else None
+    if user is None:
+        metrics.inc("tinyagents_credits_api_total", status="401")
+        _send_json(request_handler, 401, {"error": "initData mancante o non valido"})
+        return
+
+    user_id = int(user['id'])
+    balance, source = balance_cache.get(user_id)
+    if balance is None:
+        metrics.inc("tinyagents_credits_api_total", status="503", source=source)
+        _send_json(request_handler, 503, {"error": "Saldo non disponibile, riprova tra poco"}, {'Retry-After': '5'})
+        return
+
+    etag = 'W/"' + hashlib.sha256(f"{user_id}:{balance}".encode()).hexdigest()[:16] + '"'
+    headers = {
+        'ETag': etag,
+        'Cache-Control': f"private, max-age={int(CREDITS_CACHE_TTL)}",
+        'Vary': 'Authorization',
+    }
+    if request_handler.headers.get('If-None-Match') == etag:
+        metrics.inc("tinyagents_credits_api_total", status="304", source=source)
+        request_handler.send_response(304)
+        for name, value in headers.items():
+            request_handler.send_header(name, value)
+        request_handler.end_headers()
+        return
+    metrics.inc("tinyagents_credits_api_total", status="200", source=source)
+    _send_json(request_handler, 200, {"user_id": user_id, "credits": balance}, headers)
@@ -0,0 +1,208 @@
+"""
+Messaggi in uscita verso Telegram.
+
+Ogni update ha una `Outbox`: i gestori dei comandi vi accodano i messaggi e
+l'ultimo resta in sospeso finché non ne arriva un altro (che lo fa partire,
+così l'ordine è rispettato) o l'elaborazione finisce. A quel punto:
+
+- se il webhook è ancora aperto, il messaggio viaggia nel corpo della
+  risposta HTTP (`{"method": "sendMessage", ...}`) e Telegram lo esegue senza
+  una chiamata alla Bot API;
+- altrimenti (modalità ack-first, long polling) viene inviato con la Bot API.
+
+Tutti gli invii passano da `FloodControl`, che distribuisce i messaggi nel
+tempo secondo i limiti di Telegram: `TELEGRAM_CHAT_PER_SECOND` messaggi al
+secondo per chat privata (raffiche fino a `TELEGRAM_CHAT_BURST`),
+`TELEGRAM_GROUP_PER_MINUTE` al minuto per gruppo e
+`TELEGRAM_GLOBAL_PER_SECOND` al secondo per tutto il bot. Un 429 di Telegram
+(`RetryAfter`) blocca la chat per `retry_after` secondi e il messaggio viene
+ritentato; un messaggio con Markdown non valido (`BadRequest`) viene ripetuto
+come testo semplice; un messaggio che non parte entro
+`TELEGRAM_SEND_MAX_WAIT` secondi, o che fallisce per altri motivi, viene
+scartato con un log invece di interrompere il comando.
+
+Nella risposta al webhook Telegram non segnala errori: vi finiscono solo testi
+scritti dal bot. Le risposte degli agenti (Markdown generato dall'LLM) vengono
+inviate con `wait=True`, così un Markdown non valido viene corretto e un invio
+fallito è visibile al chiamante, che può rimborsare il credito.
+"""
+import os
+import threading
+import time
+
+from tinyagents import metrics
+from tinyagents.admission import MemoryBucketStore
+
+# --- CONFIGURAZIONE ---
+# Con TELEGRAM_FLOOD_CONTROL=false i messaggi non vengono distribuiti nel tempo (retry_after resta rispettato)
+TELEGRAM_FLOOD_CONTROL = os.environ.get('TELEGRAM_FLOOD_CONTROL', 'true').lower() in ('1', 'true', 'yes')
+TELEGRAM_CHAT_PER_SECOND = float(os.environ.get('TELEGRAM_CHAT_PER_SECOND', '1'))
+TELEGRAM_CHAT_BURST = float(os.environ.get('TELEGRAM_CHAT_BURST', '3'))
+TELEGRAM_GROUP_PER_MINUTE = float(os.environ.get('TELEGRAM_GROUP_PER_MINUTE', '20'))
+TELEGRAM_GLOBAL_PER_SECOND = float(os.environ.get('TELEGRAM_GLOBAL_PER_SECOND', '30'))
+TELEGRAM_SEND_MAX_WAIT = float(os.environ.get('TELEGRAM_SEND_MAX_WAIT', '20'))
+TELEGRAM_SEND_RETRIES = int(os.environ.get('TELEGRAM_SEND_RETRIES', '3'))
+
+
+class FloodControl:
+    """Distribuisce gli invii per chat secondo i limiti di Telegram e rispetta `retry_after`."""
+
+    def __init__(self, pacing: bool = TELEGRAM_FLOOD_CONTROL, chat_per_second: float = TELEGRAM_CHAT_PER_SECOND,
+                 chat_burst: float = TELEGRAM_CHAT_BURST, group_per_minute: float = TELEGRAM_GROUP_PER_MINUTE,
+                 global_per_second: float = TELEGRAM_GLOBAL_PER_SECOND, max_wait: float = TELEGRAM_SEND_MAX_WAIT,
+                 retries: int = TELEGRAM_SEND_RETRIES, clock=time.monotonic, sleep=time.sleep):
+        self.pacing = pacing
+        self.chat_rate = chat_per_second
+        self.chat_burst = chat_burst
+        self.group_rate = group_per_minute / 60
+        self.global_rate = global_per_second
+        self.max_wait = max_wait
+        self.retries = retries
+        self.clock = clock
+        self.sleep = sleep
+        self.buckets = MemoryBucketStore(clock=clock)
+        # Chat bloccate da un 429 di Telegram: chat_id -> istante di sblocco
+        self._blocked = {}
+        self._lock = threading.Lock()
+
+    def _blocked_for(self, chat_id) -> float:
+        with self._lock:
+            until = self._blocked.get(chat_id)
+            if until is None:
+                return 0.0
+            wait = until - self.clock()
+            if wait <= 0:
+                del self._blocked[chat_id]
+                return 0.0
+            return wait
+
+    def block(self, chat_id, seconds: float):
+        """Sospende gli invii verso la chat (risposta 429 con `retry_after`)."""
+        with self._lock:
+            self._blocked[chat_id] = max(self._blocked.get(chat_id, 0.0), self.clock() + seconds)
+
+    def _take(self, chat_id) -> float:
+        """Preleva i gettoni per un messaggio; restituisce i secondi da attendere (0 se può partire)."""
+        wait = self._blocked_for(chat_id)
+        if wait or not self.pacing:
+            return wait
+        # Gli id negativi sono gruppi e canali, con un limite al minuto
+        rate = self.group_rate if isinstance(chat_id, int) and chat_id < 0 else self.chat_rate
+        if rate > 0:
+            wait = self.buckets.take(f"chat:{chat_id}", rate, self.chat_burst)
+            if wait:
+                return wait
+        if self.global_rate > 0:
+            return self.buckets.take("global", self.global_rate, self.global_rate)
+        return 0.0
+
+    def try_acquire(self, chat_id) -> bool:
+        """True se un messaggio verso la chat può partire subito (gettoni prelevati)."""
+        return self._take(chat_id) == 0
+
+    def send(self, send_message, chat_id, **params):
+        """
+        Invia un messaggio con `send_message(chat_id=..., **params)` appena i limiti lo consentono.
+        Restituisce il risultato della chiamata, o None se il messaggio è stato scartato.
+        """
+        from telegram.error import BadRequest, RetryAfter
+
+        deadline = self.clock() + self.max_wait
+        retries = self.retries
+        while True:
+            wait = self._take(chat_id)
+            while wait:
+                if self.clock() + wait > deadline:
+                    metrics.inc("tinyagents_telegram_sends_total", result="dropped")
+                    print(f"Messaggio per la chat {chat_id} scartato: limiti di Telegram oltre {self.max_wait}s")
+                    return None
+                metrics.inc("tinyagents_telegram_sends_total", result="delayed")
+                self.sleep(wait)
+                wait = self._take(chat_id)
+            try:
+                # Il bot condiviso misura già la chiamata come fase "telegram"
+                result = send_message(chat_id=chat_id, **params)
+                metrics.inc("tinyagents_telegram_sends_total", result="sent")
+                return result
+            except RetryAfter as e:
+                metrics.inc("tinyagents_telegram_sends_total", result="retry_after")
+                self.block(chat_id, float(e.retry_after))
+                if not retries:
+                    metrics.inc("tinyagents_telegram_sends_total", result="dropped")
+                    print(f"Messaggio per la chat {chat_id} scartato dopo {self.retries + 1} risposte 429")
+                    return None
+                retries -= 1
+            except BadRequest as e:
+                if not params.pop("parse_mode", None):
+                    metrics.inc("tinyagents_telegram_sends_total", result="error")
+                    print(f"Errore Telegram (send_message): {e}")
+                    return None
+                # Markdown non valido (es. generato dall'LLM): si ripete come testo semplice
+                metrics.inc("tinyagents_telegram_sends_total", result="plain_text")
+                print(f"Markdown non valido per la chat {chat_id}, invio come testo semplice: {e}")
+            except Exception as e:
+                metrics.inc("tinyagents_telegram_sends_total", result="error")
+                print(f"Errore Telegram (send_message): {e}")
+                return None
+
+
+flood_control = FloodControl()
+
+
+class Outbox:
+    """
+    Messaggi in uscita di un update; l'ultimo può viaggiare nella risposta al webhook.
+    Il bot viene creato con `bot_factory` solo al primo invio con la Bot API, così gli
+    update senza risposta (o con la sola risposta al webhook) non caricano l'SDK di Telegram.
+    """
+
+    def __init__(self, bot_factory, flood_control: FloodControl = flood_control):
+        self.bot_factory = bot_factory
+        self.flood_control = flood_control
+        self._bot = None
+        self._pending = None
+
+    @property
+    def bot(self):
+        if self._bot is None:
+            self._bot = self.bot_factory()
+        return self._bot
+
+    def send_message(self, chat_id, text, parse_mode=None, wait: bool = False):
+        """
+        Accoda un messaggio e invia quello precedente. Con `wait=True` il messaggio
+        parte subito e viene restituito il `telegram.Message` (es. per modificarlo poi),
+        o None se non è stato consegnato: va usato per i testi non scritti dal bot,
+        come le risposte dell'LLM, che non devono finire nella risposta al webhook.
+        """
+        self.flush()
+        params = {"text": text}
+        if parse_mode:
+            params["parse_mode"] = parse_mode
+        if wait:
+            return self.flood_control.send(self.bot.send_message, chat_id, **params)
+        self._pending = (chat_id, params)
+        return None
+
+    def flush(self):
+        """Invia con la Bot API il messaggio in sospeso."""
+        pending, self._pending = self._pending, None
+        if pending is not None:
+            chat_id, params = pending
+            self.flood_control.send(self.bot.send_message, chat_id, **params)
+
+    def webhook_reply(self) -> dict | None:
+        """
+        Il messaggio in sospeso come chiamata da restituire nel corpo della risposta
+        al webhook, o None. Se la chat è oltre i limiti il messaggio viene invece
+        inviato con la Bot API, che attende il proprio turno.
+        """
+        pending, self._pending = self._pending, None
+        if pending is None:
+            return None
+        chat_id, params = pending
+        if not self.flood_control.try_acquire(chat_id):
+            self.flood_control.send(self.bot.send_message, chat_id, **params)
+            return None
+        metrics.inc("tinyagents_telegram_sends_total", result="webhook_reply")
+        return {"method": "sendMessage", "chat_id": chat_id, **params}
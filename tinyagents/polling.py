@@ -0,0 +1,322 @@
+"""
+Runner in long polling per l'hosting su un server proprio.
+
+Alternativa al webhook di Vercel: un unico processo chiede gli update a
+Telegram con `getUpdates` (long polling su asyncio) e li passa a un pool di
+worker che eseguono la stessa logica di `do_POST` (`process_update` di
+`api/telegram.py`). Le chiamate a Supabase, Groq e Telegram restano
+sincrone e girano in un pool di thread di `POLL_CONCURRENCY` elementi.
+
+- Concorrenza limitata: la coda interna contiene al massimo
+  `2 * POLL_CONCURRENCY` update; quando è piena il polling si ferma.
+- Offset persistente: ogni blocco di update viene salvato in
+  `POLL_OFFSET_PATH` prima di essere accodato, insieme agli update ricevuti e
+  non ancora completati. Telegram dimentica gli update confermati da
+  getUpdates: al riavvio, anche dopo un crash, gli update non completati
+  vengono rielaborati dal file invece di andare persi.
+- Arresto ordinato: con SIGINT/SIGTERM il polling si ferma, gli update già
+  accodati vengono completati (al massimo `POLL_SHUTDOWN_TIMEOUT` secondi) e
+  quelli rimasti restano nel file per il riavvio. Gli update di una richiesta
+  getUpdates interrotta non vengono confermati e Telegram li riconsegna.
+
+Uso (dalla root del repository, con il webhook disattivato):
+
+    python -m tinyagents.polling --delete-webhook --concurrency 200
+"""
+import argparse
+import asyncio
+import importlib.util
+import json
+import os
+import signal
+import sys
+import threading
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from tinyagents import metrics
+
+# --- CONFIGURAZIONE ---
+POLL_CONCURRENCY = int(os.environ.get('POLL_CONCURRENCY', '100'))
+POLL_TIMEOUT = int(os.environ.get('POLL_TIMEOUT', '30'))
+POLL_OFFSET_PATH = os.environ.get('POLL_OFFSET_PATH', '/tmp/tinyagents_poll_offset.json')
+POLL_SHUTDOWN_TIMEOUT = float(os.environ.get('POLL_SHUTDOWN_TIMEOUT', '30'))
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MAX_BACKOFF = 30.0
+# Intervallo (secondi) tra due salvataggi degli update completati
+SAVE_INTERVAL = 1.0
+
+
+class OffsetStore:
+    """Offset di getUpdates e update non ancora completati, salvati su file (scrittura atomica)."""
+
+    def __init__(self, path: str = POLL_OFFSET_PATH):
+        self.path = path
+
+    def load(self):
+        """Restituisce (offset, update da rielaborare); (None, []) se il file non esiste."""
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                data = json.load(f)
+            return int(data["offset"]), list(data.get("pending", []))
+        except FileNotFoundError:
+            return None, []
+        except Exception as e:
+            print(f"Offset di polling illeggibile in {self.path}: {e}")
+            return None, []
+
+    def save(self, offset: int, pending=()):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding='utf-8') as f:
+            json.dump({"offset": offset, "pending": list(pending)}, f)
+        os.replace(tmp_path, self.path)
+
+
+# --- BOT API ---
+
+def _api_url(method: str) -> str:
+    from tinyagents.clients import TELEGRAM_API_URL, TELEGRAM_TOKEN
+    return f"{TELEGRAM_API_URL or 'https://api.telegram.org'}/bot{TELEGRAM_TOKEN}/{method}"
+
+
+def call_bot_api(method: str, params: dict, timeout: float = 10.0):
+    """Chiamata diretta alla Bot API: gli update arrivano come dizionari, come nel webhook."""
+    request = urllib.request.Request(
+        _api_url(method),
+        data=json.dumps(params).encode('utf-8'),
+        headers={"Content-Type": "application/json"},
+    )
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            data = json.load(response)
+    except urllib.error.HTTPError as e:
+        data = json.load(e)
+    if not data.get("ok"):
+        raise RuntimeError(f"{method}: {data.get('description', data)}")
+    return data["result"]
+
+
+def get_updates(offset: int | None, timeout: int) -> list:
+    """Long polling: attende fino a `timeout` secondi nuovi messaggi."""
+    params = {"timeout": timeout, "allowed_updates": ["message"]}
+    if offset is not None:
+        params["offset"] = offset
+    return call_bot_api("getUpdates", params, timeout=timeout + 10)
+
+
+def _run_in_daemon_thread(loop, function, *args) -> asyncio.Future:
+    """Esegue `function` in un thread daemon: un long poll in corso non blocca l'uscita del processo."""
+    future = loop.create_future()
+
+    def settle(setter, value):
+        if not future.done():
+            setter(value)
+
+    def target():
+        try:
+            result = function(*args)
+        except BaseException as e:
+            outcome = (future.set_exception, e)
+        else:
+            outcome = (future.set_result, result)
+        try:
+            loop.call_soon_threadsafe(settle, *outcome)
+        except RuntimeError:
+            # Il ciclo asyncio è già stato chiuso: il risultato viene scartato
+            pass
+
+    threading.Thread(target=target, name="telegram-poll", daemon=True).start()
+    return future
+
+
+class PollingRunner:
+    """Ciclo getUpdates su asyncio che alimenta un pool di worker con concorrenza limitata."""
+
+    def __init__(self, handle_update, concurrency: int = POLL_CONCURRENCY, poll_timeout: int = POLL_TIMEOUT,
+                 offset_store: OffsetStore | None = None, fetch=get_updates, is_duplicate=None,
+                 shutdown_timeout: float = POLL_SHUTDOWN_TIMEOUT):
+        self.handle_update = handle_update
+        self.concurrency = concurrency
+        self.poll_timeout = poll_timeout
+        self.offset_store = offset_store or OffsetStore()
+        self.fetch = fetch
+        self.is_duplicate = is_duplicate
+        self.shutdown_timeout = shutdown_timeout
+        self.offset = None
+        self.processed = 0
+        # Update ricevuti e non ancora completati, per update_id
+        self._unfinished = {}
+        self._dirty = False
+        self._stop = None
+        self._queue = None
+        self._executor = None
+
+    def stop(self):
+        """Richiede l'arresto ordinato (sicuro da chiamare da un signal handler)."""
+        if self._stop is not None:
+            self._stop.set()
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        self._stop = asyncio.Event()
+        self._queue = asyncio.Queue(maxsize=self.concurrency * 2)
+        self._executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="poll-worker")
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, self.stop)
+            except (NotImplementedError, RuntimeError):
+                pass
+
+        self.offset, pending = self.offset_store.load()
+        workers = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+        saver = asyncio.create_task(self._save_periodically())
+        print(f"Polling avviato (offset {self.offset}, {len(pending)} update da riprendere, {self.concurrency} worker).")
+        try:
+            # Update ricevuti prima dell'ultimo arresto e mai completati
+            for update in pending:
+                self._unfinished[update["update_id"]] = update
+                await self._queue.put(update)
+            await self._poll()
+        finally:
+            saver.cancel()
+            await self._shutdown(workers)
+
+    def _save(self):
+        if self.offset is not None:
+            self.offset_store.save(self.offset, self._unfinished.values())
+        self._dirty = False
+
+    async def _save_periodically(self):
+        while True:
+            await asyncio.sleep(SAVE_INTERVAL)
+            if self._dirty:
+                self._save()
+
+    async def _poll(self):
+        loop = asyncio.get_running_loop()
+        backoff = 1.0
+        stop_wait = asyncio.create_task(self._stop.wait())
+        try:
+            while not self._stop.is_set():
+                fetch = _run_in_daemon_thread(loop, self.fetch, self.offset, self.poll_timeout)
+                await asyncio.wait({fetch, stop_wait}, return_when=asyncio.FIRST_COMPLETED)
+                if self._stop.is_set():
+                    # Gli update di questa richiesta non sono confermati: Telegram li riconsegnerà
+                    fetch.cancel()
+                    break
+                try:
+                    updates = fetch.result()
+                except Exception as e:
+                    print(f"Errore getUpdates (nuovo tentativo tra {backoff:.0f}s): {e}")
+                    await asyncio.wait({stop_wait}, timeout=backoff)
+                    backoff = min(backoff * 2, MAX_BACKOFF)
+                    continue
+                backoff = 1.0
+
+                batch = []
+                for update in updates:
+                    self.offset = update["update_id"] + 1
+                    if self.is_duplicate is not None and self.is_duplicate(update):
+                        continue
+                    self._unfinished[update["update_id"]] = update
+                    batch.append(update)
+                # Il blocco viene salvato prima di essere elaborato: la prossima
+                # getUpdates lo conferma e Telegram non lo riconsegnerà più
+                if updates:
+                    self._save()
+                for update in batch:
+                    # Coda piena: il polling aspetta che i worker si liberino
+                    await self._queue.put(update)
+                    metrics.inc("tinyagents_poll_updates_total")
+        finally:
+            stop_wait.cancel()
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            update = await self._queue.get()
+            try:
+                await loop.run_in_executor(self._executor, self.handle_update, update)
+                self.processed += 1
+            except Exception as e:
+                print(f"ERRORE WORKER POLLING (update {update.get('update_id')}): {e}")
+            finally:
+                self._queue.task_done()
+            # Un worker annullato (arresto forzato) non arriva qui: l'update resta da rielaborare
+            self._unfinished.pop(update.get("update_id"), None)
+            self._dirty = True
+
+    async def _shutdown(self, workers):
+        pending = self._queue.qsize()
+        print(f"Arresto del polling: completamento di {pending} update in coda e di quelli in corso...")
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout=self.shutdown_timeout)
+        except asyncio.TimeoutError:
+            print(f"Arresto forzato dopo {self.shutdown_timeout}s: {len(self._unfinished)} update non completati "
+                  f"verranno rielaborati al riavvio.")
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        self._save()
+        print(f"Polling arrestato: {self.processed} update elaborati, offset {self.offset}.")
+
+
+# --- AVVIO ---
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Runner in long polling del bot TinyAgents.")
+    parser.add_argument("--concurrency", type=int, default=POLL_CONCURRENCY, help="update elaborati in parallelo")
+    parser.add_argument("--poll-timeout", type=int, default=POLL_TIMEOUT, help="durata del long polling (s)")
+    parser.add_argument("--offset-path", default=POLL_OFFSET_PATH, help="file in cui salvare l'offset")
+    parser.add_argument("--shutdown-timeout", type=float, default=POLL_SHUTDOWN_TIMEOUT)
+    parser.add_argument("--delete-webhook", action="store_true", help="rimuove il webhook (getUpdates non funziona se è attivo)")
+    return parser.parse_args(argv)
+
+
+def load_bot_module():
+    """Carica `api/telegram.py`, che contiene la stessa logica usata dal webhook."""
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+    spec = importlib.util.spec_from_file_location("tinyagents_bot", os.path.join(ROOT, "api", "telegram.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def configure_pools(concurrency: int):
+    """
+    Dimensiona sul numero di worker i pool di connessioni verso Telegram e Groq e
+    il limite di chiamate a Groq in corso, se non già impostati nell'ambiente.
+    Va chiamata prima di caricare i client condivisi.
+    """
+    for name in ('TELEGRAM_POOL_SIZE', 'GROQ_MAX_CONNECTIONS', 'LLM_MAX_INFLIGHT'):
+        os.environ.setdefault(name, str(concurrency))
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    configure_pools(args.concurrency)
+    bot = load_bot_module()
+    if not bot.TELEGRAM_TOKEN:
+        print("TELEGRAM_TOKEN mancante.")
+        return 1
+    if args.delete_webhook:
+        call_bot_api("deleteWebhook", {"drop_pending_updates": False})
+
+    runner = PollingRunner(
+        handle_update=bot.process_update,
+        concurrency=args.concurrency,
+        poll_timeout=args.poll_timeout,
+        offset_store=OffsetStore(args.offset_path),
+        is_duplicate=bot.is_duplicate_update,
+        shutdown_timeout=args.shutdown_timeout,
+    )
+    asyncio.run(runner.run())
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,124 @@
+"""
+Registro degli agenti.
+
+Gli agenti sono definiti in `agents.json` (nella root del repository, oppure nel
+file indicato da `AGENTS_CONFIG`). Ogni agente può impostare modello,
+temperatura, `max_tokens` e `cacheable`; i valori mancanti vengono presi dalla
+sezione `defaults`.
+
+Il file viene letto una sola volta per istanza: il registro precalcola le
+risposte statiche (messaggio di benvenuto, messaggi d'uso) e l'elenco pubblico
+degli agenti servito alla Mini App da `GET /api/agents`.
+"""
+import hashlib
+import json
+import os
+import threading
+
+# --- CONFIGURAZIONE ---
+AGENTS_CONFIG = os.environ.get('AGENTS_CONFIG') or os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'agents.json'
+)
+
+# Comandi gestiti dal bot che non corrispondono ad agenti
+RESERVED_COMMANDS = frozenset({"start", "credits", "buy", "multi"})
+
+# Campi dell'agente esposti alla Mini App (il system prompt resta sul server)
+PUBLIC_FIELDS = ("emoji", "description")
+
+
+def parse_command(text: str):
+    """Divide `/comando@bot argomenti` in (`comando`, `argomenti`).
+
+    Restituisce (None, testo) se il messaggio non è un comando.
+    """
+    if not text.startswith('/'):
+        return None, text
+    parts = text.split(None, 1)
+    command = parts[0][1:].split('@', 1)[0].lower()
+    return command, parts[1].strip() if len(parts) > 1 else ""
+
+
+class AgentRegistry:
+    """Agenti caricati dalla configurazione, con le risposte statiche già pronte."""
+
+    def __init__(self, config: dict):
+        defaults = config.get("defaults", {})
+        self.agents = {}
+        for name, data in config["agents"].items():
+            if name in RESERVED_COMMANDS:
+                raise ValueError(f"Nome di agente riservato: {name}")
+            if not data.get("system_prompt"):
+                raise ValueError(f"system_prompt mancante per l'agente {name}")
+            self.agents[name] = {**defaults, **data}
+
+        self.welcome_message = self._build_welcome_message()
+        self.usage_messages = {name: f"Uso corretto: `/{name} [la tua richiesta]`" for name in self.agents}
+
+        public = {name: {k: data[k] for k in PUBLIC_FIELDS if k in data} for name, data in self.agents.items()}
+        self.public_json = json.dumps({"agents": public}, ensure_ascii=False).encode('utf-8')
+        self.public_etag = '"' + hashlib.sha256(self.public_json).hexdigest()[:16] + '"'
+
+    def __contains__(self, name) -> bool:
+        return name in self.agents
+
+    def __getitem__(self, name) -> dict:
+        return self.agents[name]
+
+    def _build_welcome_message(self) -> str:
+        lines = [
+            "Benvenuto in Tiny Agents! 🤖\n",
+            "Scegli un micro-agente per un compito specifico:\n",
+        ]
+        lines += [f"🔹 `/{name}` - {data['description']}" for name, data in self.agents.items()]
+        example = next(iter(self.agents), "agente")
+        pair = ",".join(list(self.agents)[:2]) or "agente1,agente2"
+        lines += [
+            "",
+            f"Usa il comando seguito dalla tua richiesta. Esempio:\n`/{example} gatto che suona il pianoforte`\n",
+            f"🧩 Più agenti in parallelo sulla stessa idea (un credito per agente):\n`/multi {pair} gatto che suona il pianoforte`\n",
+            "💳 **Monetizzazione:** Usa `/credits` per vedere il tuo saldo e `/buy` per acquistare nuovi utilizzi.",
+        ]
+        return "\n".join(lines)
+
+    def llm_params(self, name: str) -> dict:
+        """Modello e parametri di generazione dell'agente."""
+        data = self.agents[name]
+        return dict(model=data["model"], temperature=data["temperature"], max_tokens=data["max_tokens"])
+
+
+def load_registry(path: str = AGENTS_CONFIG) -> AgentRegistry:
+    """Legge il file di configurazione degli agenti e costruisce il registro."""
+    with open(path, encoding='utf-8') as f:
+        return AgentRegistry(json.load(f))
+
+
+_registry = None
+_lock = threading.Lock()
+
+
+def get_registry() -> AgentRegistry:
+    """Restituisce il registro condiviso, caricandolo alla prima chiamata."""
+    global _registry
+    if _registry is None:
+        with _lock:
+            if _registry is None:
+                _registry = load_registry()
+    return _registry
+
+
+def serve_agents(request_handler):
+    """Risponde a una GET con l'elenco pubblico degli agenti (usato dalla Mini App)."""
+    registry = get_registry()
+    if request_handler.headers.get('If-None-Match') == registry.public_etag:
+        request_handler.send_response(304)
+        request_handler.send_header('ETag', registry.public_etag)
+        request_handler.end_headers()
+        return
+    request_handler.send_response(200)
+    request_handler.send_header('Content-Type', 'application/json; charset=utf-8')
+    request_handler.send_header('Content-Length', str(len(registry.public_json)))
+    request_handler.send_header('Cache-Control', 'public, max-age=300')
+    request_handler.send_header('ETag', registry.public_etag)
+    request_handler.end_headers()
+    request_handler.wfile.write(registry.public_json)
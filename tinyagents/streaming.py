@@ -0,0 +1,73 @@
+"""
+Streaming delle risposte dell'LLM verso Telegram.
+
+Il testo generato viene mostrato modificando un messaggio già inviato
+(il "placeholder"). Le modifiche vengono raggruppate in modo da non superare
+i limiti di Telegram sulle edit: al massimo una ogni `STREAM_EDIT_INTERVAL`
+secondi, e solo se il testo è cambiato.
+"""
+import os
+import time
+
+from telegram.error import BadRequest, RetryAfter
+
+# Intervallo minimo (secondi) tra due modifiche dello stesso messaggio
+STREAM_EDIT_INTERVAL = float(os.environ.get('STREAM_EDIT_INTERVAL', '1.0'))
+# Indicatore mostrato in coda al testo mentre la generazione è in corso
+STREAM_CURSOR = " ▌"
+
+
+class MessageStreamer:
+    """Aggiorna un messaggio Telegram man mano che arrivano nuovi token."""
+
+    def __init__(self, bot, chat_id, message_id, min_interval=STREAM_EDIT_INTERVAL, clock=time.monotonic):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.min_interval = min_interval
+        self.clock = clock
+        self.text = ""
+        self.edits = 0
+        self._shown = None
+        self._next_edit_at = 0.0
+
+    def push(self, delta: str):
+        """Aggiunge un frammento di testo; modifica il messaggio se è passato abbastanza tempo."""
+        if not delta:
+            return
+        self.text += delta
+        if self.clock() >= self._next_edit_at:
+            # I testi parziali possono contenere Markdown non chiuso: niente parse_mode
+            self._edit(self.text + STREAM_CURSOR, parse_mode=None)
+
+    def finish(self, parse_mode=None) -> str:
+        """Mostra il testo completo. Se il Markdown non è valido, lo invia come testo semplice."""
+        try:
+            self._edit(self.text, parse_mode=parse_mode, raise_errors=True)
+        except BadRequest:
+            self._edit(self.text, parse_mode=None)
+        return self.text
+
+    def fail(self, message: str):
+        """Sostituisce il contenuto del messaggio con un messaggio di errore."""
+        self.text = message
+        self._edit(message, parse_mode=None)
+
+    def _edit(self, text, parse_mode=None, raise_errors=False):
+        if not text or text == self._shown:
+            return
+        try:
+            self.bot.edit_message_text(text=text, chat_id=self.chat_id, message_id=self.message_id, parse_mode=parse_mode)
+            self._shown = text
+            self.edits += 1
+            self._next_edit_at = self.clock() + self.min_interval
+        except RetryAfter as e:
+            # Flood control: rimandiamo la prossima modifica intermedia
+            self._next_edit_at = self.clock() + e.retry_after
+            if raise_errors:
+                time.sleep(e.retry_after)
+                self._edit(text, parse_mode=parse_mode, raise_errors=raise_errors)
+        except BadRequest as e:
+            if raise_errors:
+                raise
+            print(f"Errore durante la modifica del messaggio in streaming: {e}")